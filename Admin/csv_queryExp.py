@@ -3,9 +3,10 @@ a bunch of functions that unify csv handling across
 python codes, planned to be somewhat equivalent to +csv. funcs in the matlab base 
 
 """
-import datetime
+import datetime,time
 import pandas as pd
 import re,inspect,json,os,sys,glob
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pathlib import Path
 from itertools import compress
@@ -63,8 +64,8 @@ def check_date_selection(date_selection,dateList):
     dateList: list
         corresponds to all dates to match to 
     
-    Return: list
-        list of dates selected from dateList that pass the criteria determined by date_selection
+    Return: np.ndarray
+        bool, dates selected from dateList that pass the criteria determined by date_selection
     """
     date_range = []
     date_range_called = False # when a from to type of date range called. Otherwise date_selection is treated as list of dates 
@@ -85,22 +86,15 @@ def check_date_selection(date_selection,dateList):
         if len(date_range) == 1:
             date_range.append(date_range[0])
 
-    selected_dates = []
-    for date in dateList:
-        exp_date = datetime.datetime.strptime(date,'%Y-%m-%d')
-
-        # check for the dates
-        if date_range_called:
-            IsGoodDate = (exp_date >= date_range[0]) & (exp_date <= date_range[1])
-        else: 
-            IsGoodDate= True in ([exp_date==date_range[i] for i in range(len(date_range))])           
+    exp_dates = pd.to_datetime(np.array(dateList,dtype='str'),format='%Y-%m-%d')
 
+    # check for the dates
+    if date_range_called:
+        selected_dates = (exp_dates >= date_range[0]) & (exp_dates <= date_range[1])
+    else: 
+        selected_dates = exp_dates.isin(date_range)
 
-        if IsGoodDate:
-            selected_dates.append(True)
-        else:
-            selected_dates.append(False)
-    return selected_dates
+    return np.asarray(selected_dates)
 
 
 def bombcell_sort_units(clusdat,max_peaks=2,max_throughs=1,
@@ -173,14 +167,14 @@ def get_subregions(regionNames,mode='Beryl'):
 
 
     if mode=="Beryl":
-        from Processing.pyhist.helpers.regions import BrainRegions
-        reg = BrainRegions()
+        from Processing.pyhist.helpers.regions import get_brain_regions
+        reg = get_brain_regions()
         regionNames[regionNames=='unregistered']='void'
         parentregions = reg.acronym2acronym(regionNames, mapping='Beryl')
 
     elif mode=='Cosmos':
-        from Processing.pyhist.helpers.regions import BrainRegions
-        reg = BrainRegions()
+        from Processing.pyhist.helpers.regions import get_brain_regions
+        reg = get_brain_regions()
         regionNames[regionNames=='unregistered']='void'
         parentregions = reg.acronym2acronym(regionNames, mapping='Cosmos')       
 
@@ -272,9 +266,62 @@ def select_best_camera(rec,cam_hierarchy=['sideCam','frontCam','eyeCam']):
     return cam 
     
 
-def queryCSV(subject='all',expDate='all',expDef='all',expNum = None,checkIsSortedPyKS=None,checkEvents=None,checkSpikes=None,checkFrontCam = None, checkSideCam = None, checkEyeCam = None):
+# in-process experiment index, see get_experiment_index
+EXP_INDEX_TTL = 600 
+_exp_index = {'time':None,'mouseList':None,'expList':None}
+
+def get_experiment_index(ttl=None,refresh=False):
+    """
+    reads the main csv and all subject csvs once and keeps them in memory for ttl seconds
+
+    Parameters: 
+    ----
+    ttl: None/float
+        time (s) after which the csvs are re-read. If None, EXP_INDEX_TTL
+    refresh: bool
+        whether to re-read the csvs regardless of ttl
+
+    Returns: 
+    ----
+    mouseList: pandas DataFrame 
+        main csv
+    expList: pandas DataFrame 
+        concatenated subject csvs (in the order of the main csv) with a subject column, 
+        indexed by subject,expDate,expDef,expNum
+    """
+    if ttl is None:
+        ttl = EXP_INDEX_TTL
+
+    is_expired = (_exp_index['time'] is None) or ((time.time()-_exp_index['time'])>ttl)
+    if refresh or is_expired:
+        mouseList = pd.read_csv(get_csv_location('main'))
+        expList = []
+        for mm in mouseList.Subject.drop_duplicates():
+            mouse_csv = get_csv_location(mm)
+            if mouse_csv.is_file():
+                mouse_expList = pd.read_csv(mouse_csv,dtype='str')
+                mouse_expList['subject'] = mm
+                expList.append(mouse_expList)
+
+        expList = pd.concat(expList,ignore_index=True)
+        expList.expDate = expList.expDate.str.replace('_','-').str.lower()
+        expList = expList.set_index(['subject','expDate','expDef','expNum'],drop=False)
+
+        _exp_index.update({'time':time.time(),'mouseList':mouseList,'expList':expList})
+
+    return _exp_index['mouseList'],_exp_index['expList']
+
+def check_string_column(expList,column,check):
+    """
+    vectorised check whether the (str) entries of a csv column contain check. nan entries are dropped.
+    """
+    values = expList[column]
+    return values.notna() & values.str.contains(check,regex=False,na=False)
+
+def queryCSV(subject='all',expDate='all',expDef='all',expNum = None,checkIsSortedPyKS=None,checkEvents=None,checkSpikes=None,checkFrontCam = None, checkSideCam = None, checkEyeCam = None,refresh_index=False):
     """ 
     python version to query experiments based on csvs produced on PinkRigs
+    The csvs are only re-read once the in-process experiment index expired (see get_experiment_index) 
 
     Parameters: 
     ----
@@ -299,6 +346,8 @@ def queryCSV(subject='all',expDate='all',expDef='all',expNum = None,checkIsSorte
     check_curation: bool
         only applies if unwrap_independent_probes is True
         whether the data has been curated in phy or not.
+    refresh_index: bool
+        whether to re-read the csvs even if the experiment index has not expired
 
     Returns: 
     ----
@@ -306,8 +355,7 @@ def queryCSV(subject='all',expDate='all',expDef='all',expNum = None,checkIsSorte
         concatenated csv of requested experiments and its params 
     """
 
-    mainCSVLoc = get_csv_location('main') 
-    mouseList=pd.read_csv(mainCSVLoc)
+    mouseList,expList = get_experiment_index(refresh=refresh_index)
     # look for selected mice
     if 'allActive' in subject:
         mouse2checkList = mouseList[mouseList.IsActive==1]['Subject']
@@ -318,88 +366,76 @@ def queryCSV(subject='all',expDate='all',expDef='all',expNum = None,checkIsSorte
             subject = [subject]
         mouse2checkList = mouseList[mouseList.Subject.isin(subject)]['Subject']
 
-    exp2checkList = []
-    for mm in mouse2checkList:
-        mouse_csv = get_csv_location(mm)
-        if mouse_csv.is_file():
-            expList = pd.read_csv(mouse_csv,dtype='str')
-            expList.expDate=[date.replace('_','-').lower() for date in expList.expDate.values]
-            if 'all' not in expDef:
-                if not isinstance(expDef,list):
-                    expDef = [expDef]
-                
-                is_selected_defs = np.concatenate([expList.expDef.str.contains(curr_expDef).values[np.newaxis] for curr_expDef in expDef]).sum(axis=0).astype('bool')
-                expList = expList[is_selected_defs]
-
-
-            if 'all' not in expDate: 
-                # dealing with the call of posImplant based on the main csv. Otherwise one is able to use any date they would like 
-                if ('postImplant' in expDate):
-                    implant_date  = mouseList[mouseList.Subject == mm].P0_implantDate
-                    # check whether mouse was implanted at all or not.
-                    if ~implant_date.isnull().values[0] & (expList.size>0): 
-                        implant_date = implant_date.values[0]
-                        implant_date = implant_date.replace('_','-').lower()
-                        implant_date_range = implant_date + ':' + expList.expDate.iloc[-1]
-                        selected_dates = check_date_selection(implant_date_range,expList.expDate)
-                    else: 
-                        print('%s was not implanted or did not have the requested type of exps.' % mm)
-                        selected_dates = np.zeros(expList.expDate.size).astype('bool')
-                    
-                    expList = expList[selected_dates]
-
-                elif ('last' in expDate):
-                    # this only selects the last experiment done on the given animal
-                    how_many_days = int(expDate.split('last')[1]) 
-                    expList = expList.iloc[-how_many_days:]
+    # select the subjects on the subject level of the index (in the order of the main csv)
+    indexed_subjects = mouse2checkList.drop_duplicates()
+    indexed_subjects = indexed_subjects[indexed_subjects.isin(expList.index.get_level_values('subject').unique())]
+    expList = expList.loc[indexed_subjects.to_list()].reset_index(drop=True)
 
-                else:  
-                    selected_dates = check_date_selection(expDate,expList.expDate)                    
-                    expList = expList[selected_dates]
-                    
-            if expNum:
-                expNum = (np.array(expNum)).astype('str')
-                _,idx,_ = np.intersect1d(expList.expNum.to_numpy(),expNum,return_indices=True)
-                expList = expList.iloc[idx]  
+    if 'all' not in expDef:
+        if not isinstance(expDef,list):
+            expDef = [expDef]
+        
+        is_selected_defs = np.zeros(len(expList)).astype('bool')
+        for curr_expDef in expDef:
+            is_selected_defs = is_selected_defs | expList.expDef.str.contains(curr_expDef).values
+        expList = expList[is_selected_defs]
+
+    if 'all' not in expDate: 
+        # dealing with the call of posImplant based on the main csv. Otherwise one is able to use any date they would like 
+        if ('postImplant' in expDate):
+            implant_dates = mouseList.drop_duplicates('Subject').set_index('Subject').P0_implantDate
+            # the column is read as float if none of the mice was implanted
+            implant_dates = implant_dates.astype('string').str.replace('_','-').str.lower()
+            # check whether mouse was implanted at all or not.
+            for mm in mouse2checkList:
+                if implant_dates.isnull()[mm] or not (expList.subject==mm).any():
+                    print('%s was not implanted or did not have the requested type of exps.' % mm)
+
+            exp_dates = pd.to_datetime(expList.expDate,format='%Y-%m-%d')
+            implant_date = pd.to_datetime(expList.subject.map(implant_dates),format='%Y-%m-%d')
+            last_date = exp_dates.groupby(expList.subject.values).transform('last')
+            expList = expList[((exp_dates>=implant_date) & (exp_dates<=last_date)).values]
+
+        elif ('last' in expDate):
+            # this only selects the last experiment done on the given animal
+            how_many_days = int(expDate.split('last')[1]) 
+            expList = expList.groupby('subject',sort=False).tail(how_many_days)
+
+        else:  
+            selected_dates = check_date_selection(expDate,expList.expDate)                    
+            expList = expList[selected_dates]
             
-            # add mouse name to list
-            expList['subject'] = mm
-
-            exp2checkList.append(expList)
-
-    if len(exp2checkList)>0:
-        exp2checkList = pd.concat(exp2checkList)
-        # re-index
-        exp2checkList = exp2checkList.reset_index(drop=True)
-    
-    else: 
+    if expNum:
+        expNum = np.atleast_1d(expNum).astype('str')
+        # match of each expNum per mouse, sorted by expNum 
+        expList = expList.drop_duplicates(['subject','expNum'])
+        expList = expList[expList.expNum.isin(expNum)]
+        subject_order = pd.Series(np.arange(len(mouse2checkList)),index=mouse2checkList.values)
+        expList = expList.assign(subject_order=expList.subject.map(subject_order).values)
+        expList = expList.sort_values(['subject_order','expNum'],kind='mergesort').drop(columns='subject_order')
+
+    exp2checkList = expList.reset_index(drop=True)
+
+    if len(exp2checkList)==0:
+        # empty, with the csv columns
         print('you did not call any experiments.')
-        exp2checkList = None
+        return exp2checkList
     
-    if len(exp2checkList)>0:
-        if checkIsSortedPyKS is not None:
-            # nan means we should not have ephys. So we drop nan columns
-            exp2checkList = exp2checkList[exp2checkList['issortedPyKS'].notna()]
-            to_keep_column = np.array([checkIsSortedPyKS in rec.issortedPyKS for _,rec in exp2checkList.iterrows()])
-            exp2checkList = exp2checkList[to_keep_column]
-        
-        if checkEvents is not None:
-            exp2checkList = exp2checkList[exp2checkList['extractEvents'].notna()]
-            to_keep_column = np.array([checkEvents in rec.extractEvents for _,rec in exp2checkList.iterrows()])
-            exp2checkList = exp2checkList[to_keep_column]
-
-        if checkSpikes is not None:
-            exp2checkList = exp2checkList[exp2checkList['extractSpikes'].notna()]
-            to_keep_column = np.array([checkSpikes in rec.extractSpikes for _,rec in exp2checkList.iterrows()])
-            exp2checkList = exp2checkList[to_keep_column]
+    if checkIsSortedPyKS is not None:
+        # nan means we should not have ephys. So we drop nan columns
+        exp2checkList = exp2checkList[check_string_column(exp2checkList,'issortedPyKS',checkIsSortedPyKS)]
+    
+    if checkEvents is not None:
+        exp2checkList = exp2checkList[check_string_column(exp2checkList,'extractEvents',checkEvents)]
 
-        if checkFrontCam is not None: 
-            exp2checkList = exp2checkList[exp2checkList['alignFrontCam'].notna() & exp2checkList['fMapFrontCam'].notna()]
-            to_keep_column = np.array([(checkFrontCam in rec.alignFrontCam) & (checkFrontCam in rec.fMapFrontCam) for _,rec in exp2checkList.iterrows()])
-            exp2checkList = exp2checkList[to_keep_column]        
+    if checkSpikes is not None:
+        exp2checkList = exp2checkList[check_string_column(exp2checkList,'extractSpikes',checkSpikes)]
 
+    if checkFrontCam is not None: 
+        exp2checkList = exp2checkList[check_string_column(exp2checkList,'alignFrontCam',checkFrontCam) & 
+                                      check_string_column(exp2checkList,'fMapFrontCam',checkFrontCam)]
 
-    return exp2checkList
+    return exp2checkList.copy()
 
 class Bunch(dict):
     """ taken from iblutil
@@ -439,7 +475,7 @@ class Bunch(dict):
         return Bunch(np.load(npz_file))
 
 
-def load_ONE_object(collection_folder,object,attributes='all'): 
+def load_ONE_object(collection_folder,object,attributes='all',cache=None,mmap=False): 
     """
     function that loads any ONE object with npy extension
     ONE object = clollection_folder/object.attribute.expIDtag.extension 
@@ -453,6 +489,13 @@ def load_ONE_object(collection_folder,object,attributes='all'):
     attributes: str/list
         if str: 'all': all attributes for the object 
         if list: list of strings with specified attributes 
+            names that are not an attribute of the object are treated as columns of its parquet table(s), 
+            and only those columns are read (e.g. ['timeline_choiceMoveOn','is_blankTrial'] for _av_trials)
+    cache: None/Admin.helpers.one_cache.ONECache
+        if given, the object is read from the local cache unless the files changed on the server
+    mmap: bool
+        whether to memory-map the .npy files (copy-on-write) instead of reading them, 
+        such that data is only read from disk once it is actually used 
     
     Returns: 
     ---------
@@ -460,6 +503,9 @@ def load_ONE_object(collection_folder,object,attributes='all'):
         of  object.attribute
 
     """
+    mmap_mode = 'c' if mmap else None
+    if cache is not None:
+        return Bunch(cache.load(collection_folder,object,attributes,load_ONE_object,mmap_mode=mmap_mode))
 
     file_names = list(collection_folder.glob('%s.*' % object))
     object_names = [re.split(r"\.",file.name)[0] for file in file_names]
@@ -469,13 +515,19 @@ def load_ONE_object(collection_folder,object,attributes='all'):
     if 'all' in attributes: 
         attributes=attribute_names
 
+    # requested columns of the parquet tables
+    if isinstance(attributes,list):
+        columns = [c for c in attributes if c not in attribute_names]
+    else: 
+        columns = []
+
     output = {}
 
     for f,o,a,e in zip(file_names,object_names,attribute_names,extensions):        
         # normally don't load any large data with this loader 
             if 'npy' in e: 
                 if a in attributes: 
-                    tempload = np.load(f)
+                    tempload = np.load(f,mmap_mode=mmap_mode)
                     if (tempload.ndim==2):
                         if (tempload.shape[1]==1): #if its the stupid matlab format, ravel
                             output[a] = tempload[:,0]
@@ -485,8 +537,13 @@ def load_ONE_object(collection_folder,object,attributes='all'):
                         output[a] = tempload
 
             elif 'pqt' in e: 
-                if a in attributes:  # now I just not load the largeData
-                    tempload = pd.read_parquet(f)
+                if (a in attributes) or (len(columns)>0):  # now I just not load the largeData
+                    if a in attributes: 
+                        tempload = pd.read_parquet(f)
+                    else:
+                        from pyarrow.parquet import read_schema
+                        table_columns = [c for c in columns if c in read_schema(f).names]
+                        tempload = pd.read_parquet(f,columns=table_columns)
                     tempload = tempload.to_dict('list')
 
                     for k in tempload.keys():
@@ -503,13 +560,62 @@ def load_ONE_object(collection_folder,object,attributes='all'):
 
     return output
 
+def load_collection(exp_folder,collection,object_dict,cache=None,mmap=False):
+    """
+    loads the requested ONE objects of a single collection of an experiment
+
+    Parameters
+    ----------
+    exp_folder: pathlib.Path
+    collection: str
+        collection name, e.g. 'events','probe0' or 'probe0_raw' for the raw ibl_format folder
+    object_dict: dict
+        {object:attributes} as passed to load_ONE_object
+    cache: None/Admin.helpers.one_cache.ONECache
+    mmap: bool
+        whether to memory-map the .npy files (see load_ONE_object)
+
+    Returns: 
+    ---------
+    Bunch
+        of objects
+    dict
+        time (s) it took to load each object
+    """
+    if 'raw' in collection and 'probe' in collection:
+        probe_name = re.findall('probe\d',collection)[0]
+        probe_collection_folder = exp_folder / 'ONE_preproc' / probe_name
+        raw_path = list((probe_collection_folder).glob('_av_rawephys.path.*.json'))
+        if len(raw_path)==1:
+            # then a matching ephys file is found
+            ev_collection_folder = open(raw_path[0],)
+            ev_collection_folder = json.load(ev_collection_folder)
+            ev_collection_folder = Path(ev_collection_folder)
+        else: 
+            ev_collection_folder = probe_collection_folder                
+    else:
+        ev_collection_folder = exp_folder / 'ONE_preproc' / collection
+    
+    objects,latencies = {},{}
+    for object in object_dict:
+        t0 = time.time()
+        objects[object] = load_ONE_object(ev_collection_folder,object,attributes=object_dict[object],cache=cache,mmap=mmap)
+        latencies[object] = time.time()-t0
+    objects = Bunch(objects)
+
+    return objects,latencies
+
 def load_data(recordings=None,
               data_name_dict=None,
               unwrap_probes=False,
               merge_probes=False,
               region_selection=None,
               filter_unique_shank_positions = False,
-              cam_hierarchy=None,**kwargs):
+              cam_hierarchy=None,
+              cache=None,
+              n_threads=1,
+              report_latency=False,
+              mmap=False,**kwargs):
     """
     Paramters: 
     -------------
@@ -536,6 +642,15 @@ def load_data(recordings=None,
     merge_probes: bool
         returns a exp2checkList with a single column of ehys data, where data from both probes are merged into a single Bunch of clusters and spikes
         where clusterIDs from the 2nd probe get 10k added to them
+    cache: None/bool/Admin.helpers.one_cache.ONECache
+        local on-disk cache of the loaded ONE objects, invalidated when the files on the server change
+        if True, the default cache (~/.pinkrigs_cache/ONE) is used
+    n_threads: int
+        number of threads the collections of each recording are loaded with (network bound, so can be >> n cores)
+    report_latency: bool
+        whether to print how long loading each object took
+    mmap: bool
+        whether to memory-map the .npy files, such that e.g. {'spikes':'all','clusters':'all'} is only read once used
 
     Returns: 
     -------------
@@ -550,34 +665,49 @@ def load_data(recordings=None,
     else:
         recordings = recordings[['subject','expDate','expDef','expFolder']]
 
+    if cache is True:
+        from Admin.helpers.one_cache import ONECache
+        cache = ONECache()
+    elif cache is False:
+        cache = None
+
     if data_name_dict:
 
         collections = list(data_name_dict.keys())
+        tasks,collection_objects = [],{}
         for collection in collections: 
             recordings[collection]=None
             for idx,rec in recordings.iterrows():
                 # to do -- make it dependent on whether the extraction was done correctly 
-
-                exp_folder = Path(rec.expFolder)
-                if 'raw' in collection and 'probe' in collection:
-                    probe_name = re.findall('probe\d',collection)[0]
-                    probe_collection_folder = exp_folder / 'ONE_preproc' / probe_name
-                    raw_path = list((probe_collection_folder).glob('_av_rawephys.path.*.json'))
-                    if len(raw_path)==1:
-                        # then a matching ephys file is found
-                        ev_collection_folder = open(raw_path[0],)
-                        ev_collection_folder = json.load(ev_collection_folder)
-                        ev_collection_folder = Path(ev_collection_folder)
-                    else: 
-                        ev_collection_folder = probe_collection_folder                
-                else:
-                    ev_collection_folder = exp_folder / 'ONE_preproc' / collection
-                
-                objects = {}
+                collection_objects[(idx,collection)] = Bunch()
                 for object in data_name_dict[collection]:
-                    objects[object] = load_ONE_object(ev_collection_folder,object,attributes=data_name_dict[collection][object])
-                objects = Bunch(objects)
-                recordings.loc[idx][collection] = objects
+                    tasks.append((idx,collection,object,Path(rec.expFolder)))
+
+        # each object is loaded as a separate task
+        def load_task(task):
+            idx,collection,object,exp_folder = task
+            return load_collection(exp_folder,collection,{object:data_name_dict[collection][object]},cache=cache,mmap=mmap)
+
+        if n_threads==1:
+            loaded = [load_task(t) for t in tasks]
+        else:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                loaded = list(executor.map(load_task,tasks))
+
+        latencies = []
+        for (idx,collection,object,exp_folder),(objects,object_latencies) in zip(tasks,loaded):
+            collection_objects[(idx,collection)].update(objects)
+            latencies.append((exp_folder,collection,object,object_latencies[object]))
+
+        for (idx,collection),objects in collection_objects.items():
+            recordings.loc[idx][collection] = objects
+
+        if report_latency:
+            for exp_folder,collection,object,t in latencies:
+                print('%s %s/%s: %.2f s' % (exp_folder,collection,object,t))
+            t = np.array([l[-1] for l in latencies])
+            if t.size>0:
+                print('loaded %d objects, median %.2f s, max %.2f s per object.' % (t.size,np.median(t),np.max(t)))
 
 
     ### ####### deling with extra arguments that further format the data ######
@@ -777,8 +907,8 @@ def format_cluster_data(clusters):
     if 'phy_clusterID' not in colnames:
         clusInfo['phy_clusterID'] = clusInfo.cluster_id
 
-    from Processing.pyhist.helpers.regions import BrainRegions
-    br = BrainRegions()
+    from Processing.pyhist.helpers.regions import get_brain_regions
+    br = get_brain_regions()
     bc_class = bombcell_sort_units(clusInfo)
     clusInfo['bombcell_class'] = bc_class
     clusInfo['is_good'] = bc_class=='good'
@@ -1,17 +1,231 @@
 import numpy as np
-from mtscomp import compress
+from mtscomp import Writer, Reader, cumsum_along_axis
 import re
+import zlib
 import os
 import sys
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-def mainCompress(binFile=''):
+# these also run as scripts (called from matlab), so make PinkRigs importable
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+def get_manifest_path(cbinFile):
+    # x.ap.cbin -> x.ap.manifest.json
+    return Path(cbinFile).with_suffix('.manifest.json')
+
+def read_recording_params(binFile):
+    """
+    sample rate and number of channels of a SpikeGLX .bin file, read from its .meta file
+    if there is no .meta file, we fall back to the 3B/1.0 defaults (30 kHz, 385 channels)
+    """
+    from Processing.pykilo.ReadSGLXData.readSGLX import readMeta, SampRate
+    meta = readMeta(Path(binFile))
+    if len(meta)>0:
+        sample_rate,n_channels = SampRate(meta),int(meta['nSavedChans'])
+    else:
+        print('%s: no meta file, assuming 30 kHz and 385 channels.' % binFile)
+        sample_rate,n_channels = 30000.,385
+
+    return sample_rate,n_channels
+
+def _md5(buffer):
+    return hashlib.md5(buffer).hexdigest()
+
+def _read_bytes(path,start,length):
+    with open(path,'rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+class ManifestWriter(Writer):
+    """
+    mtscomp Writer that computes the per-chunk checksums of the raw and the compressed data
+    from the buffers it compresses (on the compression threads), such that the .bin is only read once.
+
+    Parameters:
+    -----------
+    check_chunks: bool
+        whether each compressed chunk is also decompressed in memory and compared to the raw chunk
+    kwargs:
+        of mtscomp.Writer
+    """
+    def __init__(self,check_chunks=False,**kwargs):
+        super().__init__(**kwargs)
+        self.check_chunks = check_chunks
+        self.chunk_md5 = {}
+
+    def _decompress(self,chunkdc,shape):
+        chunkd = np.frombuffer(zlib.decompress(chunkdc),dtype=self.dtype).reshape(shape,order=self.chunk_order)
+        chunk = cumsum_along_axis(chunkd,axis=1 if self.do_spatial_diff else None)
+        return cumsum_along_axis(chunk,axis=0 if self.do_time_diff else None)
+
+    def _compress_chunk(self,chunk_idx):
+        chunk_idx,(chunk,chunkdc) = super()._compress_chunk(chunk_idx)
+        chunk = np.ascontiguousarray(chunk)
+        if self.check_chunks and not np.array_equal(self._decompress(chunkdc,chunk.shape),chunk):
+            raise IOError('chunk %d of %s does not match after compression.' % (chunk_idx,self.data_path))
+        self.chunk_md5[chunk_idx] = [_md5(chunk),_md5(chunkdc)]
+        return chunk_idx,(chunk,chunkdc)
+
+def write_manifest(binFile,cbinFile,chFile,n_threads=1,chunk_md5=None):
+    """
+    writes the per-chunk checksums of the raw (.bin) and the compressed (.cbin) data
+
+    Parameters:
+    -----------
+    binFile,cbinFile,chFile: str/pathlib.Path
+    n_threads: int
+        number of threads the chunks are hashed on
+    chunk_md5: None/dict
+        {chunk index:[raw md5,cbin md5]} computed during compression (ManifestWriter.chunk_md5).
+        If None, the chunks are read from binFile and cbinFile and hashed.
+
+    Returns:
+    --------
+        : pathlib.Path
+        path to the manifest
+    """
+    with open(chFile) as f:
+        cmeta = json.load(f)
+    chunk_bytes = cmeta['n_channels']*np.dtype(cmeta['dtype']).itemsize
+    bounds,offsets = cmeta['chunk_bounds'],cmeta['chunk_offsets']
+
+    def hash_chunk(i):
+        raw = _read_bytes(binFile,bounds[i]*chunk_bytes,(bounds[i+1]-bounds[i])*chunk_bytes)
+        comp = _read_bytes(cbinFile,offsets[i],offsets[i+1]-offsets[i])
+        return [_md5(raw),_md5(comp)]
+
+    if chunk_md5 is not None:
+        hashes = [chunk_md5[i] for i in range(len(bounds)-1)]
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            hashes = list(executor.map(hash_chunk,range(len(bounds)-1)))
+
+    manifest = {
+        'bin_file':Path(binFile).name,
+        'bin_size':os.path.getsize(binFile),
+        'chunk_bounds':bounds,
+        'chunk_offsets':offsets,
+        'raw_md5':[h[0] for h in hashes],
+        'cbin_md5':[h[1] for h in hashes]
+    }
+    manifest_path = get_manifest_path(cbinFile)
+    with open(manifest_path,'w') as f:
+        json.dump(manifest,f)
+
+    return manifest_path
+
+def verify_compressed(cbinFile,chFile=None,decompress=False,n_threads=1):
+    """
+    checks a .cbin file against its manifest, chunk by chunk, stopping at the first mismatch.
+
+    Parameters:
+    -----------
+    cbinFile: str/pathlib.Path
+    chFile: str/pathlib.Path
+        only used when decompress. Default: .ch file next to cbinFile
+    decompress: bool
+        if False, the checksums of the compressed chunks are compared (e.g. after copying the data),
+        if True, each chunk is decompressed and compared to the checksum of the raw data
+    n_threads: int
+
+    Returns:
+    --------
+        : bool
+        whether all chunks match
+    """
+    with open(get_manifest_path(cbinFile)) as f:
+        manifest = json.load(f)
+    offsets = manifest['chunk_offsets']
+    n_chunks = len(offsets)-1
+
+    if decompress:
+        r = Reader(check_after_decompress=False)
+        r.open(cbinFile,chFile)
+        def check_chunk(i):
+            chunk = r.read_chunk(i,offsets[i],offsets[i+1]-offsets[i])
+            return _md5(chunk.tobytes())==manifest['raw_md5'][i]
+    else:
+        def check_chunk(i):
+            return _md5(_read_bytes(cbinFile,offsets[i],offsets[i+1]-offsets[i]))==manifest['cbin_md5'][i]
+
+    is_ok = True
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        # in batches, such that we stop early on a corrupted file
+        for batch_start in range(0,n_chunks,n_threads*4):
+            batch = range(batch_start,min(batch_start+n_threads*4,n_chunks))
+            if not all(executor.map(check_chunk,batch)):
+                is_ok = False
+                break
+
+    if decompress:
+        r.close()
+
+    return is_ok
+
+def mainCompress(binFile='',n_threads=None,check_after_compress=True):
     # Compress a .bin file into a pair .cbin (compressed binary file) and .ch (JSON file).
+    # the sample rate and channel number are read from the .meta file, and a manifest with per-chunk checksums is written.
+    # The checksums are computed from the chunks while they are compressed, so the .bin is read once.
+    # check_after_compress: True compares the written .cbin to the compressed chunk checksums (reads the .cbin once),
+    # 'decompress' also decompresses each chunk in memory right after compression and compares it to the raw chunk.
     cbinFile = re.sub('ap.bin','ap.cbin',binFile)
     chFile = re.sub('ap.bin','ap.ch',binFile)
+    if n_threads is None:
+        n_threads = os.cpu_count()
 
     if not os.path.exists(cbinFile) and not os.path.exists(chFile):
-        compress(binFile, cbinFile, chFile, sample_rate=30000., n_channels=385, 
-                 dtype=np.int16, check_after_compress=True)
+        sample_rate,n_channels = read_recording_params(binFile)
+        w = ManifestWriter(check_chunks=(check_after_compress=='decompress'),
+                           n_threads=n_threads,check_after_compress=False)
+        w.open(binFile,sample_rate=sample_rate,n_channels=n_channels,dtype=np.int16)
+        w.write(cbinFile,chFile)
+        w.close()
+        write_manifest(binFile,cbinFile,chFile,n_threads=n_threads,chunk_md5=w.chunk_md5)
+
+        if check_after_compress:
+            if not verify_compressed(cbinFile,n_threads=n_threads):
+                raise IOError('%s does not match its manifest after compression.' % cbinFile)
+
+    return cbinFile
+
+def _compress_or_report(binFile,n_threads,check_after_compress):
+    try:
+        return mainCompress(binFile=binFile,n_threads=n_threads,check_after_compress=check_after_compress)
+    except Exception as e:
+        print('%s could not be compressed: %s' % (binFile,e))
+        return None
+
+def compress_recordings(binFiles,n_processes=4,n_threads=None,check_after_compress=True):
+    """
+    compresses many .bin files concurrently, n_processes files at a time, each with n_threads (mtscomp chunk threads)
+
+    Parameters:
+    -----------
+    binFiles: list of str/pathlib.Path
+    n_processes: int
+    n_threads: None/int
+        if None, the cpus are split between processes
+
+    Returns:
+    --------
+        : list
+        cbin file for each binFile, None where compression failed
+    """
+    binFiles = [str(b) for b in binFiles]
+    if n_threads is None:
+        n_threads = max(os.cpu_count()//n_processes,1)
+
+    if n_processes==1:
+        return [_compress_or_report(b,n_threads,check_after_compress) for b in binFiles]
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        cbinFiles = list(executor.map(_compress_or_report,binFiles,
+                                      [n_threads]*len(binFiles),[check_after_compress]*len(binFiles)))
+
+    return cbinFiles
 
 if __name__ == "__main__":
    mainCompress(binFile=sys.argv[1])
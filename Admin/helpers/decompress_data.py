@@ -8,10 +8,45 @@ from mtscomp import Reader
 import re
 import os
 import sys
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# these also run as scripts (called from matlab), so make PinkRigs importable
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from Admin.helpers.compress_data import get_manifest_path, _md5, _read_bytes
+
+def verify_decompressed(binFile,cbinFile,n_threads=1):
+    """
+    compares the chunks of a decompressed .bin file to the raw checksums in the manifest of cbinFile
+    """
+    with open(get_manifest_path(cbinFile)) as f:
+        manifest = json.load(f)
+    bounds = manifest['chunk_bounds']
+    chunk_bytes = manifest['bin_size']//bounds[-1]
+
+    if os.path.getsize(binFile)!=manifest['bin_size']:
+        return False
+
+    def check_chunk(i):
+        raw = _read_bytes(binFile,bounds[i]*chunk_bytes,(bounds[i+1]-bounds[i])*chunk_bytes)
+        return _md5(raw)==manifest['raw_md5'][i]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        is_ok = all(executor.map(check_chunk,range(len(bounds)-1)))
+
+    return is_ok
+
+def mainDecompress(cbinFile='', chFile='',delete_compressed = False,n_threads=None):
+    # if the compression manifest exists, the output is checked against its checksums
+    # rather than with mtscomp's check (which decompresses everything a second time)
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    has_manifest = get_manifest_path(cbinFile).is_file()
 
-def mainDecompress(cbinFile='', chFile='',delete_compressed = False):
     # Define a reader to decompress a compressed array.
-    r = Reader()
+    r = Reader(n_threads=n_threads,check_after_decompress=not has_manifest)
     # Open the compressed dataset.
     binFile = re.sub('ap.cbin','ap.bin',cbinFile);
     r.open(cbinFile, chFile)
@@ -19,9 +54,43 @@ def mainDecompress(cbinFile='', chFile='',delete_compressed = False):
     r.tofile(binFile)
     r.close()
 
+    if has_manifest and not verify_decompressed(binFile,cbinFile,n_threads=n_threads):
+        raise IOError('%s does not match the manifest of %s.' % (binFile,cbinFile))
+
     if delete_compressed:
         os.remove(cbinFile)
         os.remove(chFile)
 
+    return binFile
+
+def _decompress_or_report(cbinFile,chFile,delete_compressed,n_threads):
+    try:
+        return mainDecompress(cbinFile=cbinFile,chFile=chFile,delete_compressed=delete_compressed,n_threads=n_threads)
+    except Exception as e:
+        print('%s could not be decompressed: %s' % (cbinFile,e))
+        return None
+
+def decompress_recordings(cbinFiles,chFiles,delete_compressed=False,n_processes=4,n_threads=None):
+    """
+    decompresses many .cbin files concurrently, n_processes files at a time, each with n_threads
+
+    Returns:
+    --------
+        : list
+        bin file for each cbinFile, None where decompression failed
+    """
+    cbinFiles,chFiles = [str(c) for c in cbinFiles],[str(c) for c in chFiles]
+    if n_threads is None:
+        n_threads = max(os.cpu_count()//n_processes,1)
+    n = len(cbinFiles)
+
+    if n_processes==1:
+        return [_decompress_or_report(c,ch,delete_compressed,n_threads) for c,ch in zip(cbinFiles,chFiles)]
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        binFiles = list(executor.map(_decompress_or_report,cbinFiles,chFiles,[delete_compressed]*n,[n_threads]*n))
+
+    return binFiles
+
 if __name__ == "__main__":
-   mainDecompress(cbinFile=sys.argv[1],chFile=sys.argv[2])
\ No newline at end of file
+   mainDecompress(cbinFile=sys.argv[1],chFile=sys.argv[2])
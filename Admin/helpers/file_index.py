@@ -0,0 +1,258 @@
+"""
+persistent index of the files on a server (path, size, mtime), to replace recursive globs over the network
+
+The index holds the listing of each folder below the server root, saved as a json file
+(~/.pinkrigs_cache/file_index). A refresh stats each folder and only lists again the folders whose
+mtime has changed (i.e. files/folders were added, removed or renamed in them), so after the first scan
+a refresh costs one stat per folder rather than a full listing, and queries do not touch the network.
+
+Files rewritten in place do not change the mtime of their folder, so their size/mtime is the one of the
+last listing of the folder. Empty files (e.g. still being written when listed) are stat'ed again on refresh.
+
+"""
+import json,hashlib,os,re,tempfile
+from pathlib import Path
+
+from Admin.helpers.one_cache import get_default_cache_dir
+
+# file indices already loaded in this session, {server root:FileIndex}
+_file_indices = {}
+
+
+def get_default_index_dir():
+    return get_default_cache_dir().parent / 'file_index'
+
+
+def _to_posix(path):
+    return str(path).replace('\\','/').rstrip('/')
+
+
+def pattern_to_regex(pattern,ignore_case=False):
+    """
+    translate a glob pattern ('/' separated, with recursive **) to a compiled regular expression
+
+    Parameters:
+    -----------
+    pattern: str
+    ignore_case: bool
+
+    Returns:
+    --------
+    : re.Pattern
+    """
+    parts = pattern.split('/')
+    regex = ''
+    for i,part in enumerate(parts):
+        is_last = i==len(parts)-1
+        if part=='**':
+            # any number of folders, including none
+            regex += '.*' if is_last else '(?:[^/]+/)*'
+            continue
+        for c in part:
+            if c=='*':
+                regex += '[^/]*'
+            elif c=='?':
+                regex += '[^/]'
+            else:
+                regex += re.escape(c)
+        if not is_last:
+            regex += '/'
+
+    return re.compile(regex+r'\Z',flags=re.IGNORECASE if ignore_case else 0)
+
+
+class FileIndex():
+    """
+    incrementally updated listing of the files below a server root
+
+    Parameters:
+    -----------
+    root: pathlib.Path/str
+        e.g. \\\\zinu.cortexlab.net\\Subjects
+    index_path: None/pathlib.Path
+        json file the index is saved to. If None, ~/.pinkrigs_cache/file_index/<hash of root>.json
+    """
+    def __init__(self,root,index_path=None):
+        self.root = Path(root)
+        if index_path is None:
+            index_path = get_default_index_dir() / ('%s.json' % hashlib.sha1(_to_posix(root).lower().encode()).hexdigest())
+        self.index_path = Path(index_path)
+        self.ignore_case = os.name=='nt'
+        # {folder relative to root ('/' separated):{'mtime':mtime_ns,'dirs':[names],'files':{name:[size,mtime_ns]}}}
+        self.folders = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                self.folders = json.load(f)['folders']
+        except (FileNotFoundError,ValueError,KeyError):
+            self.folders = {}
+
+    def save(self):
+        self.index_path.parent.mkdir(parents=True,exist_ok=True)
+        fd,tmp_path = tempfile.mkstemp(dir=self.index_path.parent,prefix='.tmp_')
+        with os.fdopen(fd,'w') as f:
+            json.dump({'root':str(self.root),'folders':self.folders},f)
+        os.replace(tmp_path,self.index_path)
+
+    def _rel(self,path):
+        """
+        path (absolute, or relative to root) -> '/' separated path relative to root
+        """
+        path,root = _to_posix(path),_to_posix(self.root)
+        prefix = root+'/'
+        if self.ignore_case:
+            is_abs = path.lower().startswith(prefix.lower()) or path.lower()==root.lower()
+        else:
+            is_abs = path.startswith(prefix) or path==root
+        if is_abs:
+            path = path[len(prefix):]
+        return path.strip('/')
+
+    def _path(self,rel):
+        return self.root / rel if rel else self.root
+
+    def _remove_folder(self,rel):
+        for k in [k for k in self.folders if k==rel or k.startswith(rel+'/')]:
+            del self.folders[k]
+
+    def _list_folder(self,rel,mtime):
+        dirs,files = [],{}
+        with os.scandir(self._path(rel)) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    else:
+                        st = entry.stat()
+                        files[entry.name] = [st.st_size,st.st_mtime_ns]
+                except OSError:
+                    # removed while listing
+                    continue
+        return {'mtime':mtime,'dirs':sorted(dirs),'files':files}
+
+    def refresh(self,subfolder=''):
+        """
+        update the index below subfolder, listing again only the folders that have changed
+
+        Parameters:
+        -----------
+        subfolder: str/pathlib.Path
+            absolute, or relative to root (e.g. r'AV049\\2023-05-12\\ephys'). Default: the whole server.
+
+        Returns:
+        --------
+        : int
+            number of folders that were listed
+        """
+        n_listed,is_changed = 0,False
+        to_check = [self._rel(subfolder)]
+        while to_check:
+            rel = to_check.pop()
+            try:
+                mtime = os.stat(self._path(rel)).st_mtime_ns
+            except OSError:
+                if any(k==rel or k.startswith(rel+'/') for k in self.folders):
+                    self._remove_folder(rel)
+                    is_changed = True
+                continue
+
+            folder = self.folders.get(rel)
+            if (folder is None) or (folder['mtime']!=mtime):
+                try:
+                    new_folder = self._list_folder(rel,mtime)
+                except OSError as e:
+                    print('%s could not be listed: %s' % (self._path(rel),e))
+                    continue
+                if folder is not None:
+                    for d in set(folder['dirs'])-set(new_folder['dirs']):
+                        self._remove_folder('%s/%s' % (rel,d) if rel else d)
+                folder = self.folders[rel] = new_folder
+                n_listed += 1
+                is_changed = True
+            else:
+                for name,(size,_) in folder['files'].items():
+                    if size==0:
+                        try:
+                            st = os.stat(self._path(rel) / name)
+                        except OSError:
+                            continue
+                        if st.st_size>0:
+                            folder['files'][name] = [st.st_size,st.st_mtime_ns]
+                            is_changed = True
+
+            to_check.extend(['%s/%s' % (rel,d) if rel else d for d in folder['dirs']])
+
+        if is_changed:
+            self.save()
+
+        return n_listed
+
+    def find(self,pattern):
+        """
+        indexed files matching a glob pattern
+
+        Parameters:
+        -----------
+        pattern: str
+            absolute, or relative to root, with * ? and recursive ** (as glob.glob(pattern,recursive=True))
+
+        Returns:
+        --------
+        : list
+            (path,size,mtime_ns) of each match, sorted by path
+        """
+        rel_pattern = self._rel(pattern)
+        regex = pattern_to_regex(rel_pattern,ignore_case=self.ignore_case)
+        # only the folders below the part of the pattern without wildcards can match
+        literal = []
+        for part in rel_pattern.split('/')[:-1]:
+            if ('*' in part) or ('?' in part):
+                break
+            literal.append(part)
+        literal = '/'.join(literal)
+        if self.ignore_case:
+            literal = literal.lower()
+
+        matches = []
+        for rel,folder in self.folders.items():
+            key = rel.lower() if self.ignore_case else rel
+            if literal and not (key==literal or key.startswith(literal+'/')):
+                continue
+            for name,(size,mtime) in folder['files'].items():
+                rel_file = '%s/%s' % (rel,name) if rel else name
+                if regex.match(rel_file):
+                    matches.append((str(self._path(rel_file)),size,mtime))
+
+        return sorted(matches)
+
+    def glob(self,pattern):
+        """
+        as glob.glob(pattern,recursive=True), on the index
+
+        Returns:
+        --------
+        : list
+            paths (str) of the matching files
+        """
+        return [m[0] for m in self.find(pattern)]
+
+
+def get_file_index(server):
+    """
+    file index of a server, loaded once per session
+
+    Parameters:
+    -----------
+    server: pathlib.Path/str
+        root of the index, e.g. one of csv_queryExp.get_server_list()
+
+    Returns:
+    --------
+    FileIndex
+    """
+    key = _to_posix(server).lower()
+    if key not in _file_indices:
+        _file_indices[key] = FileIndex(server)
+    return _file_indices[key]
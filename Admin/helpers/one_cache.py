@@ -0,0 +1,193 @@
+"""
+local on-disk cache for ONE objects loaded from the servers (see csv_queryExp.load_ONE_object)
+
+Each cached entry is a folder named by the hash of collection folder, object and attributes.
+It contains one .npy per attribute and a meta.json holding the signature (name,size,mtime)
+of the source files on the server, such that the entry is reloaded whenever the server files change.
+The cache is kept below max_size_GB by evicting the least recently used entries.
+
+"""
+import json,hashlib,os,shutil,tempfile
+import numpy as np
+from pathlib import Path
+
+
+def get_default_cache_dir():
+    return Path.home() / '.pinkrigs_cache' / 'ONE'
+
+
+def get_source_signature(file_names):
+    """
+    size and modification time of each file that makes up a ONE object
+
+    Parameters:
+    -----------
+    file_names: list of pathlib.Path
+
+    Returns:
+    --------
+    : list
+        [name,size,mtime_ns] for each file, sorted by name
+    """
+    signature = []
+    for f in file_names:
+        st = os.stat(f)
+        signature.append([f.name,st.st_size,st.st_mtime_ns])
+    signature.sort()
+    return signature
+
+
+class ONECache():
+    """
+    LRU cache of ONE objects on the local disk
+
+    Parameters:
+    -----------
+    cache_dir: pathlib.Path/str/None
+        where the cache lives. If None, ~/.pinkrigs_cache/ONE
+    max_size_GB: float
+        total size the cache can take up before the least recently used entries are removed
+    validate: bool
+        whether to check the source files on the server (glob+stat, no data read) before using an entry.
+        If False, any existing entry is used without touching the network.
+    """
+    def __init__(self,cache_dir=None,max_size_GB=20,validate=True):
+        if cache_dir is None:
+            cache_dir = get_default_cache_dir()
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True,exist_ok=True)
+        self.max_size = max_size_GB*1024**3
+        self.validate = validate
+
+    def get_entry_path(self,collection_folder,object,attributes):
+        key = json.dumps([str(collection_folder),object,attributes])
+        return self.cache_dir / hashlib.sha1(key.encode()).hexdigest()
+
+    def read(self,entry_path,signature=None,mmap_mode=None):
+        """
+        read the cached Bunch content as a dict. Returns None when missing or stale.
+        """
+        meta_path = entry_path / 'meta.json'
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (FileNotFoundError,ValueError):
+            return None
+
+        if (signature is not None) and (meta['signature']!=signature):
+            return None
+
+        output = {}
+        try:
+            for k,kind in meta['attributes']:
+                if kind=='path':
+                    output[k] = Path(meta['paths'][k])
+                elif kind=='object':
+                    output[k] = np.load(entry_path / ('%s.npy' % k),allow_pickle=True)
+                else:
+                    output[k] = np.load(entry_path / ('%s.npy' % k),mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            return None
+
+        # mark as recently used
+        os.utime(meta_path)
+
+        return output
+
+    def write(self,entry_path,output,signature):
+        """
+        write the loaded dict to the cache, replacing the former version of the entry
+        """
+        tmp_path = Path(tempfile.mkdtemp(dir=self.cache_dir,prefix='.tmp_'))
+        attributes,paths = [],{}
+        size = 0
+        for k,v in output.items():
+            if isinstance(v,Path):
+                attributes.append([k,'path'])
+                paths[k] = str(v)
+            else:
+                v = np.asarray(v)
+                attributes.append([k,'object' if v.dtype==object else 'npy'])
+                np.save(tmp_path / ('%s.npy' % k),v,allow_pickle=(v.dtype==object))
+                size += v.nbytes
+
+        with open(tmp_path / 'meta.json','w') as f:
+            json.dump({'signature':signature,'attributes':attributes,'paths':paths,'size':size},f)
+
+        shutil.rmtree(entry_path,ignore_errors=True)
+        try:
+            os.replace(tmp_path,entry_path)
+        except OSError:
+            # another process wrote the same entry in the meantime
+            shutil.rmtree(tmp_path,ignore_errors=True)
+
+        self.evict()
+
+    def get_size(self):
+        """
+        Returns:
+        --------
+        : list
+            (last access time,size,entry_path) for each entry in the cache
+        """
+        entries = []
+        for meta_path in self.cache_dir.glob('*/meta.json'):
+            try:
+                with open(meta_path) as f:
+                    size = json.load(f)['size']
+                entries.append((os.stat(meta_path).st_mtime,size,meta_path.parent))
+            except (FileNotFoundError,ValueError):
+                continue
+        return entries
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache fits max_size
+        """
+        entries = sorted(self.get_size(),key=lambda e: e[0])
+        total_size = sum([e[1] for e in entries])
+        for _,size,entry_path in entries:
+            if total_size<=self.max_size:
+                break
+            shutil.rmtree(entry_path,ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        for entry_path in self.cache_dir.iterdir():
+            shutil.rmtree(entry_path,ignore_errors=True)
+
+    def load(self,collection_folder,object,attributes,loader,mmap_mode=None):
+        """
+        load ONE object from cache, or with loader if it is not cached/has changed on the server
+
+        Parameters:
+        -----------
+        collection_folder: pathlib.Path
+        object: str
+        attributes: str/list
+            as passed to load_ONE_object
+        loader: callable
+            loader(collection_folder,object,attributes) -> dict (e.g. load_ONE_object)
+        mmap_mode: None/str
+            passed to np.load when reading the cached arrays (object arrays are always read)
+
+        Returns:
+        --------
+        : dict
+        """
+        entry_path = self.get_entry_path(collection_folder,object,attributes)
+
+        if not self.validate:
+            output = self.read(entry_path,mmap_mode=mmap_mode)
+            if output is not None:
+                return output
+
+        signature = get_source_signature(list(Path(collection_folder).glob('%s.*' % object)))
+        output = self.read(entry_path,signature=signature,mmap_mode=mmap_mode)
+        if output is None:
+            output = loader(collection_folder,object,attributes)
+            # don't cache objects that are not on the server (yet)
+            if len(signature)>0:
+                self.write(entry_path,output,signature)
+
+        return output
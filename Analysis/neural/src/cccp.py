@@ -2,6 +2,7 @@ import sys
 import numpy as np
 import pandas as pd
 from scipy.stats import rankdata
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(0, r"C:\Users\Flora\Documents\Github\PinkRigs") 
 from Admin.csv_queryExp import load_ephys_independent_probes,simplify_recdat,Bunch
@@ -10,6 +11,40 @@ from Analysis.neural.utils.spike_dat import get_binned_rasters
 
 
 
+def get_shuffle_matrix(n_trials,nx,n_shuffles=20):
+    """
+    function to create the permutation sets of the Mann-Whitney U as a single selection matrix
+
+    Parameters:
+    n_trials: int
+        total number of trials (x and y)
+    nx: int
+        number of trials in x 
+    n_shuffles = n of permitation sets to create
+
+    Returns: 
+    : np.ndarray (n_shuffles+1 x n_trials)
+        1 where the trial belongs to x in that permutation set. The first row is the actual x.
+        Drawn from the global numpy random state in the same order as np.random.permutation calls.
+    """
+    shuffle_matrix = np.zeros((n_shuffles+1,n_trials))
+    shuffle_matrix[0,:nx] = 1 # add first row as the actual 
+    for s in range(n_shuffles):
+        shuffle_matrix[s+1,np.random.permutation(n_trials)[:nx]] = 1
+
+    return shuffle_matrix
+
+def _rank_sum_U(x_y,nx,shuffle_matrix):
+    """
+    rank x_y once and sum the ranks of every permutation set with one matrix product 
+    """
+    # rank for each nrn
+    t = rankdata(x_y,axis=0)
+    numer = (shuffle_matrix @ t.reshape(t.shape[0],-1)).reshape((shuffle_matrix.shape[0],)+t.shape[1:])
+    numer = numer - (nx*(nx+1)/2)
+
+    return numer
+
 def get_mann_whitneyU(x,y,n_shuffles=20):
     """
     function to calculate the mann-Whitney U(x) statistic for each unit
@@ -28,22 +63,12 @@ def get_mann_whitneyU(x,y,n_shuffles=20):
     x_y = np.concatenate((x,y),axis=0)
     nx = x.shape[0]
 
-    v_ = np.arange(x_y.shape[0])
-    shuffle_idxs = [np.random.permutation(v_)[:nx][np.newaxis,:] for s in range(n_shuffles)]
-    shuffle_idxs = np.concatenate(shuffle_idxs)
-    shuffle_idxs = np.concatenate((v_[:nx][np.newaxis,:],shuffle_idxs)) # add first row as the actual 
-    
-    # rank for each nrn
-    t = rankdata(x_y,axis=0)
-    t= t[shuffle_idxs]
+    shuffle_matrix = get_shuffle_matrix(x_y.shape[0],nx,n_shuffles=n_shuffles)
 
-    numer = t.sum(axis=1)
-    numer = numer - (nx*(nx+1)/2)
-
-    return numer
+    return _rank_sum_U(x_y,nx,shuffle_matrix)
 
 
-def combined_condition_U(spike_counts,trialChoice,trialConditions,n_shuffles=2000):
+def combined_condition_U(spike_counts,trialChoice,trialConditions,n_shuffles=2000,n_threads=1):
     """
     function to calculate te combined ranksum across conditions (i.e. cccp anaysis established by Steinmetz et al.)
 
@@ -56,6 +81,9 @@ def combined_condition_U(spike_counts,trialChoice,trialConditions,n_shuffles=200
     trialConditions: np.array 
         (int, trials): unique classes that define which condition the trial belongs to 
     n_shuffles: float (for cv)
+    n_threads: int
+        number of threads to compute the conditions on. 
+        The permutation sets are drawn beforehand in condition order, so results do not depend on it.
 
     Returns: 
     --------
@@ -69,18 +97,28 @@ def combined_condition_U(spike_counts,trialChoice,trialConditions,n_shuffles=200
 
     """
     uCond =np.unique(trialConditions)
-    nTotal = np.zeros(((n_shuffles+1,) + spike_counts.shape[1:]))
     dTotal = 0
+    cond_data = []
     for c in uCond: 
         inclT = trialConditions==c
         chA = trialChoice & inclT
         nA = chA.sum()
         chB = ~trialChoice & inclT
         nB = chB.sum()
-        uA = get_mann_whitneyU(spike_counts[chA],spike_counts[chB],n_shuffles=n_shuffles)
-        nTotal = nTotal+uA
+        x_y = np.concatenate((spike_counts[chA],spike_counts[chB]),axis=0)
+        cond_data.append((x_y,nA,get_shuffle_matrix(nA+nB,nA,n_shuffles=n_shuffles)))
         dTotal = dTotal+nA+nB
 
+    if n_threads==1:
+        uA = [_rank_sum_U(*d) for d in cond_data]
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            uA = list(executor.map(lambda d: _rank_sum_U(*d),cond_data))
+
+    nTotal = np.zeros(((n_shuffles+1,) + spike_counts.shape[1:]))
+    for u in uA:
+        nTotal = nTotal+u
+
     cp = nTotal/dTotal
     t = rankdata(cp,axis=0)
     p = t[0]/(n_shuffles+1)
@@ -126,12 +164,14 @@ class cccp():
             classify_choice_types=True)
         
     
-    def get_U(self,test_type='ccCP',t_on_key ='timeline_choiceMoveOn',which_dat='neural',t_before=0.2,t_after=0,t_bin=0.05):
+    def get_U(self,test_type='ccCP',t_on_key ='timeline_choiceMoveOn',which_dat='neural',t_before=0.2,t_after=0,t_bin=0.05,n_threads=1):
         """
         ccCP = combined condition choice probability
         ccVP = combined condition visual stimulus detction probability
         ccAP = combined condition auditory stimulus detection probability
 
+        n_threads: int
+            number of threads the trial conditions are computed on (see combined_condition_U)
 
 
 
@@ -212,7 +252,7 @@ class cccp():
             
 
 
-        u,p,u_  = combined_condition_U(raster,trialChoice=trialChoice,trialConditions=ev.newIDs,n_shuffles=2000)
+        u,p,u_  = combined_condition_U(raster,trialChoice=trialChoice,trialConditions=ev.newIDs,n_shuffles=2000,n_threads=n_threads)
         
         return u,p,u_,tscale
     
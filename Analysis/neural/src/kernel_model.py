@@ -3,11 +3,13 @@
 import numpy as np 
 import pandas as pd
 import collections,itertools
+from pathlib import Path
 
 
 # import PinkRig utilities 
 from Admin.csv_queryExp import load_ephys_independent_probes,simplify_recdat,Bunch
 from Analysis.neural.utils.spike_dat import bincount2D
+from Analysis.neural.utils.spike_counts import get_spike_counts
 from Analysis.pyutils.video_dat import digitise_motion_energy,get_move_raster
 from Analysis.pyutils.plotting import off_axes
 from Analysis.pyutils.ev_dat import parse_events
@@ -21,10 +23,12 @@ import sklearn.pipeline as sklpipe
 import sklearn.model_selection as sklselection
 import sklearn.dummy as skldummy
 from sklearn.base import clone
+from joblib import Parallel, delayed
 
 import scipy.linalg as slinalg
 import scipy.sparse as ssparse
 from scipy.stats import zscore,median_abs_deviation
+from scipy.stats import rankdata as sp_rankdata
 
 # for plotting default plots 
 import matplotlib.pyplot as plt 
@@ -36,7 +40,7 @@ from matplotlib.colors import LogNorm
 
 #make toeplitz matrix 
 def make_event_toeplitz(event_time_vector, event_bins,
-                        diag_value_vector=None,off_time_vector=None):
+                        diag_value_vector=None,off_time_vector=None,feat_mat_type='dense'):
     """
     Obtains feature matrix for doing regression.
     INPUT
@@ -53,29 +57,23 @@ def make_event_toeplitz(event_time_vector, event_bins,
 
     off_time_vector : (numpy ndarray),optional
         number of indices between onsets determined by event_time_vector
+    feat_mat_type : (str)
+        'dense' : numpy ndarray
+        'sparse' : scipy.sparse csr matrix, which only stores the filled diagonals
 
     OUTPUT
     ----------
-    full_event_toeplitz : (numpy ndarray)
+    full_event_toeplitz : (numpy ndarray or scipy.sparse.csr_matrix)
 
     might change the way diag_value vector gets inputted
     """
 
+    # rather than filling the diagonals event by event, we compute the (row,column) 
+    # position of every filled element at once. Column n_pre-1 corresponds to the onset of the event.
+    n_rows = len(event_time_vector)
+    n_pre = len(np.where(event_bins <= 0)[0])
+    n_post = len(np.where(event_bins >= 0)[0])
 
-    # this implementation is far more memory efficient than using toeplitz
-    # since it does not have to make a square (useful for tall matrices)
-
-    # the underlying logic is the same; we still need to make two matrices
-    # actually there is no need if I can infer the first vector
-    # I guess that can be done by some form of sliding...
-    # but then I also need to know the first row... so overall seems
-    # complicated...
-
-    event_bin_mid_point = np.where(event_bins == 0)[0]
-    post_event_toeplitz = np.zeros(shape=(len(event_time_vector),
-                                            len(np.where(event_bins >= 0)[0])
-                                            ))
-    # we include the midpoint in the post-event toeplitz
     event_time_indices = np.where(event_time_vector == 1)[0]
 
     if diag_value_vector is None:
@@ -88,32 +86,23 @@ def make_event_toeplitz(event_time_vector, event_bins,
     if off_time_vector is None: 
         offset_indices = (np.ones(event_time_indices.size)*max(event_bins)).astype('int')
     else: 
-        offset_indices = off_time_vector
-        offset_indices[offset_indices>max(event_bins)] = max(event_bins)
-
-    
-    # Still requires for loop... which annoys me.
-    for diag_index, offset_index, diag_value in zip(event_time_indices, offset_indices, diag_value_vector):
-        np.fill_diagonal(post_event_toeplitz[diag_index:, :(offset_index+1)], diag_value) # easiest is to make variable indices by introducing an offset bin here so  np.fill_diagonal(post_event_toeplitz[diag_index:, :offsetIdx],1)
+        offset_indices = np.minimum(off_time_vector,max(event_bins))
 
-    pre_event_toeplitz = np.zeros(shape=(len(event_time_vector),
-                                            len(np.where(event_bins <= 0)[0])
-                                            ))
+    # lags relative to event onset, in bins. Pre-event lags do not get truncated by the offsets.
+    lags = np.arange(-(n_pre-1),n_post)
+    rows = event_time_indices[:,np.newaxis] + lags[np.newaxis,:]
+    is_filled = (rows>=0) & (rows<n_rows) & ((lags[np.newaxis,:]<0) | (lags[np.newaxis,:]<=np.asarray(offset_indices)[:,np.newaxis]))
 
-    flipped_event_time_indices = np.where(np.flip(event_time_vector) == 1)[0]
-    flipped_diag_value_vector = np.flip(diag_value_vector)
+    rows = rows[is_filled]
+    cols = np.broadcast_to(lags+n_pre-1,is_filled.shape)[is_filled]
+    values = np.broadcast_to(np.asarray(diag_value_vector,dtype='float')[:,np.newaxis],is_filled.shape)[is_filled]
 
-    for diag_index, diag_value in zip(flipped_event_time_indices, flipped_diag_value_vector):
-        np.fill_diagonal(pre_event_toeplitz[diag_index:, :], diag_value)
-
-    pre_event_toeplitz_flipped = np.flip(pre_event_toeplitz,
-                                            axis=(0, 1))
-    # remove middle column (associated with onset of event
-    pre_event_toeplitz_truncated = pre_event_toeplitz_flipped[:, :-1]
-
-    full_event_toeplitz = np.concatenate([pre_event_toeplitz_truncated,
-                                            post_event_toeplitz],
-                                            axis=1)
+    if feat_mat_type=='sparse':
+        # each (row,col) is filled by at most one event, as events are on separate diagonals
+        full_event_toeplitz = ssparse.csr_matrix((values,(rows,cols)),shape=(n_rows,n_pre+n_post-1))
+    else:
+        full_event_toeplitz = np.zeros(shape=(n_rows,n_pre+n_post-1))
+        full_event_toeplitz[rows,cols] = values
 
     # good check if toeplitz is has to diag_value_vector, otherwise not 
     # if np.sum(full_event_toeplitz[:, -1]) != np.sum(event_time_vector):
@@ -122,6 +111,32 @@ def make_event_toeplitz(event_time_vector, event_bins,
     # assert np.sum(full_event_toeplitz[:, -1]) == np.sum(event_time_vector)
 
     return full_event_toeplitz
+
+def append_feature_columns(feature_matrix,columns):
+    """
+    append columns to the feature matrix, keeping it sparse if it was sparse
+
+    Parameters: 
+    -----------
+    feature_matrix: numpy ndarray/scipy.sparse matrix
+        (num_time_bins, num_features)
+    columns: numpy ndarray
+        (num_time_bins,) or (num_time_bins,num_new_features)
+    
+    Returns:
+    --------
+        numpy ndarray/scipy.sparse.csr_matrix
+    """
+    if columns.ndim==1:
+        columns = columns[:,np.newaxis]
+
+    if ssparse.issparse(feature_matrix):
+        feature_matrix = ssparse.hstack((feature_matrix,ssparse.csr_matrix(columns)),format='csr')
+    else:
+        feature_matrix = np.concatenate((feature_matrix,columns),axis=1)
+
+    return feature_matrix
+
 # make vectors of events
 def make_vector(): 
     pass 
@@ -138,6 +153,15 @@ def format_data():
 def evaluate_kernel_regression(): 
     pass
 
+def _gram_matrix(X):
+    """
+    X.T X as a dense array, for X that can be either a numpy ndarray or a scipy.sparse matrix
+    """
+    CXX = X.T @ X
+    if ssparse.issparse(CXX):
+        CXX = CXX.toarray()
+    return CXX
+
 class reduce_feature_matrix(object):
     """
     Performs dimensionality reduction on the feature matrix.
@@ -171,8 +195,8 @@ class reduce_feature_matrix(object):
         assert self.method in ['reduced-rank', 'reduced-rank-steinmetz'], print('Unknown method specified.')
         if self.method == 'reduced-rank':
             # weird implementation, but get the same results as Kush's reduced rank code
-            CXX = np.dot(X.T, X) + self.reg * ssparse.eye(np.size(X, 1))
-            CXY = np.dot(X.T, Y)
+            CXX = _gram_matrix(X) + self.reg * np.eye(np.size(X, 1))
+            CXY = X.T @ Y
             _U, _S, V = np.linalg.svd(np.dot(CXY.T, np.dot(np.linalg.pinv(CXX), CXY)))
 
             W = V[0:self.rank, :].T
@@ -184,8 +208,8 @@ class reduce_feature_matrix(object):
 
         elif self.method == 'reduced-rank-steinmetz':
 
-            CYX = np.dot(Y.T, X)
-            CXX = np.dot(X.T, X) + self.reg * ssparse.eye(np.size(X, 1))
+            CYX = (X.T @ Y).T
+            CXX = _gram_matrix(X) + self.reg * np.eye(np.size(X, 1))
             CXXMH = np.sqrt(CXX)
             M = np.dot(CYX, CXXMH)
 
@@ -201,7 +225,7 @@ class reduce_feature_matrix(object):
 
     def transform(self, X):
 
-        reduced_X = np.dot(X, self.transformer_matrix)
+        reduced_X = X @ self.transformer_matrix
 
         return reduced_X
 
@@ -209,19 +233,19 @@ class reduce_feature_matrix(object):
 
         if self.method == 'reduced-rank':
             # weird implementation, but get the same results as Kush's reduced rank code
-            CXX = np.dot(X.T, X) + self.reg * ssparse.eye(np.size(X, 1))
-            CXY = np.dot(X.T, Y)
+            CXX = _gram_matrix(X) + self.reg * np.eye(np.size(X, 1))
+            CXY = X.T @ Y
             _U, _S, V = np.linalg.svd(np.dot(CXY.T, np.dot(np.linalg.pinv(CXX), CXY)))
 
             W = V[0:self.rank, :].T
             A = np.dot(np.linalg.pinv(CXX), np.dot(CXY, W)).T
-            XA = np.dot(X, A.T)  # same as PB in Steinmetz 2019
+            XA = X @ A.T  # same as PB in Steinmetz 2019
             reduced_X = XA
 
         elif self.method == 'reduced-rank-steinmetz':
 
-            CYX = np.dot(Y.T, X)
-            CXX = np.dot(X.T, X) + self.reg * ssparse.eye(np.size(X, 1))
+            CYX = (X.T @ Y).T
+            CXX = _gram_matrix(X) + self.reg * np.eye(np.size(X, 1))
             CXXMH = np.sqrt(CXX)
             M = np.dot(CYX, CXXMH)
 
@@ -230,7 +254,7 @@ class reduce_feature_matrix(object):
             # _A = np.dot(U, S)
 
             reduced_B = B[:, :self.rank]
-            reduced_X = np.dot(X, reduced_B)
+            reduced_X = X @ reduced_B
 
         return reduced_X
 
@@ -272,8 +296,8 @@ class ReducedRankRegressor(object):
         if np.size(np.shape(Y)) == 1:
             Y = np.reshape(Y, (-1, 1))
 
-        CXX = np.dot(X.T, X) + self.reg * ssparse.eye(np.size(X, 1))
-        CXY = np.dot(X.T, Y)
+        CXX = _gram_matrix(X) + self.reg * np.eye(np.size(X, 1))
+        CXY = X.T @ Y
         # _U, _S, V = np.linalg.svd(np.dot(CXY.T, np.dot(np.linalg.pinv(CXX), CXY)))
         matrix_to_do_SVD = np.dot(CXY.T, np.dot(np.linalg.pinv(CXX), CXY))
 
@@ -287,11 +311,11 @@ class ReducedRankRegressor(object):
         self.A = np.dot(np.linalg.pinv(CXX), np.dot(CXY, self.W)).T
 
         if self.regressor == 'Ridge':
-            self.XA = np.dot(X, self.A.T)  # same as PB in Steinmetz 2019
+            self.XA = X @ self.A.T  # same as PB in Steinmetz 2019
             self.regressor_model = sklinear.Ridge(alpha=self.alpha, fit_intercept=False, solver='auto')
             self.regressor_model.fit(X=self.XA, y=Y)
         elif self.regressor == 'ElasticNet':
-            self.XA = np.dot(X, self.A.T)  # same as PB in Steinmetz 2019
+            self.XA = X @ self.A.T  # same as PB in Steinmetz 2019
             self.regressor_model = sklinear.ElasticNet(fit_intercept=False, alpha=self.alpha,
                                                        l1_ratio=self.l1_ratio)
             self.regressor_model.fit(X=self.XA, y=Y)
@@ -304,9 +328,9 @@ class ReducedRankRegressor(object):
             X = np.reshape(X, (-1, 1))
 
         if self.regressor is None:
-            Y_hat = np.dot(X, np.dot(self.A.T, self.W.T))
+            Y_hat = X @ np.dot(self.A.T, self.W.T)
         else:
-            XA = np.dot(X, self.A.T)  # multiply new data with the A (ie. B) matrix that was learnt
+            XA = X @ self.A.T  # multiply new data with the A (ie. B) matrix that was learnt
             Y_hat = self.regressor_model.predict(XA)
 
         return Y_hat
@@ -329,6 +353,115 @@ class ReducedRankRegressor(object):
         return self
 
 
+class MultiTargetRidgeSolver(object):
+    """
+    Closed-form ridge and reduced rank regression (no intercept) for all neurons and a whole grid of 
+    regularisation strengths/ranks at once.
+    - X is an n-by-d matrix of features (numpy ndarray or scipy.sparse matrix).
+    - Y is an n-by-D matrix of targets.
+    X.T X is eigendecomposed once (X.T X = V diag(l) V.T), after which the ridge solution for any alpha is 
+    B(alpha) = V diag(1/(l+alpha)) V.T X.T Y, i.e. a rescaling of the d-by-D matrix V.T X.T Y.
+    The reduced rank solution of ReducedRankRegressor (rank, reg) is B(reg) W W.T, where W are the top 
+    eigenvectors of Y.T X B(reg), so all ranks are truncations of the same decomposition.
+    """
+
+    def __init__(self, X, Y):
+        if np.size(np.shape(Y)) == 1:
+            Y = np.reshape(Y, (-1, 1))
+
+        eigvals, self.V = np.linalg.eigh(_gram_matrix(X))
+        self.eigvals = np.clip(eigvals, 0, None)
+        self.VtXtY = self.V.T @ np.asarray(X.T @ Y)
+        self._rank_cache = {}
+
+    def _inverse_eigvals(self, alpha):
+        # same cutoff as np.linalg.pinv, which ReducedRankRegressor uses on X.T X + reg*I
+        shifted = self.eigvals + alpha
+        is_kept = shifted > 1e-15 * np.max(shifted)
+        inv = np.zeros(shifted.size)
+        inv[is_kept] = 1 / shifted[is_kept]
+        return inv
+
+    def ridge_coef(self, alpha):
+        """(d, D) ridge coefficients for regularisation alpha"""
+        return self.V @ (self._inverse_eigvals(alpha)[:, np.newaxis] * self.VtXtY)
+
+    def rank_basis(self, reg):
+        """(D, D) output basis of the reduced rank regression, columns sorted by decreasing eigenvalue"""
+        if reg not in self._rank_cache:
+            M = self.VtXtY.T @ (self._inverse_eigvals(reg)[:, np.newaxis] * self.VtXtY)
+            _, W = np.linalg.eigh(M)
+            self._rank_cache[reg] = W[:, ::-1]
+        return self._rank_cache[reg]
+
+    def predict(self, X, alpha=0, rank=None):
+        """
+        prediction of the ridge model (rank=None) or of the reduced rank model (alpha is then reg)
+        """
+        Y_hat = np.asarray(X @ self.ridge_coef(alpha))
+        if rank is not None:
+            W = self.rank_basis(alpha)[:, :rank]
+            Y_hat = (Y_hat @ W) @ W.T
+        return Y_hat
+
+
+def closed_form_grid_search(X, Y, cv_splitter, param_grid, method='Ridge'):
+    """
+    Equivalent of sklearn GridSearchCV (scored by variance weighted r2) for Ridge ('alpha') and 
+    ReducedRankRegression ('rank','reg') without an intercept, where X is only decomposed once per 
+    training fold and every hyperparameter is evaluated from that decomposition.
+
+    Parameters
+    -----------
+    X : (numpy ndarray or scipy.sparse matrix)
+    Y : (numpy ndarray)
+    cv_splitter : (list)
+        list of (train,test) index tuples, e.g. the output of groupKFoldRandom
+    param_grid : (list of dict or dict)
+        same format as for GridSearchCV
+    method : (str)
+        'Ridge' or 'ReducedRankRegression'
+
+    Returns
+    ----------
+    best_params : (dict)
+    cv_results : (dict)
+        subset of the GridSearchCV.cv_results_ fields
+    """
+    params = list(sklselection.ParameterGrid(param_grid))
+    split_scores = np.zeros((len(cv_splitter), len(params)))
+
+    for fold_n, (train_idx, test_idx) in enumerate(cv_splitter):
+        solver = MultiTargetRidgeSolver(X[train_idx, :], Y[train_idx])
+        X_test, y_test = X[test_idx, :], Y[test_idx]
+
+        # the ridge prediction is computed once per regularisation strength and truncated for each rank
+        alphas = np.array([p['alpha'] if method == 'Ridge' else p['reg'] for p in params])
+        for alpha in np.unique(alphas):
+            ridge_prediction = solver.predict(X_test, alpha=alpha)
+            for i in np.where(alphas == alpha)[0]:
+                if method == 'Ridge':
+                    y_pred = ridge_prediction
+                elif method == 'ReducedRankRegression':
+                    W = solver.rank_basis(alpha)[:, :params[i]['rank']]
+                    y_pred = (ridge_prediction @ W) @ W.T
+                split_scores[fold_n, i] = sklmetrics.r2_score(y_test, y_pred.reshape(np.shape(y_test)),
+                                                              multioutput='variance_weighted')
+
+    mean_scores = split_scores.mean(axis=0)
+    cv_results = {'params': params,
+                  'mean_test_score': mean_scores,
+                  'std_test_score': split_scores.std(axis=0),
+                  'rank_test_score': sp_rankdata(-mean_scores, method='min').astype(np.int32)}
+    for fold_n in range(len(cv_splitter)):
+        cv_results['split%d_test_score' % fold_n] = split_scores[fold_n, :]
+
+    # as GridSearchCV, the first of the best parameter sets wins
+    best_params = params[np.argmax(mean_scores)]
+
+    return best_params, cv_results
+
+
 def groupKFoldRandom(groups, n=2, seed=None):
     """
     Random analogous of sklearn.model_selection.GroupKFold.split.
@@ -361,12 +494,13 @@ def groupKFoldRandom(groups, n=2, seed=None):
 def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evaluation_method='fit-all', cv_split=10,
                           tune_hyper_parameter=True, split_group_vector=None, preprocessing_method=None,
                           rank=10, ridge_alpha=10, rr_regulariser=None, l1_ratio=None,  dev_test_random_seed=None, cv_random_seed=None, test_size=0.2,
-                          save_path=None, check_neg_weights=True, time_bins=None, save_X=False):
+                          save_path=None, check_neg_weights=True, time_bins=None, save_X=False,
+                          hyperparam_search='closed-form'):
     """
     Fits kernel regression to neural data.
     Parameters
     -----------
-    X :  (numpy ndarray)
+    X :  (numpy ndarray or scipy.sparse matrix)
          feature matrix (toeplitz-like matrix)
     Y :  (numpy ndarray)
         neural activity (can be one vector or a matrix of shape (numTimePoints, numNeuron)
@@ -388,6 +522,11 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
         this is useful when time bins are not independent of each other (ie. there is autocorrelation)
     save_X : (booL)
         whether to save the feature matrices as well (for double checking things)
+    hyperparam_search : (str)
+        how hyperparameters are tuned when tune_hyper_parameter is True
+        'closed-form' : for Ridge and ReducedRankRegression without intercept, use closed_form_grid_search, 
+                        which decomposes X once per cv fold for the whole parameter grid and all neurons
+        'sklearn' : sklearn GridSearchCV (always used for the other methods)
 
     numerous parameters are in fact the starting parameters if a parameter search is performed
 
@@ -424,6 +563,9 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
                                   'nnegElasticNet', 'DummyRegressorMean']
     other_methods = ['ReduceThenRidge', 'ReduceThenElasticNet']
 
+    # sklearn defaults to an iterative solver for sparse X, so use the same closed-form solution as for dense X 
+    ridge_solver = 'cholesky' if ssparse.issparse(X) else 'auto'
+
     if preprocessing_method == 'RankReduce':
         print('Performing reduced rank regression as a preprocessing step')
         reduction_transformer = reduce_feature_matrix(reg=0, rank=rank)
@@ -439,7 +581,7 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
             elif method == 'Ridge':
                 print('ysd')
                 # the column of 1s is already included in design matrix, so no need to fit intercept.
-                clf = sklinear.Ridge(alpha=ridge_alpha, fit_intercept=fit_intercept, solver='auto')
+                clf = sklinear.Ridge(alpha=ridge_alpha, fit_intercept=fit_intercept, solver=ridge_solver)
             elif method == 'Lasso':
                 clf = sklinear.Lasso(alpha=ridge_alpha, fit_intercept=fit_intercept, solver='auto')
             elif method == 'nnegElasticNet':
@@ -460,7 +602,7 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
             
             # check that there are no negative weights in the feature matrix
             if check_neg_weights:
-                if (X < 0).any():
+                if X.min() < 0:
                     print('Found negative weights in feature matrix.')
                     print('To disable negative weight checking, set check_neg_weights to False')
 
@@ -513,7 +655,7 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
                 model = KernelRidge(alpha=1.0, kernel='linear')
             elif method == 'Ridge':
                 # default model is basically not regularised
-                model = sklinear.Ridge(alpha=ridge_alpha, fit_intercept=fit_intercept, solver='auto')
+                model = sklinear.Ridge(alpha=ridge_alpha, fit_intercept=fit_intercept, solver=ridge_solver)
                 param_grid = [{'alpha': np.logspace(-4, 4, num=10)}]
                 scoring_method = sklmetrics.make_scorer(sklmetrics.r2_score,
                                                         multioutput='variance_weighted',
@@ -569,27 +711,33 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
 
                 if split_group_vector is None:
                     # if no cv method provided, then htis does 5-fold cross validation .
-                    grid_search = sklselection.GridSearchCV(model, param_grid, n_jobs=2,
-                                                            cv=cv_split, scoring=scoring_method)
-
-                    grid_search_results = grid_search.fit(X=X_dev, y=y_dev)
+                    cv_splitter = cv_split
                 else:
                     print('Using custom groups to do CV splits')
                     # note that GroupKFold is not random
                     # and shuffling the input does not resolve that.
                     # cv_splitter = sklselection.GroupKFold(n_splits=cv_split)
                     cv_splitter = groupKFoldRandom(groups=split_group_vector_dev, n=cv_split, seed=cv_random_seed)
+
+                if (hyperparam_search == 'closed-form') and (method in ['Ridge', 'ReducedRankRegression']) and (not fit_intercept):
+                    if isinstance(cv_splitter, int):
+                        # default splitting of GridSearchCV for regressors
+                        cv_splitter = list(sklselection.KFold(n_splits=cv_splitter).split(X_dev))
+                    best_params, cv_results = closed_form_grid_search(X_dev, y_dev, cv_splitter, param_grid, method=method)
+                else:
                     grid_search = sklselection.GridSearchCV(model, param_grid, n_jobs=2,
                                                             cv=cv_splitter, scoring=scoring_method)
-                    grid_search_results = grid_search.fit(X=X_dev, y=y_dev, groups=split_group_vector_dev)
-
-                best_params = grid_search_results.best_params_
+                    if split_group_vector is None:
+                        grid_search_results = grid_search.fit(X=X_dev, y=y_dev)
+                    else:
+                        grid_search_results = grid_search.fit(X=X_dev, y=y_dev, groups=split_group_vector_dev)
+                    best_params, cv_results = grid_search_results.best_params_, grid_search_results.cv_results_
 
                 # Update the model with the best hyperparameter from cv (to be used in the test set)
                 if method == 'Ridge':
                     print('Applying tuned hyperparameter to model for test set evaluation.')
                     model = sklinear.Ridge(alpha=best_params['alpha'],
-                                           fit_intercept=fit_intercept, solver='auto')
+                                           fit_intercept=fit_intercept, solver=ridge_solver)
                 elif method == 'ReducedRankRegression':
                     try:
                         model = ReducedRankRegressor(rank=best_params['rank'],
@@ -609,7 +757,7 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
                                                  regressor='ElasticNet')
 
                 fit_results.update(best_params=best_params,
-                                   cv_hyperparam_search_results=grid_search_results.cv_results_)
+                                   cv_hyperparam_search_results=cv_results)
 
                 # add the indices (eg. Trials) used in development and testing set
                 if split_group_vector is not None:
@@ -661,7 +809,8 @@ def fit_kernel_regression(X, Y, method='KernelRidge', fit_intercept=False, evalu
                                                                          multioutput='raw_values')
 
             # Fit a non-validated model to the test set to look at the explainable variance
-            non_validated_model = sklinear.Ridge(alpha=0, fit_intercept=fit_intercept, solver='auto')
+            # (cholesky cannot fall back to svd for singular sparse X at alpha=0)
+            non_validated_model = sklinear.Ridge(alpha=0, fit_intercept=fit_intercept, solver='lsqr' if ssparse.issparse(X) else 'auto')
             non_validated_model = non_validated_model.fit(X_test, y_test)
             non_validated_model_prediction = non_validated_model.predict(X_test)
             test_set_explainable_variance = sklmetrics.explained_variance_score(y_test, non_validated_model_prediction,
@@ -704,13 +853,13 @@ def remove_all_zero_rows(X, Y, group_vector=None, intercept_included=True):
     when there are all zeros in the rows of the feature matrix
     Parameters
     ----------
-    X : (numpy ndarray)
+    X : (numpy ndarray or scipy.sparse matrix)
         feature matrix
     Y : (numpy ndarray)
         target matrix
     Returns
     -------
-    reduced_X : (numpy ndarray)
+    reduced_X : (numpy ndarray or scipy.sparse.csr_matrix)
         X with all-zero row deleted
     reduced_Y : (numpy ndarray)
         Y with rows corresponding to all-zero row in X deleted
@@ -718,20 +867,27 @@ def remove_all_zero_rows(X, Y, group_vector=None, intercept_included=True):
         1 dimension vector with the groups to remove
     """
 
+    # number of non-zero features per row; works for both dense and sparse X
+    def _nonzero_per_row(X_):
+        return np.asarray((X_ != 0).sum(axis=1)).ravel()
+
     # double check whether X has the intercept included
     if intercept_included:
         if np.shape(X)[1] == 1:
             # only a single feature
-            all_zero_rows = np.where(X == 0)[0]
+            all_zero_rows = np.where(_nonzero_per_row(X) == 0)[0]
         else:
-            all_zero_rows = np.where(~X[:, 1:].any(axis=1))[0]
+            all_zero_rows = np.where(_nonzero_per_row(X[:, 1:]) == 0)[0]
     else:
-        all_zero_rows = np.where(~X.any(axis=1))[0]
-        if np.sum(X[:, 0]) == np.shape(X)[0]:
+        all_zero_rows = np.where(_nonzero_per_row(X) == 0)[0]
+        if X[:, 0].sum() == np.shape(X)[0]:
             print('Are you sure the intercept is not included? Because'
                   'the first column seems to be all zeros')
 
-    reduced_X = np.delete(X, all_zero_rows, axis=0)
+    if ssparse.issparse(X):
+        reduced_X = ssparse.csr_matrix(X)[np.setdiff1d(np.arange(np.shape(X)[0]), all_zero_rows), :]
+    else:
+        reduced_X = np.delete(X, all_zero_rows, axis=0)
     reduced_Y = np.delete(Y, all_zero_rows, axis=0)
 
     if group_vector is not None:
@@ -741,6 +897,28 @@ def remove_all_zero_rows(X, Y, group_vector=None, intercept_included=True):
 
     return reduced_X, reduced_Y, all_zero_rows,reduced_group_vector
 
+def zero_feature_columns(X, columns):
+    """
+    copy of the feature matrix where the requested columns are set to 0 
+    for sparse matrices this is done by masking rather than assignment, which would densify the columns
+
+    Parameters
+    ----------
+    X : (numpy ndarray or scipy.sparse matrix)
+    columns : (numpy ndarray)
+        indices of the columns to zero
+    """
+    if ssparse.issparse(X):
+        column_mask = np.ones(np.shape(X)[1])
+        column_mask[columns] = 0
+        X_zeroed = ssparse.csr_matrix(X @ ssparse.diags(column_mask))
+        X_zeroed.eliminate_zeros()
+    else:
+        X_zeroed = X.copy()
+        X_zeroed[:, columns] = 0
+
+    return X_zeroed
+
 def compute_response_function(model, event_names, event_start_ends, bin_width,event_start_index=1,
                               include_intercept=True, diag_fill_values=None,
                               custom_event_names=None, feature_column_dict=None,
@@ -832,12 +1010,100 @@ def compute_response_function(model, event_names, event_start_ends, bin_width,ev
 
     return response_function_dict
 
+def _leave_one_out_fold(model, X, y, event, feature_column_index, fold_n, train_idx, test_idx,
+                        sig_metric=['explained-variance'], original_feature_column_dict=None):
+    """
+    leave-one-out significance of a single kernel on a single cv fold. See test_kernel_significance.
+
+    Returns
+    --------------
+    event_cv_df (pandas dataframe)
+    """
+    num_neuron = np.shape(y)[1]
+
+    X_train = X[train_idx, :]
+    X_test = X[test_idx, :]
+    y_train = y[train_idx, :]
+    y_test = y[test_idx, :]
+
+    print(event,train_idx.size,test_idx.size)
+
+    # subset the feature matrix to remove the kernel of interest
+    X_train_leave_one = zero_feature_columns(X_train, feature_column_index)  # separate objects!
+    X_test_leave_one = zero_feature_columns(X_test, feature_column_index)
+
+    # if (event == 'audRightOne') & (fold_n == 3):
+    #     pdb.set_trace()
+
+    # Fit model with leave-one-out feature matrix
+    try:
+        train_fit_model = model.fit(X_train_leave_one, y_train)
+    except:
+        print('One kernel fitting on X_train_leave_one failed, '
+              'this is using event: %s in fold %.f.'
+              'Try making reg a small positive value.' % (event, fold_n))
+
+    # Predict training and testing data and subtract the difference from actual training and testing
+    train_prediction = train_fit_model.predict(X_train_leave_one)
+    train_diff = y_train - train_prediction
+
+    test_prediction = train_fit_model.predict(X_test_leave_one)
+    test_diff = y_test - test_prediction
+
+    # Train error on the one kernel feature matrix, and evaluate it's performance on the test set residuals
+    one_kernel_X_train = X_train - X_train_leave_one
+
+    try:
+        one_kernel_train_fit_model = model.fit(one_kernel_X_train, train_diff)
+    except:
+        print('One kernel fitting failed, this is using event: %s' % event)
+    # one_kernel_train_prediction = one_kernel_train_fit_model.predict(one_kernel_X_train)  # for plotting
+
+    one_kernel_X_test = X_test - X_test_leave_one
+    one_kernel_test_prediction = one_kernel_train_fit_model.predict(one_kernel_X_test)
+
+    if 'explained-variance' in sig_metric:
+        explained_variance_score = sklmetrics.explained_variance_score(test_diff,
+                                                                       one_kernel_test_prediction,
+                                                                       multioutput='raw_values')
+        event_cv_df = pd.DataFrame.from_dict({'VE': explained_variance_score})
+
+    if 'explained-variance-temporal' in sig_metric: 
+        # this is a temporal VE measure within trial to pull apart that from stimulus onset, how much VE is explained by the model in specific time bins. 
+        kernel_names = np.array(list(original_feature_column_dict.keys()))
+        trial_kernel_idx = [original_feature_column_dict[f].size>1 for f in original_feature_column_dict.keys()]
+        trial_kernel_names = kernel_names[trial_kernel_idx]
+        trial_rows_feature_matrix = [original_feature_column_dict[tk][:,np.newaxis] for tk in trial_kernel_names]
+        trial_rows_feature_matrix = np.concatenate(trial_rows_feature_matrix,axis=1)
+        # take the times of each
+
+        n_trial_t_bins = trial_rows_feature_matrix.shape[0]
+        num_neuron  = test_diff.shape[1]
+        explained_variance_trial = np.zeros((n_trial_t_bins,num_neuron))
+        for i in range(n_trial_t_bins):
+            trial_time_index = np.asarray((X_test[:,trial_rows_feature_matrix[i,:]]).sum(axis=1)).ravel()>0
+            explained_variance_score = sklmetrics.explained_variance_score(test_diff[trial_time_index,:],
+                                                        one_kernel_test_prediction[trial_time_index,:],
+                                                        multioutput='raw_values')
+            explained_variance_trial[i,:] = explained_variance_score
+        if 'event_cv_df' in locals():
+            event_cv_df['VE_trial'] = [explained_variance_trial[:,n] for n in range(num_neuron)]
+        else:
+            event_cv_df = pd.DataFrame.from_dict({'VE_trial': [explained_variance_trial[:,n] for n in range(num_neuron)]})
+
+
+    event_cv_df['neuron'] = np.arange(0, num_neuron)
+    event_cv_df['cv_number'] = fold_n
+    event_cv_df['event'] = event
+
+    return event_cv_df
+
 def test_kernel_significance(model, X, y, feature_column_dict,original_feature_column_dict=None,
                              method='leave-one-out', num_cv_folds=5,
                              split_group_vector=None,
                              sig_metric=['explained-variance'],
                              cv_random_seed=None, param_dict=None,
-                             check_neg_features=False):
+                             check_neg_features=False, n_jobs=1):
     """
     Test the significance of each kernel in the feature matrix.
 
@@ -855,7 +1121,7 @@ def test_kernel_significance(model, X, y, feature_column_dict,original_feature_c
         sklearn model object with set hyperparameters (but not fitted to data yet)
         can also be a sklearn pipeline where hyperparameter tuning is done via cross validation
         within the training set.
-    X : (numpy ndarray)
+    X : (numpy ndarray or scipy.sparse matrix)
         feature matrix of shape (num_time_bin, num_neuron)
     y : (numpy ndarray)
         target matrix of shape (num_time_bin, num_neuron)
@@ -877,14 +1143,15 @@ def test_kernel_significance(model, X, y, feature_column_dict,original_feature_c
         eg. Steinmetz 2018 define a significant kernel as having more than 2% variacne
         explained in the test set (on average)
     original_feature_column_dict : used when the kernel is temporal and the feature column dict is a refurbished one 
+    n_jobs : (int)
+        number of processes to fit the (kernel x cv fold) grid of the leave-one-out method on. 
+        -1 uses all cores. 
     Returns
     --------------
     kernel_sig_results (pandas dataframe)
         dataframe with colummns : (1) kernel name (2) neuron (3) explained variance (4) cv number
     """
 
-    # TODO: allow parallelising this (both cv part and event part can be parallelised)
-
     # check that split_group_vector has the correct number of values
     if split_group_vector is not None:
         assert len(split_group_vector) == np.shape(X)[0]
@@ -901,94 +1168,27 @@ def test_kernel_significance(model, X, y, feature_column_dict,original_feature_c
 
     if method == 'leave-one-out':
 
-        for event, feature_column_index in feature_column_dict.items():
-
-            # generate cross-validation split
-            if split_group_vector is not None:
-                cv_splitter = groupKFoldRandom(groups=split_group_vector,
-                                               n=num_cv_folds, seed=cv_random_seed)
-            else:
-                print('Implement CV without groups')
-
-            for fold_n, (train_idx, test_idx) in enumerate(cv_splitter):
-                X_train = X[train_idx, :]
-                X_test = X[test_idx, :]
-                y_train = y[train_idx, :]
-                y_test = y[test_idx, :]
-
-                print(event,train_idx.size,test_idx.size)
-
-                # subset the feature matrix to remove the kernel of interest
-                X_train_leave_one = X_train.copy()  # separate objects!
-                X_test_leave_one = X_test.copy()
-                X_train_leave_one[:, feature_column_dict[event]] = 0
-                X_test_leave_one[:, feature_column_dict[event]] = 0
-
-                # if (event == 'audRightOne') & (fold_n == 3):
-                #     pdb.set_trace()
-
-                # Fit model with leave-one-out feature matrix
-                try:
-                    train_fit_model = model.fit(X_train_leave_one, y_train)
-                except:
-                    print('One kernel fitting on X_train_leave_one failed, '
-                          'this is using event: %s in fold %.f.'
-                          'Try making reg a small positive value.' % (event, fold_n))
-
-                # Predict training and testing data and subtract the difference from actual training and testing
-                train_prediction = train_fit_model.predict(X_train_leave_one)
-                train_diff = y_train - train_prediction
-
-                test_prediction = train_fit_model.predict(X_test_leave_one)
-                test_diff = y_test - test_prediction
-
-                # Train error on the one kernel feature matrix, and evaluate it's performance on the test set residuals
-                one_kernel_X_train = X_train - X_train_leave_one
-
-                try:
-                    one_kernel_train_fit_model = model.fit(one_kernel_X_train, train_diff)
-                except:
-                    print('One kernel fitting failed, this is using event: %s' % event)
-                # one_kernel_train_prediction = one_kernel_train_fit_model.predict(one_kernel_X_train)  # for plotting
-
-                one_kernel_X_test = X_test - X_test_leave_one
-                one_kernel_test_prediction = one_kernel_train_fit_model.predict(one_kernel_X_test)
-
-                if 'explained-variance' in sig_metric:
-                    explained_variance_score = sklmetrics.explained_variance_score(test_diff,
-                                                                                   one_kernel_test_prediction,
-                                                                                   multioutput='raw_values')
-                    event_cv_df = pd.DataFrame.from_dict({'VE': explained_variance_score})
-
-                if 'explained-variance-temporal' in sig_metric: 
-                    # this is a temporal VE measure within trial to pull apart that from stimulus onset, how much VE is explained by the model in specific time bins. 
-                    kernel_names = np.array(list(original_feature_column_dict.keys()))
-                    trial_kernel_idx = [original_feature_column_dict[f].size>1 for f in original_feature_column_dict.keys()]
-                    trial_kernel_names = kernel_names[trial_kernel_idx]
-                    trial_rows_feature_matrix = [original_feature_column_dict[tk][:,np.newaxis] for tk in trial_kernel_names]
-                    trial_rows_feature_matrix = np.concatenate(trial_rows_feature_matrix,axis=1)
-                    # take the times of each
-                    
-                    n_trial_t_bins = trial_rows_feature_matrix.shape[0]
-                    num_neuron  = test_diff.shape[1]
-                    explained_variance_trial = np.zeros((n_trial_t_bins,num_neuron))
-                    for i in range(n_trial_t_bins):
-                        trial_time_index = (X_test[:,trial_rows_feature_matrix[i,:]]).sum(axis=1)>0
-                        explained_variance_score = sklmetrics.explained_variance_score(test_diff[trial_time_index,:],
-                                                                    one_kernel_test_prediction[trial_time_index,:],
-                                                                    multioutput='raw_values')
-                        explained_variance_trial[i,:] = explained_variance_score
-                    if 'event_cv_df' in locals():
-                        event_cv_df['VE_trial'] = [explained_variance_trial[:,n] for n in range(num_neuron)]
-                    else:
-                        event_cv_df = pd.DataFrame.from_dict({'VE_trial': [explained_variance_trial[:,n] for n in range(num_neuron)]})
-
+        # generate cross-validation split
+        if split_group_vector is not None:
+            cv_splitter = groupKFoldRandom(groups=split_group_vector,
+                                           n=num_cv_folds, seed=cv_random_seed)
+        else:
+            print('Implement CV without groups')
 
-                event_cv_df['neuron'] = np.arange(0, num_neuron)
-                event_cv_df['cv_number'] = fold_n
-                event_cv_df['event'] = event
+        # every (kernel,fold) pair is refitted independently
+        fit_grid = [(event, feature_column_index, fold_n, train_idx, test_idx) 
+                    for event, feature_column_index in feature_column_dict.items() 
+                    for fold_n, (train_idx, test_idx) in enumerate(cv_splitter)]
 
-                df_store.append(event_cv_df)
+        if n_jobs==1:
+            df_store = [_leave_one_out_fold(model, X, y, *g, sig_metric=sig_metric,
+                                            original_feature_column_dict=original_feature_column_dict) for g in fit_grid]
+        else:
+            # X and y are memory mapped and shared with the workers rather than pickled to each of them.
+            # The output order follows fit_grid, so results do not depend on which worker finishes first.
+            df_store = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+                delayed(_leave_one_out_fold)(model, X, y, *g, sig_metric=sig_metric,
+                                             original_feature_column_dict=original_feature_column_dict) for g in fit_grid)
 
         kernel_sig_results = pd.concat(df_store)
 
@@ -1034,10 +1234,8 @@ def test_kernel_significance(model, X, y, feature_column_dict,original_feature_c
                 y_test = y[test_idx, :]
 
                 # subset the feature matrix to remove the kernel of interest
-                X_train_leave_one = X_train.copy()  # separate objects!
-                X_test_leave_one = X_test.copy()
-                X_train_leave_one[:, feature_column_dict[event]] = 0
-                X_test_leave_one[:, feature_column_dict[event]] = 0
+                X_train_leave_one = zero_feature_columns(X_train, feature_column_dict[event])  # separate objects!
+                X_test_leave_one = zero_feature_columns(X_test, feature_column_dict[event])
 
                 loo_fit_model = model.fit(X_train_leave_one, y_train)
                 loo_test_prediction = loo_fit_model.predict(X_test_leave_one)
@@ -1238,6 +1436,7 @@ class kernel_model():
                             turn_stim_off = None,
                             aud_dir_kernel = False,
                             vis_dir_kernel = False,
+                            feat_mat_type = 'dense',
                             **kwargs):         
 
         """
@@ -1267,6 +1466,9 @@ class kernel_model():
                  - 'moveEnd' when the movement kernel stops being supported as well
         stim_dir_kernel: bool
             whether separate kernels by azimuths or to add a direction kernel for L/R (and aud center as the always on kernel) 
+        feat_mat_type: str
+            'dense' or 'sparse'. 'sparse' keeps the feature matrix as a scipy.sparse csr matrix, 
+            which is much smaller for long sessions with many kernels at fine time bins.
 
         """
 
@@ -1274,6 +1476,7 @@ class kernel_model():
         # load from PinkRigs pipeline
     
         loaded_ok = False
+        probe_folder = None
 
         if rec is None:
             ephys_dict =  {'spikes': ['times', 'clusters'],'clusters':['_av_IDs','mlapdv']}
@@ -1286,6 +1489,7 @@ class kernel_model():
 
             if rec.shape[0] == 1:            
                 rec =  rec.iloc[0]
+                probe_folder = Path(rec.expFolder) / 'ONE_preproc' / kwargs.get('probe','probe0')
                 print('successful loading.')
                 print('binning events and spikes... This might take a while.')
                 loaded_ok = True
@@ -1317,14 +1521,16 @@ class kernel_model():
             # prepare spike data  - bin and smooth 
 
             ################# SPIKE DATA ###########################
+            # bin from the session's spike count matrix (cached next to the ONE folder when the folder is known)
+            spike_counts = get_spike_counts(spikes,self.t_bin,probe_folder=probe_folder)
+
             # subselect neurons 
+            cluster_ids = None
             if subselect_neurons: 
                 subselect_neurons = np.array(subselect_neurons)
-                idx  = np.where(spikes.clusters==subselect_neurons[:,np.newaxis])[1]
-                spikes.clusters = spikes.clusters[idx]  
-                spikes.times = spikes.times[idx]      
+                cluster_ids = spike_counts.clusIDs[np.isin(spike_counts.clusIDs,subselect_neurons)]
 
-            self.R,self.tscale,self.clusIDs = bincount2D(spikes.times,spikes.clusters,xbin=self.t_bin,xsmoothing=self.smoothing)
+            self.R,self.tscale,self.clusIDs = spike_counts.get(cluster_ids=cluster_ids,xsmoothing=self.smoothing)
 
             
             ############## EVENTS DATA #########################
@@ -1567,8 +1773,11 @@ class kernel_model():
 
 
             # make feature matrix from the digitised events
-            toeplitz = [make_event_toeplitz(event_,bin_ranges[ev_name],diag_value_vector=extracted_ev.diag_values[ev_name],off_time_vector=offset_indices[ev_name]) for event_,ev_name in zip(self.events_digitised,event_names_)]
-            toeplitz = np.concatenate(toeplitz,axis=1)
+            toeplitz = [make_event_toeplitz(event_,bin_ranges[ev_name],diag_value_vector=extracted_ev.diag_values[ev_name],off_time_vector=offset_indices[ev_name],feat_mat_type=feat_mat_type) for event_,ev_name in zip(self.events_digitised,event_names_)]
+            if feat_mat_type=='sparse':
+                toeplitz = ssparse.hstack(toeplitz,format='csr')
+            else:
+                toeplitz = np.concatenate(toeplitz,axis=1)
 
 
             self.feature_matrix = toeplitz
@@ -1606,7 +1815,7 @@ class kernel_model():
                                       
                 bl_kernel = trial_indices[fitted_trial_idxs,:].sum(axis=0)
                 # add a baseline to the feature matrix
-                self.feature_matrix = np.concatenate((self.feature_matrix,bl_kernel[:,np.newaxis]),axis=1)
+                self.feature_matrix = append_feature_columns(self.feature_matrix,bl_kernel)
                 self.feature_column_dict['baseline'] = np.array([self.feature_matrix.shape[1]-1])
 
             if 'motionEnergy' in event_types or 'pupil' in event_types:                 
@@ -1637,7 +1846,7 @@ class kernel_model():
                     # add the movement to the feature matrix during the trial
                     kernel_idx  = trial_indices[fitted_trial_idxs,:].sum(axis=0).astype('bool')
                     cam_values[~kernel_idx] = 0
-                    self.feature_matrix = np.concatenate((self.feature_matrix,cam_values[:,np.newaxis]),axis=1)
+                    self.feature_matrix = append_feature_columns(self.feature_matrix,cam_values)
                     self.feature_column_dict[camtype] = np.array([self.feature_matrix.shape[1]-1]) 
 
             if 'coherent-nl-gain' in event_types:                
@@ -1650,7 +1859,7 @@ class kernel_model():
 
                     my_kernel = trial_indices[is_selected,:].sum(axis=0)
                 # add a baseline to the feature matrix
-                    self.feature_matrix = np.concatenate((self.feature_matrix,my_kernel[:,np.newaxis]),axis=1)
+                    self.feature_matrix = append_feature_columns(self.feature_matrix,my_kernel)
                     self.feature_column_dict[feature_name_string] = np.array([self.feature_matrix.shape[1]-1])
 
 
@@ -1686,13 +1895,15 @@ class kernel_model():
       
 
 
-    def evaluate(self,kernel_selection = 'independent',sig_metric = ['explained-varaince']):
+    def evaluate(self,kernel_selection = 'independent',sig_metric = ['explained-varaince'],n_jobs=1):
         """
         independent evaluation function using various modes
         Parameters: 
         ----------- 
         kernel_selection: str
             implement grouping of kernels
+        n_jobs: int
+            number of processes used to test the kernel significance, see test_kernel_significance
 
 
         """
@@ -1722,7 +1933,8 @@ class kernel_model():
                 new_feature_column_dict,original_feature_column_dict = self.feature_column_dict,
                 num_cv_folds=2, 
                 sig_metric=sig_metric,
-                split_group_vector=split_group_vector_
+                split_group_vector=split_group_vector_,
+                n_jobs=n_jobs
                 )            
 
         elif 'dirgroups' in kernel_selection: 
@@ -1744,7 +1956,8 @@ class kernel_model():
                 new_feature_column_dict,original_feature_column_dict = self.feature_column_dict,
                 num_cv_folds=2, 
                 sig_metric=sig_metric,
-                split_group_vector=split_group_vector_
+                split_group_vector=split_group_vector_,
+                n_jobs=n_jobs
                 ) 
 
 
@@ -1753,7 +1966,8 @@ class kernel_model():
                 model,feature_matrix_,R_,
                 self.feature_column_dict,num_cv_folds=2, 
                 sig_metric=sig_metric,
-                split_group_vector=split_group_vector_
+                split_group_vector=split_group_vector_,
+                n_jobs=n_jobs
                 ) 
 
         kernel_significance['clusID'] = [self.clusIDs[n] for n in kernel_significance.neuron]
@@ -1769,7 +1983,7 @@ class kernel_model():
         predict_all = self.fit_results['dev_model'].predict(self.feature_matrix)
         self.prediction = predict_all.T
 
-    def fit_evaluate(self,get_prediciton=True,**fit_kwargs): 
+    def fit_evaluate(self,get_prediciton=True,n_jobs=1,**fit_kwargs): 
         """
         Fit the kernel regression 
         Fitting procedure: get rid of zero-rows: ie. rows where no kernel is activated 
@@ -1779,6 +1993,8 @@ class kernel_model():
         ------------
         get_prediction: bool
             whether to get prediciton for the entire feature matrix (with the zero rows)
+        n_jobs: int
+            number of processes used to test the kernel significance, see test_kernel_significance
         
         """
 
@@ -1805,7 +2021,8 @@ class kernel_model():
             model,feature_matrix_,R_,
             self.feature_column_dict,num_cv_folds=2, 
             sig_metric=['explained-variance'],
-            split_group_vector=split_group_vector_
+            split_group_vector=split_group_vector_,
+            n_jobs=n_jobs
             )
 
         if get_prediciton:
@@ -81,6 +81,97 @@ def get_test_statistic(test_raster,blank_raster,trim_fraction = None, permute_se
     
     return Rmax_stim-Rmax_blank
 
+def get_shuffle_indices(n_trials,n_shuffles,seed=0):
+    """
+    trial orders of all shuffles as one (n_shuffles x n_trials) index matrix. 
+    Shuffle 0 is the unshuffled order (as permute_seed=0 in get_test_statistic).
+    """
+    shuffle_idx = np.tile(np.arange(n_trials),(n_shuffles,1))
+    shuffle_idx[1:,:] = np.random.default_rng(seed).permuted(shuffle_idx[1:,:],axis=1)
+
+    return shuffle_idx
+
+def _trimmed_group_weights(trial_resp,group_idx,n_to_trim):
+    """
+    weights to average the trials of each shuffled group after discarding the n_to_trim 
+    lowest and highest responding trials of each neuron
+
+    trial_resp: np.ndarray (trials x neurons), mean response of each trial
+    group_idx: np.ndarray (shuffles x trials_in_group), trials belonging to the group in each shuffle 
+
+    Returns: np.ndarray (neurons x shuffles x trials)
+    """
+    n_shuffles,n_group = group_idx.shape
+    n_trials,n_neurons = trial_resp.shape
+    # rank within the group is only needed at the trimming boundaries, so partition rather than sort
+    group_resp = trial_resp.T[:,group_idx]
+    kept = np.argpartition(group_resp,(n_to_trim,n_group-n_to_trim-1),axis=2)[:,:,n_to_trim:n_group-n_to_trim]
+    kept_trials = np.take_along_axis(np.broadcast_to(group_idx,group_resp.shape),kept,axis=2)
+
+    weights = np.zeros((n_neurons,n_shuffles,n_trials))
+    neuron_ix,shuffle_ix,_ = np.ix_(np.arange(n_neurons),np.arange(n_shuffles),np.arange(kept.shape[2]))
+    weights[neuron_ix,shuffle_ix,kept_trials] = 1/kept.shape[2]
+
+    return weights
+
+def get_permuted_test_statistics(test_raster,blank_raster,n_shuffles=2000,trim_fraction = None,chunk_size=100,seed=0):
+    """
+    vectorised equivalent of calling get_test_statistic with n_shuffles different permute_seeds
+    the group means of a chunk of shuffles are computed as a single matrix product with trial weights
+
+    Parameters: 
+    -----------
+    test_raster: np.ndarray (trials x neurons x time)
+    blank_raster: np.ndarray (trials x neurons x time)
+    n_shuffles: int
+    trim_fraction: float
+        fraction ot trials to trim from highest to loweest response 
+    chunk_size: int
+        number of shuffles evaluated at once, which bounds memory to chunk_size x neurons x time (x trials if trimmed)
+    seed: int
+        seed of the shuffles
+
+    Returns:
+    --------
+        np.ndarray (neurons), np.ndarray (neurons x n_shuffles)
+        test statistic without shuffling and the null distribution (where shuffle 0 is unshuffled)
+    """
+    # check if trial sizes are the same, if not subsample
+    n_trials_test = test_raster.shape[0]
+    n_trials_blank = blank_raster.shape[0]
+    n_group = min(n_trials_test,n_trials_blank)
+    rasters = np.concatenate((test_raster[:n_group,:,:],blank_raster[:n_group,:,:]),axis=0)
+    n_trials,n_neurons,n_bins = rasters.shape
+
+    shuffle_idx = get_shuffle_indices(n_trials,n_shuffles,seed=seed)
+
+    if trim_fraction is not None: 
+        n_to_trim = int(np.floor(n_trials_test * trim_fraction))       
+        trial_resp = rasters.mean(axis=2)
+        rasters_per_neuron = np.ascontiguousarray(rasters.transpose(1,0,2)) # neurons x trials x time
+
+    t_null = np.zeros((n_neurons,n_shuffles))
+    for c in range(0,n_shuffles,chunk_size):
+        chunk_idx = shuffle_idx[c:c+chunk_size,:]
+        Rmax = []
+        for group_idx in (chunk_idx[:,:n_group],chunk_idx[:,n_group:]):
+            if (trim_fraction is not None) and (n_to_trim>0):
+                weights = _trimmed_group_weights(trial_resp,group_idx,n_to_trim)
+                # batched over neurons: (neurons x shuffles x trials) @ (neurons x trials x time)
+                group_mean = np.matmul(weights,rasters_per_neuron)
+                Rmax.append(np.max(np.abs(group_mean),axis=2))
+            else:
+                weights = np.zeros((group_idx.shape[0],n_trials))
+                np.put_along_axis(weights,group_idx,1/n_group,axis=1)
+                group_mean = (weights @ rasters.reshape(n_trials,-1)).reshape(-1,n_neurons,n_bins)
+                Rmax.append(np.max(np.abs(group_mean),axis=2).T)
+
+        t_null[:,c:c+chunk_size] = Rmax[0]-Rmax[1]
+
+    t_obs = t_null[:,0].copy()
+
+    return t_obs,t_null
+
 class maxtest(): 
     def __init__(self):
 
@@ -175,9 +266,7 @@ class maxtest():
             t_on = event_times_dict[k]
             r = get_binned_rasters(spikes.times,spikes.clusters,clus_ids,t_on,**self.raster_kwargs)
             stim = r.rasters[:,:,r.tscale>=0]
-            t_obs = get_test_statistic(stim,blank,trim_fraction=trim_fraction,permute_seed=None)
-            t_null = [get_test_statistic(stim,blank,trim_fraction=trim_fraction,permute_seed=s)[:,np.newaxis] for s in range(n_shuffles)]
-            t_null = np.concatenate(t_null,axis=1)
+            t_obs,t_null = get_permuted_test_statistics(stim,blank,n_shuffles=n_shuffles,trim_fraction=trim_fraction)
             # implement plotting just to check
             if plotting: 
                 [ax[n,ev_idx].hist(t_null[n,:],bins=int(n_shuffles/20),alpha=.7,color='k') for n in range(n_neurons)]
@@ -188,7 +277,7 @@ class maxtest():
                     [ax[n,ev_idx].text(0,0,'%.0d' % subselect_neurons[n]) for n in range(n_neurons)]
 
 
-            p_values = np.array([(((t_null[n_idx,:]>t_obs_i).sum())/n_shuffles) for n_idx,t_obs_i in enumerate(t_obs)])
+            p_values = (t_null>t_obs[:,np.newaxis]).sum(axis=1)/n_shuffles
             p_value_per_event.append(p_values[:,np.newaxis])
 
         p_value_per_event = np.concatenate(p_value_per_event,axis=1)
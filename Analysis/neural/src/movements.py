@@ -1,11 +1,13 @@
 
 import sys
 import numpy as np
+from pathlib import Path
 import pandas as pd
 import scipy
 sys.path.insert(0, r"C:\Users\Flora\Documents\Github\PinkRigs") 
 from Admin.csv_queryExp import load_ephys_independent_probes,simplify_recdat,load_data
-from Analysis.neural.utils.spike_dat import bincount2D, cross_correlation
+from Analysis.neural.utils.spike_dat import cross_correlation
+from Analysis.neural.utils.spike_counts import get_spike_counts
 from Analysis.pyutils.batch_data import get_data_bunch
 
 
@@ -39,7 +41,8 @@ class movement_correlation():
 
         is_correlating = np.empty(clus_ids.size)
 
-        r,t_bins,clus = bincount2D(spikes.times,spikes.clusters,xbin=t_bin)
+        probe_folder = Path(recordings.expFolder) / 'ONE_preproc' / rec_info.get('probe','probe0')
+        r,t_bins,clus = get_spike_counts(spikes,t_bin,probe_folder=probe_folder).get()
 
         correlations = np.empty((len(self.vid_dat),r.shape[0]))
         is_correlated = np.zeros((clus_ids.size,1))
@@ -171,6 +171,7 @@ class rf_model():
             wherther to shuffle the square position that was onsetted (can be slow, because I recalculate averages, so don't do many)        
         selected_ids: None/list
             cluster IDs of neurons where response calculation is requested
+            (in 'per-depth' mode, MUA channel IDs or their 'shank-depth' labels)
         delay_for_vistrig: float
             time (in sec) to take the response fro relative to actual square onset (meant to account for the fact that visual responses are rather slow)
         cv_split: float 
@@ -183,12 +184,16 @@ class rf_model():
             all_cluster_ids = self.spikes.clusters
         elif mode == 'per-depth': 
             spikes_depths = bin_mua_per_depth(self.spikes,depth_spacing=60)            
-            all_cluster_ids = spikes_depths.shank_depth_ids
+            all_cluster_ids = spikes_depths.mua_ids
             
         if selected_ids is None:
             requsted_cluster_ids = np.unique(all_cluster_ids)
         else:
-            requsted_cluster_ids = selected_ids
+            requsted_cluster_ids = np.asarray(selected_ids)
+            if (mode=='per-depth') and (requsted_cluster_ids.dtype.kind in 'US'):
+                # translate labels to MUA channel IDs
+                label_to_id = {label:i for i,label in enumerate(spikes_depths.mua_labels)}
+                requsted_cluster_ids = np.array([label_to_id[label] for label in requsted_cluster_ids])
 
         if shuffle_seed is None: 
             xy_pos = self.xy_pos
@@ -221,6 +226,8 @@ class rf_model():
                                         'elevations':self.elevations,
                                         'azimuths':self.azimuths,
                                         'cv_number':range(cv_split)}) 
+        if mode=='per-depth':
+            responses = responses.assign_coords(mua_label=('neuronID',spikes_depths.mua_labels[requsted_cluster_ids]))
         
         return responses
         
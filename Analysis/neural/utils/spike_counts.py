@@ -0,0 +1,193 @@
+"""
+session-level clusters x time bins spike count matrices, shared across analyses
+
+The counts of a session are binned once per bin size (same binning as spike_dat.bincount2D),
+kept as a scipy.sparse.csr_matrix in memory, and saved next to the ONE folder
+(expFolder/ONE_preproc_cache/probeX), such that the next analysis of the session only loads them.
+The saved matrix is rebuilt whenever the spikes in the ONE folder change.
+
+"""
+import json
+import numpy as np
+from pathlib import Path
+from scipy import sparse
+
+from Admin.csv_queryExp import load_ONE_object
+from Admin.helpers.one_cache import get_source_signature
+from Analysis.neural.utils.spike_dat import smooth_causal
+
+# spike count matrices already built in this session, {(probe folder,t_bin):SpikeCountMatrix}
+_spike_counts = {}
+
+
+class SpikeCountMatrix():
+    """
+    sparse spike counts of a whole session
+
+    Parameters:
+    -----------
+    counts: scipy.sparse.csr_matrix
+        clusters x time bins
+    tscale: np.ndarray
+        start of each time bin
+    clusIDs: np.ndarray
+        cluster ID of each row
+    t_bin: float
+        bin size (s)
+    signature: None/list
+        of the spike files the counts were built from (see one_cache.get_source_signature)
+    """
+    def __init__(self,counts,tscale,clusIDs,t_bin,signature=None):
+        self.counts = counts
+        self.tscale = tscale
+        self.clusIDs = clusIDs
+        self.t_bin = t_bin
+        self.signature = signature
+
+    @classmethod
+    def from_spikes(cls,times,clusters,t_bin,signature=None):
+        """
+        bin the spikes as bincount2D(times,clusters,xbin=t_bin)
+        """
+        times,clusters = np.asarray(times),np.asarray(clusters)
+        t_min,t_max = np.min(times),np.max(times)
+        tscale = np.arange(t_min,t_max+t_bin/2,t_bin)
+        t_idx = np.floor((times-t_min)/t_bin).astype(np.int64)
+        clusIDs,clus_idx = np.unique(clusters,return_inverse=True)
+        counts = sparse.csr_matrix((np.ones(times.size,dtype=np.int32),(clus_idx,t_idx)),shape=(clusIDs.size,tscale.size))
+        return cls(counts,tscale,clusIDs,t_bin,signature=signature)
+
+    def save(self,path):
+        path = Path(path)
+        path.parent.mkdir(parents=True,exist_ok=True)
+        with open(path,'wb') as f:
+            np.savez(f,data=self.counts.data,indices=self.counts.indices,indptr=self.counts.indptr,
+                     shape=np.array(self.counts.shape),tscale=self.tscale,clusIDs=self.clusIDs,
+                     t_bin=self.t_bin,signature=json.dumps(self.signature))
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as f:
+            counts = sparse.csr_matrix((f['data'],f['indices'],f['indptr']),shape=tuple(f['shape']))
+            return cls(counts,f['tscale'],f['clusIDs'],float(f['t_bin']),signature=json.loads(str(f['signature'])))
+
+    def get(self,t_range=None,cluster_ids=None,bin_multiple=1,xsmoothing=0,dense=True):
+        """
+        spike counts of a period/set of clusters, optionally rebinned
+
+        Parameters:
+        -----------
+        t_range: None/list
+            [start,end] (s), time bins starting in this range are returned. If None, the whole session.
+        cluster_ids: None/np.ndarray
+            clusters (rows) to return, in this order. Clusters without spikes get rows of 0s. If None, all clusters.
+        bin_multiple: int
+            number of base bins summed into one bin (the last bin might be incomplete)
+        xsmoothing: float
+            sigma (s) of half-gaussian smoothing along time, as in bincount2D. Requires dense.
+        dense: bool
+            whether to return a np.ndarray, or the scipy.sparse.csr_matrix
+
+        Returns:
+        --------
+        : np.ndarray/scipy.sparse.csr_matrix
+            clusters x time bins
+        : np.ndarray
+            tscale
+        : np.ndarray
+            clusIDs
+        """
+        counts,tscale,clusIDs = self.counts,self.tscale,self.clusIDs
+
+        if t_range is not None:
+            i0 = np.searchsorted(tscale,t_range[0],side='left')
+            i1 = np.searchsorted(tscale,t_range[1],side='right')
+            counts,tscale = counts[:,i0:i1],tscale[i0:i1]
+
+        if cluster_ids is not None:
+            # selection matrix, such that missing clusters are rows of 0s
+            cluster_ids = np.asarray(cluster_ids)
+            row = np.searchsorted(clusIDs,cluster_ids)
+            row[row==clusIDs.size] = 0
+            is_present = clusIDs[row]==cluster_ids if clusIDs.size>0 else np.zeros(cluster_ids.size,dtype=bool)
+            select = sparse.csr_matrix((np.ones(is_present.sum(),dtype=counts.dtype),
+                                        (np.flatnonzero(is_present),row[is_present])),shape=(cluster_ids.size,clusIDs.size))
+            counts,clusIDs = (select @ counts).tocsr(),cluster_ids
+
+        if bin_multiple>1:
+            n_bins = tscale.size
+            rebin = sparse.csr_matrix((np.ones(n_bins,dtype=counts.dtype),(np.arange(n_bins),np.arange(n_bins)//bin_multiple)),
+                                      shape=(n_bins,int(np.ceil(n_bins/bin_multiple))))
+            counts,tscale = (counts @ rebin).tocsr(),tscale[::bin_multiple]
+
+        if dense:
+            counts = counts.toarray()
+            if xsmoothing>0:
+                counts = smooth_causal(counts,xsmoothing/(self.t_bin*bin_multiple),axis=1)
+
+        return counts,tscale,clusIDs
+
+
+def get_spike_counts_path(probe_folder,t_bin):
+    """
+    expFolder/ONE_preproc/probeX -> expFolder/ONE_preproc_cache/probeX/spikes.counts.<t_bin in us>us.npz
+    """
+    probe_folder = Path(probe_folder)
+    return probe_folder.parent.parent / 'ONE_preproc_cache' / probe_folder.name / ('spikes.counts.%dus.npz' % round(t_bin*1e6))
+
+def get_spike_counts(spikes=None,t_bin=0.01,probe_folder=None,refresh=False):
+    """
+    spike count matrix of a session, built once per bin size and shared across analyses
+
+    Parameters:
+    -----------
+    spikes: None/Bunch
+        with times and clusters. If None, these are loaded from probe_folder.
+        If probe_folder is given, these must be the unmodified ONE spikes of probe_folder (they are
+        only used to build the counts when they are not cached). Subselected spikes raise a ValueError,
+        for the counts of filtered spikes call with probe_folder=None.
+    t_bin: float
+        base bin size (s)
+    probe_folder: None/pathlib.Path
+        ONE folder of the probe (expFolder/ONE_preproc/probeX). If None, the counts are built from spikes and not cached.
+    refresh: bool
+        whether to rebuild the counts even if they are cached
+
+    Returns:
+    --------
+    SpikeCountMatrix
+    """
+    if probe_folder is None:
+        return SpikeCountMatrix.from_spikes(spikes.times,spikes.clusters,t_bin)
+
+    probe_folder = Path(probe_folder)
+    times_files = list(probe_folder.glob('spikes.times.*'))
+    signature = get_source_signature(times_files+list(probe_folder.glob('spikes.clusters.*')))
+    if (spikes is not None) and (len(times_files)>0):
+        # only the header of the ONE file is read
+        n_one_spikes = np.load(times_files[0],mmap_mode='r').shape[0]
+        if np.size(spikes.times)!=n_one_spikes:
+            raise ValueError('spikes (%d) are not the ONE spikes of %s (%d), pass probe_folder=None to count them.' 
+                             % (np.size(spikes.times),probe_folder,n_one_spikes))
+    key = (str(probe_folder),float(t_bin))
+    path = get_spike_counts_path(probe_folder,t_bin)
+
+    if not refresh:
+        if (key in _spike_counts) and (_spike_counts[key].signature==signature):
+            return _spike_counts[key]
+        if path.is_file():
+            counts = SpikeCountMatrix.load(path)
+            if counts.signature==signature:
+                _spike_counts[key] = counts
+                return counts
+
+    if spikes is None:
+        spikes = load_ONE_object(probe_folder,'spikes',attributes=['times','clusters'])
+    counts = SpikeCountMatrix.from_spikes(spikes.times,spikes.clusters,t_bin,signature=signature)
+    try:
+        counts.save(path)
+    except OSError as e:
+        print('spike counts could not be saved to %s: %s' % (path,e))
+    _spike_counts[key] = counts
+
+    return counts
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.signal import convolve, gaussian
+from scipy.ndimage import convolve1d
 from scipy.stats import zscore
 import warnings # just because of some pandas thing in 
 warnings.filterwarnings("ignore")
@@ -36,10 +36,7 @@ def get_binned_rasters(spike_times, spike_clusters, cluster_ids, align_times, ts
     :rtype: rasters: Bunch({'rasters': binned_spikes_, 'tscale': ts, 'cscale': ids})
     """
 
-    # initialize containers
-    
-
-     # compute floating tscale if not supplied - in this case smoothing can be requested
+    # compute floating tscale if not supplied - in this case smoothing can be requested
     if tscale[0]==None:
         n_offset = 5 * int(np.ceil(smoothing / bin_size))  # get rid of boundary effects for smoothing
         n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
@@ -56,17 +53,7 @@ def get_binned_rasters(spike_times, spike_clusters, cluster_ids, align_times, ts
         n_bins = tscale.size -1 # -1 as it represents bin edges?
         total_trange = [np.min(align_times),np.max(align_times)]
 
-    binned_spikes = np.zeros(shape=(len(align_times), len(cluster_ids), n_bins))
-
-    # build gaussian kernel if requested
-    if smoothing > 0:
-        w = n_bins - 1 if n_bins % 2 == 0 else n_bins
-        window = gaussian(w, std=smoothing / bin_size)
-        # half (causal) gaussian filter
-        window[:int(np.ceil(w/2))] = 0
-        window /= np.sum(window)
-        binned_spikes_conv = np.copy(binned_spikes)
-
+    align_times = np.asarray(align_times)
     ids = np.unique(cluster_ids)
 
     # filter spikes outside of the loop
@@ -76,65 +63,25 @@ def get_binned_rasters(spike_times, spike_clusters, cluster_ids, align_times, ts
     spike_times = spike_times[idxs]
     spike_clusters = spike_clusters[idxs]
 
-   
-    #determine whether tscale is even or uneven (different indexing)  
-    bin_sizes=np.diff(tscale)
-    unique_bin_size = np.unique((bin_sizes/bin_sizes[0]).round(decimals=1))*bin_sizes[0]
-    
-    # bin spikes
-    for i, t_0 in enumerate(align_times):
-        # define bin edges
-        ts = tscale + t_0
-        # filter spikes
-        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
-
-        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        xscale = ts
-        # if the bins are evenly spaced, one can just divide by bin size to get bin index
-        if unique_bin_size.size==1:     
-            xind = (np.floor((i_spikes - np.min(ts)) / bin_sizes[0])).astype(np.int64)
-        else: 
-            # if not then the binning is a bit more intensive 
-            
-            rel_spike_times = i_spikes - t_0
-            rel_spike_times = np.repeat(rel_spike_times[:,np.newaxis],tscale.size,axis=1)
-            # we subtract the bin edges and check which one is greater than 0 
-            # subtracting 1 because we start the indexing at 0 (1st bin edge only = 0th index)
-            xind  = (np.sum((rel_spike_times-tscale)>0,axis=1)-1).astype(np.int64)   
-
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
-
-        # store (ts represent bin edges, so there are one fewer bins)
-        bs_idxs = np.isin(ids, yscale)
-        binned_spikes[i, bs_idxs, :] = r[:, :-1]
-
-        # smooth
-        if smoothing > 0:
-            idxs = np.where(bs_idxs)[0]
-            for j in range(r.shape[0]):
-                binned_spikes_conv[i, idxs[j], :] = convolve(
-                    r[j, :], window, mode='same', method='auto')[:-1]
-
-    # average
+    # the trial windows are located with searchsorted, which requires sorted spike times
+    if np.any(np.diff(spike_times) < 0):
+        isort = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[isort]
+        spike_clusters = spike_clusters[isort]
+
+    binned_spikes = _bin_trial_windows(spike_times, np.searchsorted(ids, spike_clusters), align_times, tscale, ids.size)
+
+    # smooth with a half (causal) gaussian filter
     if smoothing > 0:
-        binned_spikes_ = np.copy(binned_spikes_conv)
-    else:
-        binned_spikes_ = np.copy(binned_spikes)
+        binned_spikes = smooth_causal(binned_spikes, smoothing / bin_size, axis=2, in_place=True)
 
+    bin_sizes = np.diff(tscale)
     if return_fr:
         # to account also for uneven binsizes
-        FRbins=np.repeat(np.repeat(bin_sizes[np.newaxis,np.newaxis,:],len(cluster_ids),axis=1),len(align_times),axis=0)
-        binned_spikes_ /= FRbins
-        #binned_spikes_ /= bin_size
-
+        binned_spikes /= bin_sizes[np.newaxis, np.newaxis, :]
 
     if smoothing > 0:
-         binned_spikes_ = binned_spikes_[:, :, n_offset:-n_offset]
+         binned_spikes = binned_spikes[:, :, n_offset:-n_offset]
          tscale = tscale[n_offset:-n_offset]
 
     # package output
@@ -142,16 +89,80 @@ def get_binned_rasters(spike_times, spike_clusters, cluster_ids, align_times, ts
 
     if baseline_subtract:
         # subtract the mean baseline (i.e. the mean before 0 on the tscale)
-        baseline = (binned_spikes_[:,:, tscale<0]).mean(axis=2)
-        baseline = np.tile(baseline[:,:,np.newaxis],binned_spikes_.shape[2])
-        binned_spikes_= binned_spikes_-baseline
+        baseline = (binned_spikes[:,:, tscale<0]).mean(axis=2)
+        binned_spikes = binned_spikes - baseline[:, :, np.newaxis]
 
-    rasters = Bunch({'rasters': binned_spikes_, 'tscale': tscale, 'cscale': ids})
+    rasters = Bunch({'rasters': binned_spikes, 'tscale': tscale, 'cscale': ids})
     
     return rasters
 
-def bin_spikes_pos_and_time(spikes,depth_corr_window_spacing=40,spike_binning_t=.01):
+def _bin_trial_windows(spike_times, spike_cluster_idx, align_times, tscale, n_clusters):
+    """
+    bin spikes into a (trials x clusters x bins) tensor in a single pass 
+
+    :param spike_times: sorted spike times (in seconds)
+    :param spike_cluster_idx: index of each spike's cluster along the 2nd dimension of the output
+    :param align_times: times (in seconds) the bin edges are relative to
+    :param tscale: bin edges (in seconds) relative to align times. Can be unevenly spaced.
+    :param n_clusters: size of the 2nd dimension of the output
+    :return: np.ndarray (trials x clusters x bins) of spike counts
+    """
+    n_trials, n_bins = align_times.size, tscale.size - 1
+
+    # locate every trial window (edges inclusive) in the sorted spike times
+    win_start = np.searchsorted(spike_times, tscale[0] + align_times, side='left')
+    win_end = np.searchsorted(spike_times, tscale[-1] + align_times, side='right')
+    n_spikes = np.maximum(win_end - win_start, 0)
+
+    # expand the windows into (trial, spike) index pairs. A spike is counted once for each window it falls into
+    trial_idx = np.repeat(np.arange(n_trials), n_spikes)
+    spike_idx = np.arange(trial_idx.size) - np.repeat(np.cumsum(n_spikes) - n_spikes - win_start, n_spikes)
+    t = spike_times[spike_idx]
+
+    #determine whether tscale is even or uneven (different indexing)  
+    bin_sizes = np.diff(tscale)
+    unique_bin_size = np.unique((bin_sizes/bin_sizes[0]).round(decimals=1))*bin_sizes[0]
+    if unique_bin_size.size==1:
+        # if the bins are evenly spaced, one can just divide by bin size to get bin index
+        xind = (np.floor((t - (tscale[0] + align_times)[trial_idx]) / bin_sizes[0])).astype(np.int64)
+    else:
+        # otherwise find the last bin edge that the spike is strictly later than
+        xind = np.maximum(np.searchsorted(tscale, t - align_times[trial_idx], side='left') - 1, 0)
+
+    # spikes that fall on the last edge are not part of any bin
+    is_binned = xind < n_bins
+    ind3d = (trial_idx[is_binned] * n_clusters + spike_cluster_idx[spike_idx[is_binned]]) * n_bins + xind[is_binned]
+    binned_spikes = np.bincount(ind3d, minlength=n_trials * n_clusters * n_bins).astype(np.float64)
 
+    return binned_spikes.reshape(n_trials, n_clusters, n_bins)
+
+def bin_spikes_pos_and_time(spikes,depth_corr_window_spacing=40,spike_binning_t=.01,dtype='float64',sparse=False,chunk_size=None):
+    """
+    bin the spikes per shank, depth and time in a single pass (one digitize step and a bincount on the 3D bin index)
+
+    Parameters:
+    -----------
+    spikes: Bunch
+        with times, depths and _av_shankIDs
+    depth_corr_window_spacing: float
+        size of the depth bins (um)
+    spike_binning_t: float
+        size of the time bins (s)
+    dtype: str
+        of the counts, e.g. 'int32' to halve the size of the output on long sessions
+    sparse: bool
+        whether to return the counts as a scipy.sparse.csr_matrix of (shank*depth) x time bins
+    chunk_size: None/int
+        number of time bins counted at once, to bound the size of the intermediate arrays. If None, all at once.
+
+    Returns:
+    --------
+    Bunch
+        array: np.ndarray (shank x depth x time bins) or scipy.sparse.csr_matrix
+        xposscale: shank bins
+        depthscale: lower edge of the depth bins
+        tscale: time bin edges
+    """
     depth_corr_window = 0 # MUA window in microns
     max_depths = 5760
 
@@ -160,32 +171,82 @@ def bin_spikes_pos_and_time(spikes,depth_corr_window_spacing=40,spike_binning_t=
     # also determine which shank things are on 
     shank_bins=np.arange(0,4,1) # unified for 4shank recordings.
     spike_binning_t_edges = np.arange(np.nanmin(spikes.times),np.nanmax(spikes.times)+spike_binning_t,spike_binning_t)
-    binned_spikes_depth = np.zeros((shank_bins.size,depth_corr_bins.size,spike_binning_t_edges.size-1));
-
-
-    for i in shank_bins:
-        for j in range(depth_corr_bins.size):
-            curr_depth_templates_idx = np.where((spikes._av_shankIDs==i) &                                                
-                                                (spikes.depths >= depth_corr_bins[j]) &
-                                                (spikes.depths < depth_corr_bins[j]+depth_corr_window_spacing))[0]
-
-            N=np.histogram(spikes.times[curr_depth_templates_idx],spike_binning_t_edges)    
-            binned_spikes_depth[i,j,:]=N[0]
+    n_locs,n_t = shank_bins.size*depth_corr_bins.size,spike_binning_t_edges.size-1
+
+    times,depths,shanks = np.asarray(spikes.times),np.asarray(spikes.depths),np.asarray(spikes._av_shankIDs)
+
+    # bin index of each spike. Time bins are as in np.histogram, i.e. the last bin includes its right edge
+    depth_idx = np.searchsorted(depth_corr_bins,depths,side='right')-1
+    t_idx = np.searchsorted(spike_binning_t_edges,times,side='right')-1
+    t_idx[times==spike_binning_t_edges[-1]] = n_t-1
+    is_binned = (np.isin(shanks,shank_bins) & (depth_idx>=0) &
+                 (depths<depth_corr_bins[-1]+depth_corr_window_spacing) &
+                 (t_idx>=0) & (t_idx<n_t))
+    loc_idx = shanks[is_binned].astype(np.int64)*depth_corr_bins.size+depth_idx[is_binned]
+    t_idx = t_idx[is_binned]
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        binned_spikes_depth = csr_matrix((np.ones(t_idx.size,dtype=dtype),(loc_idx,t_idx)),shape=(n_locs,n_t))
+    else:
+        if chunk_size is None:
+            chunk_size = max(n_t,1)
+        if np.any(np.diff(t_idx)<0):
+            isort = np.argsort(t_idx,kind='stable')
+            t_idx,loc_idx = t_idx[isort],loc_idx[isort]
+
+        binned_spikes_depth = np.zeros((n_locs,n_t),dtype=dtype)
+        for b0 in range(0,n_t,chunk_size):
+            b1 = min(b0+chunk_size,n_t)
+            s0,s1 = np.searchsorted(t_idx,[b0,b1])
+            ind2d = loc_idx[s0:s1]*(b1-b0)+t_idx[s0:s1]-b0
+            binned_spikes_depth[:,b0:b1] = np.bincount(ind2d,minlength=n_locs*(b1-b0)).reshape(n_locs,b1-b0)
+        binned_spikes_depth = binned_spikes_depth.reshape(shank_bins.size,depth_corr_bins.size,n_t)
 
-    
     return Bunch({'array': binned_spikes_depth,'xposscale':shank_bins,'depthscale':depth_corr_bins,'tscale':spike_binning_t_edges})
 
 def bin_mua_per_depth(spikes, depth_spacing = 40, depth_min = 0, depth_max = 5760):
-    
+    """
+    assign each spike to a shank x depth MUA channel
+
+    Parameters:
+    -----------
+    spikes: Bunch
+        with depths and _av_shankIDs
+    depth_spacing,depth_min,depth_max: float
+        depth bins (um)
+
+    Returns:
+    --------
+    Bunch
+        depth_ids: np.ndarray
+            depth bin of each spike (np.digitize on depth_bin_edges)
+        mua_ids: np.ndarray
+            integer MUA channel of each spike, shank*n_depths + depth_id
+        mua_labels: np.ndarray
+            'shank-depth' label of each MUA channel, i.e. mua_labels[mua_ids] is the label of each spike.
+            The depth is the lower bin edge, 'shank-<depth_min' for spikes below depth_min.
+        depth_bin_edges: np.ndarray
+        n_depths: int
+    """
     depth_bin_edges = np.arange(depth_min,depth_max,depth_spacing)            
     depth_ids = np.digitize(spikes.depths, bins=depth_bin_edges)            
-    # shank*depth ID strings so that units can be sorted based on that if necessary
-    shank_depth_ids = ['%.0d-%.0d' % (shank,depth_bin_edges[d_id-1]) for shank,d_id in zip(spikes._av_shankIDs,depth_ids)] 
+    # shank*depth integer IDs so that units can be sorted based on that if necessary
+    n_depths = depth_bin_edges.size+1
+    shanks = np.asarray(spikes._av_shankIDs).astype(np.int64)
+    mua_ids = shanks*n_depths + depth_ids
+
+    # labels are only formatted once per MUA channel
+    n_shanks = (shanks.max()+1) if shanks.size>0 else 0
+    depth_labels = ['<%d' % depth_min] + ['%.0d' % edge for edge in depth_bin_edges]
+    mua_labels = np.array(['%.0d-%s' % (shank,depth_labels[d_id]) for shank in range(n_shanks) for d_id in range(n_depths)])
 
     spikes_depthID = Bunch({
         'depth_ids':depth_ids,
-        'shank_depth_ids': np.array(shank_depth_ids),
-        'depth_bin_edges':depth_bin_edges
+        'mua_ids': mua_ids,
+        'mua_labels': mua_labels,
+        'depth_bin_edges':depth_bin_edges,
+        'n_depths':n_depths
               })
     # digitise depth bins
     return spikes_depthID
@@ -268,16 +329,44 @@ def bincount2D(x, y, xbin=0, ybin=0, xlim=None, ylim=None, weights=None,xsmoothi
         yscale = ybin
 
     if xsmoothing>0: 
-        w = xscale.size #[tscale.size - 1 if tscale.size % 2 == 0 else tscale.size]
-        window = gaussian(w, std=xsmoothing / xbin)
-        # half (causal) gaussian filter
-        window[:int(np.ceil(w/2))] = 0
-        window /= np.sum(window) # 
-        binned_spikes_conv = [convolve(r[j, :], window, mode='same', method='auto')[:,np.newaxis] for j in range(r.shape[0])]#[:-1]
-        r = np.concatenate(binned_spikes_conv,axis=1).T
+        r = smooth_causal(r.astype(np.float64), xsmoothing / xbin, axis=1, in_place=True)
 
     return r, xscale, yscale
 
+def smooth_causal(x, sigma, axis=-1, truncate=5, in_place=False):
+    """
+    smooth along one axis with a half (causal) gaussian filter, i.e. each bin becomes the gaussian-weighted sum of 
+    the preceding bins (lags 1 to truncate*sigma). The whole array is filtered in a single call.
+
+    Parameters:
+    -----------
+    x: np.ndarray
+        e.g. clusters x time bins or trials x clusters x time bins
+    sigma: float
+        sigma of the gaussian in bins
+    axis: int
+        time axis
+    truncate: float
+        the kernel is cut at this many sigmas
+    in_place: bool
+        whether to write the output into x (only if x is float), such that only one copy of the array is kept in memory
+
+    Returns:
+    --------
+    : np.ndarray
+        smoothed x (float)
+    """
+    n_lags = max(int(np.ceil(truncate * sigma)), 1)
+    # centred kernel with 0 weight on the current and future bins
+    weights = np.zeros(2 * n_lags + 1)
+    weights[n_lags + 1:] = np.exp(-0.5 * (np.arange(1, n_lags + 1) / sigma) ** 2)
+    weights /= np.sum(weights)
+
+    if x.dtype.kind != 'f':
+        x, in_place = x.astype(np.float64), True
+
+    return convolve1d(x, weights, axis=axis, mode='constant', cval=0., output=x if in_place else None)
+
 def cross_correlation(A, B, zscorea=True, zscoreb=True):
     '''Compute correlation for each column of A against
     every column of B (e.g. B is predictions).
@@ -306,8 +395,8 @@ class anatomy_plotter():
 
     """
     def __init__(self): 
-        from Processing.pyhist.helpers.atlas import AllenAtlas
-        self.atlas = AllenAtlas(25)
+        from Processing.pyhist.helpers.atlas import get_allen_atlas
+        self.atlas = get_allen_atlas(25)
     def plot_anat_canvas(self,ax,coord,axis='dv'):
         
         # just need some realistic numbers so that the ccf2xyz conversion works
@@ -2,16 +2,15 @@ import json,re,glob,sys,datetime
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from Processing.pyhist.helpers.atlas import AllenAtlas
+from Processing.pyhist.helpers.atlas import get_allen_atlas
 from shutil import copyfile
-atlas = AllenAtlas(25)
 
 # PinkRig specific imports 
 pinkRig_path= glob.glob(r'C:\Users\*\Documents\Github\PinkRigs')
 pinkRig_path = Path(pinkRig_path[0])
 sys.path.insert(0, (pinkRig_path.__str__()))
 from Processing.pykilo.ReadSGLXData.readSGLX import readMeta
-from Admin.csv_queryExp import load_data,get_recorded_channel_position
+from Admin.csv_queryExp import load_data,get_recorded_channel_position,Bunch
 
 
 def get_chan_coordinates(jsonFilePath):
@@ -55,6 +54,59 @@ def get_chan_coordinates(jsonFilePath):
     return chan_pos,allencoords_xyz,np.array(regionID),np.array(region_acronym)
 
 
+class CoordinateMatcher():
+    """
+    hashed lookup of the xy channel positions of an anatmap (target), 
+    such that the positions of many local channels/recordings are matched in a few vectorised lookups
+
+    The coordinates are keyed as x+iy complex numbers (sorted lexicographically by numpy), 
+    and each query is resolved with a searchsorted on the unique target keys.
+
+    Parameters:
+    -----------
+    target_coordinate_array: numpy ndarray, channel x 2
+        0th array: x pos
+        1st array y pos
+    """
+    # exact match, then to the left, to the right, one down, one up
+    offsets = [(0,0),(-32,0),(32,0),(0,-15),(0,15)]
+
+    def __init__(self,target_coordinate_array):
+        target_coordinate_array = np.asarray(target_coordinate_array)
+        self.nan_index = target_coordinate_array.shape[0]
+        target_keys = target_coordinate_array[:,0]+1j*target_coordinate_array[:,1]
+        self.keys,self.first_index,self.counts = np.unique(target_keys,return_index=True,return_counts=True)
+
+    def match(self,local_coordinate_array):
+        """
+        Parameters:
+        -----------
+        local_coordinate_array: numpy ndarray, channel x 2
+
+        Returns:
+        --------
+        : numpy ndarray
+            index of the target coordinate for each local coordinate, nan_index if there was no match
+        """
+        local_coordinate_array = np.asarray(local_coordinate_array)
+        local_x = local_coordinate_array[:,0]
+        local_y = local_coordinate_array[:,1]
+        chan_idx = np.full(local_x.size,self.nan_index,dtype='int64')
+        is_matched = np.zeros(local_x.size,dtype='bool')
+
+        if self.keys.size==0:
+            return chan_idx
+
+        for dx,dy in self.offsets:
+            query = (local_x+dx)+1j*(local_y+dy)
+            pos = np.minimum(np.searchsorted(self.keys,query),self.keys.size-1)
+            # only unambiguous (single) matches are accepted
+            is_hit = (self.keys[pos]==query) & (self.counts[pos]==1) & ~is_matched
+            chan_idx[is_hit] = self.first_index[pos[is_hit]]
+            is_matched |= is_hit
+
+        return chan_idx
+
 def coordinate_matching(local_coordinate_array,target_coordinate_array):
     """
     performs a coordinate matching bsed on xy positions using the channels.localCoordinates.npy output of the ibl format  
@@ -72,45 +124,13 @@ def coordinate_matching(local_coordinate_array,target_coordinate_array):
         must be equal to or longer than local coordinates. 
 
     Return: 
-    :list
+    :numpy ndarray
         indices of target_coordinate array that correspond to local coordinates.
         If there was no match, the index returned will be target_coordinate_array+1.
         (a hack with which I will take care if giving these outputs a NaN)
 
     """
-    local_x = local_coordinate_array[:,0]
-    local_y = local_coordinate_array[:,1]
-    target_x = target_coordinate_array[:,0]
-    target_y = target_coordinate_array[:,1]
-    nan_index = target_x.size 
-
-
-    chan_idx = []
-    for x,y in zip(local_x,local_y): 
-        idx = np.where((target_x==x) & (target_y==y))[0]
-        if idx.size==1: 
-            chan_idx.append(idx[0])
-        else: 
-            idx = np.where((target_x==x-32) & (target_y==y))[0]
-            if idx.size==1: 
-                chan_idx.append(idx[0])
-            else: 
-                idx = np.where((target_x==x+32) & (target_y==y))[0]
-                if idx.size==1: 
-                    chan_idx.append(idx[0])
-                else:
-                    idx = np.where((target_x==x) & (target_y==y-15))[0]
-                    if idx.size==1: 
-                        chan_idx.append(idx[0])
-                    else: 
-                        idx = np.where((target_x==x) & (target_y==y+15))[0]
-                        if idx.size==1: 
-                            chan_idx.append(idx[0])
-                        else: 
-                            chan_idx.append(nan_index)
-                            #print(x,y)
-
-    return chan_idx   
+    return CoordinateMatcher(target_coordinate_array).match(local_coordinate_array)
 
 def save_to_common_anatmap(one_path,probe,shank,botrow,date):
     ibl_format_path = open(list(one_path.glob('*.path.*.json'))[0],)
@@ -123,7 +143,36 @@ def save_to_common_anatmap(one_path,probe,shank,botrow,date):
         stub = 'channel_locations_%s_shank%.0d_botrow%.0d.json' % (probe,shank,botrow)
         copyfile(chanfile,(output_folder / stub))
 
-def save_out_cluster_location(one_path,anatmap_paths=None):
+def load_anatmap(anatmap_paths):
+    """
+    reads the channel locations of the anatmap recordings and builds their coordinate matcher
+
+    Parameters: 
+    -----------
+    anatmap_paths: list of pathlib.Path
+        of the channel_locations.json files of the anatmap
+
+    Returns: 
+    --------
+    Bunch
+        chan_pos,allen_xyz,region_ID,region_acronym (concatenated across anatmaps) and matcher
+    """
+    chan_pos, allen_xyz, region_ID, region_acronym = zip(
+    *[get_chan_coordinates(mypath) for mypath in anatmap_paths]
+    )
+    # concatenate the lists to arrays
+    chan_pos,allen_xyz = np.concatenate(chan_pos),np.concatenate(allen_xyz)
+    region_ID,region_acronym = np.concatenate(region_ID),np.concatenate(region_acronym) 
+
+    return Bunch({
+        'chan_pos':chan_pos,
+        'allen_xyz':allen_xyz,
+        'region_ID':region_ID,
+        'region_acronym':region_acronym,
+        'matcher':CoordinateMatcher(chan_pos)
+    })
+
+def save_out_cluster_location(one_path,anatmap_paths=None,anatmap=None):
     """
     function to save out anatomical location of clusters after the data has been alinged to the atlas using Mayo's tool
 
@@ -137,6 +186,8 @@ def save_out_cluster_location(one_path,anatmap_paths=None):
     ibl_format_path: pathlib.Path
     anatmap_paths: list of pathlib.Path
         of the ibl_format folders of the anatmap 
+    anatmap: None/Bunch
+        output of load_anatmap(anatmap_paths), when it is shared across recordings
     """
     # ibl_format_path
 
@@ -154,12 +205,10 @@ def save_out_cluster_location(one_path,anatmap_paths=None):
 
     if anatmap_paths:
         # here get the nearest sparseNoise recordings
-        chan_pos, allen_xyz, region_ID, region_acronym = zip(
-        *[get_chan_coordinates(mypath) for mypath in anatmap_paths]
-        )
-        # concatenate the lists to arrays
-        chan_pos,allen_xyz = np.concatenate(chan_pos),np.concatenate(allen_xyz)
-        region_ID,region_acronym = np.concatenate(region_ID),np.concatenate(region_acronym) 
+        if anatmap is None:
+            anatmap = load_anatmap(anatmap_paths)
+        chan_pos,allen_xyz = anatmap.chan_pos,anatmap.allen_xyz
+        region_ID,region_acronym = anatmap.region_ID,anatmap.region_acronym
 
         import matplotlib.pyplot as plt
         
@@ -170,7 +219,7 @@ def save_out_cluster_location(one_path,anatmap_paths=None):
         if chan_pos.shape[0]==384:
             pass
         else:
-            sel_idx = coordinate_matching(channel_localCoordinates,chan_pos)
+            sel_idx = anatmap.matcher.match(channel_localCoordinates)
 
             if np.max(sel_idx)==chan_pos.shape[0]: 
                 check_which = (sel_idx==np.max(sel_idx))
@@ -202,7 +251,7 @@ def save_out_cluster_location(one_path,anatmap_paths=None):
         allen_xyz_clus[region_ID_clus==0] = np.nan  # some units can be in "void" (I imagine mostly noise)
 
 
-        allencoords_ccf_apdvml = atlas.xyz2ccf(allen_xyz_clus/1e6,ccf_order='apdvml') 
+        allencoords_ccf_apdvml = get_allen_atlas(25).xyz2ccf(allen_xyz_clus/1e6,ccf_order='apdvml') 
         allencoords_ccf_mlapdv = allencoords_ccf_apdvml[:,0,[2,0,1]]                  
     # save the output
         np.save(one_path / ('clusters.brainLocationIds_ccf_2017.%s.npy' % stub),region_ID_clus)
@@ -211,6 +260,21 @@ def save_out_cluster_location(one_path,anatmap_paths=None):
     else:
         print('we could not match channels with posititons for %s' % one_path.__str__())  
 
+def save_out_cluster_locations(one_paths,anatmap_paths=None):
+    """
+    save_out_cluster_location for a batch of recordings that share their anatmap
+    (e.g. all recordings of a probe on the same day), such that the anatmap is read and hashed once
+
+    Parameters: 
+    -----------
+    one_paths: list of pathlib.Path
+    anatmap_paths: list of pathlib.Path
+        e.g. get_anatmap_path_same_day(one_paths[0])
+    """
+    anatmap = load_anatmap(anatmap_paths) if anatmap_paths else None
+    for one_path in one_paths:
+        save_out_cluster_location(one_path,anatmap_paths=anatmap_paths,anatmap=anatmap)
+
 def read_probeSN_from_folder(folderpath):
     """
     read meta file from parent folder the .ap.bin file is in 
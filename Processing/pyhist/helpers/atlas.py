@@ -9,6 +9,7 @@ import logging,os
 import matplotlib.pyplot as plt
 from pathlib import Path, PurePosixPath
 import numpy as np
+from scipy import sparse
 
 import urllib.parse
 from urllib.error import HTTPError
@@ -19,7 +20,7 @@ from Analysis.pyutils import hashfile
 import nrrd
 
 from Analysis.pyutils.numerical import ismember
-from Processing.pyhist.helpers.regions import BrainRegions
+from Processing.pyhist.helpers.regions import BrainRegions, get_brain_regions
 
 _logger = logging.getLogger(__name__)
 ALLEN_CCF_LANDMARKS_MLAPDV_UM = {'bregma': np.array([5739, 5400, 332])}
@@ -388,33 +389,50 @@ class BrainAtlas:
         """
         return self._lookup_inds(self.bc.xyz2i(xyz, mode=mode), mode=mode)
 
+    def _get_sphere_offsets(self, radius_um):
+        """
+        Volume index offsets of the voxels within a sphere around a voxel, computed once per radius
+        :param radius_um: radius of the sphere (um)
+        :return: [m, 3] array of index offsets in the mlapdv order
+        """
+        if not hasattr(self, '_sphere_offsets'):
+            self._sphere_offsets = {}
+        if radius_um not in self._sphere_offsets:
+            nr = [int(np.ceil(radius_um / abs(d) / 1e6)) for d in self.bc.dxyz]
+            offsets = np.stack(np.meshgrid(*[np.arange(-n, n + 1) for n in nr], indexing='ij'), axis=-1).reshape(-1, 3)
+            r = np.sqrt(np.sum((offsets * self.bc.dxyz) ** 2, axis=1)) * 1e6
+            self._sphere_offsets[radius_um] = offsets[r <= radius_um]
+        return self._sphere_offsets[radius_um]
+
     def get_labels(self, xyz, mapping=None, radius_um=None, mode='raise'):
         """
         Performs a 3D lookup from real world coordinates to the volume labels
         and return the regions ids according to the mapping
         :param xyz: [n, 3] array of coordinates
         :param mapping: brain region mapping (defaults to original Allen mapping)
-        :param radius_um: if not null, returns a regions ids array and an array of proportion
-         of regions in a sphere of size radius around the coordinates.
+        :param radius_um: if not null, returns a regions ids array and the proportion of each
+         region in a sphere of size radius around the coordinates. For a single coordinate [3],
+         the proportions are an array, for [n, 3] coordinates, a scipy.sparse.csr_matrix of
+         n x region ids. Voxels of the sphere outside of the volume are ignored.
         :return: n array of region ids
         """
         mapping = mapping or self.regions.default_mapping
 
         if radius_um:
-            nrx = int(np.ceil(radius_um / abs(self.bc.dx) / 1e6))
-            nry = int(np.ceil(radius_um / abs(self.bc.dy) / 1e6))
-            nrz = int(np.ceil(radius_um / abs(self.bc.dz) / 1e6))
-            nr = [nrx, nry, nrz]
-            iii = self.bc.xyz2i(xyz)
-            # computing the cube radius and indices is more complicated as volume indices are not
-            # necessariy in ml, ap, dv order so the indices order is dynamic
-            rcube = np.meshgrid(*tuple((np.arange(
-                -nr[i], nr[i] + 1) * self.bc.dxyz[i]) ** 2 for i in self.xyz2dims))
-            rcube = np.sqrt(rcube[0] + rcube[1], rcube[2]) * 1e6
-            icube = tuple(slice(-nr[i] + iii[i], nr[i] + iii[i] + 1) for i in self.xyz2dims)
-            cube = self.regions.mappings[mapping][self.label[icube]]
-            ilabs, counts = np.unique(cube[rcube <= radius_um], return_counts=True)
-            return self.regions.id[ilabs], counts / np.sum(counts)
+            xyz = np.asarray(xyz)
+            ixyz = np.atleast_2d(self.bc.xyz2i(xyz, mode=mode))
+            n = ixyz.shape[0]
+            # all voxels of all spheres, [n, m, 3]
+            ixyz = ixyz[:, np.newaxis, :] + self._get_sphere_offsets(radius_um)[np.newaxis, :, :]
+            is_in = np.all((ixyz >= 0) & (ixyz < self.bc.nxyz), axis=-1)
+            ipoint = np.nonzero(is_in)[0]
+            ilabs = self._get_mapping(mapping=mapping)[self.label.flat[self._lookup_inds(ixyz[is_in])]]
+            ilabs, icol = np.unique(ilabs, return_inverse=True)
+            counts = sparse.csr_matrix((np.ones(ipoint.size), (ipoint, icol.ravel())), shape=(n, ilabs.size))
+            proportions = sparse.diags(1 / np.maximum(counts.sum(axis=1).A1, 1)) @ counts
+            if xyz.ndim == 1:
+                return self.regions.id[ilabs], proportions.toarray()[0]
+            return self.regions.id[ilabs], proportions.tocsr()
         else:
             regions_indices = self._get_mapping(mapping=mapping)[self.label.flat[self._lookup(xyz, mode=mode)]]
             return self.regions.id[regions_indices]
@@ -902,7 +920,7 @@ class AllenAtlas(BrainAtlas):
 
         FLAT_IRON_ATLAS_REL_PATH = PurePosixPath('histology', 'ATLAS', 'Needles', 'Allen')
         LUT_VERSION = "v01"  # version 01 is the lateralized version
-        regions = BrainRegions()
+        regions = get_brain_regions()
         xyz2dims = np.array([1, 0, 2])  # this is the c-contiguous ordering
         dims2xyz = np.array([1, 0, 2])
         # we use Bregma as the origin
@@ -921,7 +939,11 @@ class AllenAtlas(BrainAtlas):
             file_label = path_atlas.joinpath(f'annotation_{res_um}.nrrd')
             if not file_label.exists():
                 print('file labels not downloaded.')
-            file_label_remap = path_atlas.joinpath(f'annotation_{res_um}_lut_{LUT_VERSION}.npz')
+            # the remapped labels are kept as an uncompressed .npy, that is memory-mapped rather than decompressed on each load
+            file_label_remap = path_atlas.joinpath(f'annotation_{res_um}_lut_{LUT_VERSION}.npy')
+            file_label_remap_npz = file_label_remap.with_suffix('.npz')
+            if not file_label_remap.exists() and file_label_remap_npz.exists():
+                np.save(file_label_remap, self._read_volume(file_label_remap_npz))
             if not file_label_remap.exists():
                 label = self._read_volume(file_label).astype(dtype=np.int32)
                 _logger.info("computing brain atlas annotations lookup table")
@@ -943,11 +965,10 @@ class AllenAtlas(BrainAtlas):
                             break
                         first += ncols
                     label = label.astype(dtype=np.uint16)
-                    _logger.info("Saving npz, this can take a long time")
                 else:
                     _, im = ismember(label, regions.id)
                     label = np.reshape(im.astype(np.uint16), label.shape)
-                np.savez_compressed(file_label_remap, label)
+                np.save(file_label_remap, label)
                 _logger.info(f"Cached remapping file {file_label_remap} ...")
             # loads the files
             label = self._read_volume(file_label_remap)
@@ -964,6 +985,8 @@ class AllenAtlas(BrainAtlas):
             volume = np.transpose(volume, (2, 0, 1))  # image[iap, iml, idv]
         elif file_volume.suffix == '.npz':
             volume = np.load(file_volume)['arr_0']
+        elif file_volume.suffix == '.npy':
+            volume = np.load(file_volume, mmap_mode='r')
         return volume
 
     def xyz2ccf(self, xyz, ccf_order='mlapdv', mode='raise'):
@@ -1018,3 +1041,15 @@ class AllenAtlas(BrainAtlas):
             ValueError("ccf_order needs to be either 'mlapdv' or 'apdvml'")
 
 
+# atlases already loaded in this process, {res_um:AllenAtlas}
+_atlases = {}
+
+def get_allen_atlas(res_um=25):
+    """
+    Returns the AllenAtlas at res_um, which is loaded on the first call and shared afterwards
+    :param res_um: 10, 25 or 50 um
+    :return: AllenAtlas
+    """
+    if res_um not in _atlases:
+        _atlases[res_um] = AllenAtlas(res_um)
+    return _atlases[res_um]
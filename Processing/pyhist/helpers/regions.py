@@ -51,6 +51,43 @@ class _BrainRegions:
             b[k] = self.__getattribute__(k)[iself[uind]]
         return b
 
+    def _get_tree_index(self):
+        """
+        Euler tour (pre-order) of the region tree, built on first use. The descendants of region i
+        (incl. i) are the regions j with tin[i] <= tin[j] < tout[i], such that ancestor/descendant queries
+        for many regions are interval tests
+        :return: Bunch with iparent (-1 for roots), tin, tout and depth (0 for roots) of each region
+        """
+        if hasattr(self, '_tree_index'):
+            return self._tree_index
+        n_regions = self.id.size
+        pmask, i_p = ismember(self.parent, self.id)
+        iparent = np.full(n_regions, -1, dtype=np.int64)
+        iparent[pmask] = i_p
+        children = [[] for _ in range(n_regions)]
+        for i, p in enumerate(iparent.tolist()):
+            if p >= 0:
+                children[p].append(i)
+        # pre-order traversal
+        order, depth = [], np.zeros(n_regions, dtype=np.int64)
+        stack = list(np.flipud(np.where(iparent < 0)[0]))
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            for c in reversed(children[i]):
+                depth[c] = depth[i] + 1
+                stack.append(c)
+        order = np.array(order, dtype=np.int64)
+        tin = np.zeros(n_regions, dtype=np.int64)
+        tin[order] = np.arange(order.size)
+        # subtree sizes, accumulated from the leaves up
+        size = np.ones(n_regions, dtype=np.int64)
+        for i in order[::-1].tolist():
+            if iparent[i] >= 0:
+                size[iparent[i]] += size[i]
+        self._tree_index = Bunch({'iparent': iparent, 'tin': tin, 'tout': tin + size, 'depth': depth})
+        return self._tree_index
+
     def _navigate_tree(self, ids, direction='down', return_indices=False):
         """
         Private method to navigate the tree and get all related objects either up, down or along the branch.
@@ -61,19 +98,20 @@ class _BrainRegions:
         to the current br object
         :return: Bunch
         """
-        indices = ismember(self.id, ids)[0]
-        count = np.sum(indices)
-        while True:
-            if direction == 'down':
-                indices |= ismember(self.parent, self.id[indices])[0]
-            elif direction == 'up':
-                indices |= ismember(self.id, self.parent[indices])[0]
-            else:
-                raise ValueError("direction should be either 'up' or 'down'")
-            if count == np.sum(indices):  # last iteration didn't find any match
-                break
-            else:
-                count = np.sum(indices)
+        tree = self._get_tree_index()
+        isel = np.where(ismember(self.id, ids)[0])[0]
+        if direction == 'down':
+            # regions whose entry time falls in any of the selected intervals
+            cover = np.zeros(self.id.size + 1, dtype=np.int64)
+            np.add.at(cover, tree.tin[isel], 1)
+            np.add.at(cover, tree.tout[isel], -1)
+            indices = (np.cumsum(cover)[:-1] > 0)[tree.tin]
+        elif direction == 'up':
+            # regions whose interval contains any of the selected regions
+            tin_sel = np.sort(tree.tin[isel])
+            indices = np.searchsorted(tin_sel, tree.tout) > np.searchsorted(tin_sel, tree.tin)
+        else:
+            raise ValueError("direction should be either 'up' or 'down'")
         if return_indices:
             return self.get(self.id[indices]), np.where(indices)[0]
         else:
@@ -156,15 +194,16 @@ class _BrainRegions:
             "All mapping ids should be represented in the Allen ids"
         # with the lateralization, self.id may have duplicate values so ismember is necessary
         iid, inm = ismember(self.id, new_map)
-        iid = np.where(iid)[0]
-        mapind = np.zeros_like(self.id) + I_ROOT  # non assigned regions are root
+        # each region is assigned to its closest ancestor (incl. itself) in the list, going down the tree
+        # one depth at a time. Non assigned regions are root
         # TO DO should root be lateralised?
-        mapind[iid] = iid  # regions present in the list have the same index
-        # Starting by the higher up levels in the hierarchy, assign all descendants to the mapping
-        for i in np.argsort(self.level[iid]):
-            descendants = self.descendants(self.id[iid[i]]).id
-            _, idesc, _ = np.intersect1d(self.id, descendants, return_indices=True)
-            mapind[idesc] = iid[i]
+        tree = self._get_tree_index()
+        mapind = np.zeros_like(self.id) + I_ROOT
+        for depth in range(tree.depth.max() + 1):
+            isel = np.where(tree.depth == depth)[0]
+            iparent = tree.iparent[isel]
+            inherited = np.where(iparent >= 0, mapind[np.maximum(iparent, 0)], I_ROOT)
+            mapind[isel] = np.where(iid[isel], isel, inherited)
         mapind[0] = I_VOID  # void stays void
         # to delateralize the regions, assign the positive index to all mapind elements
         if lateralize is False:
@@ -172,6 +211,22 @@ class _BrainRegions:
             mapind = mapind[iregion]
         return mapind
 
+    def add_mapping(self, name, regions, lateralize=False):
+        """
+        Adds a custom mapping (e.g. an ad-hoc grouping of regions) to self.mappings: each region is
+        mapped onto its closest ancestor in the list of regions (root otherwise)
+        :param name: mapping name, to be used as e.g. acronym2acronym(acronyms, mapping=name)
+        :param regions: list or array of acronyms or ids
+        :param lateralize: whether to keep the hemispheres apart
+        :return:
+        """
+        region_ids = np.abs(self.parse_acronyms_argument(regions))
+        self.mappings[name] = self._mapping_from_regions_list(region_ids, lateralize=lateralize)
+        # drop the lookups of a former mapping with the same name
+        for cache in [getattr(self, '_index_lookups', {}), getattr(self, '_group_indices', {})]:
+            for key in [k for k in cache if k[1] == name]:
+                cache.pop(key)
+
     def acronym2acronym(self, acronym, mapping=None):
         """
         Remap acronyms onto mapping
@@ -180,8 +235,8 @@ class _BrainRegions:
         :return: array of remapped acronyms
         """
         mapping = mapping or self.default_mapping
-        inds = self._find_inds(acronym, self.acronym)
-        return self.acronym[self.mappings[mapping]][inds]
+        inds = self._find_inds(acronym, 'acronym')
+        return self.acronym[np.take(self.mappings[mapping], inds)]
 
     def acronym2id(self, acronym, mapping=None, hemisphere=None):
         """
@@ -192,7 +247,7 @@ class _BrainRegions:
         :return: array of remapped atlas ids
         """
         mapping = mapping or self.default_mapping
-        inds = self._find_inds(acronym, self.acronym)
+        inds = self._find_inds(acronym, 'acronym')
         return self.id[self.mappings[mapping]][self._filter_lr(inds, mapping, hemisphere)]
 
     def acronym2index(self, acronym, mapping=None, hemisphere=None):
@@ -205,10 +260,8 @@ class _BrainRegions:
         """
         mapping = mapping or self.default_mapping
         acronym = self.acronym2acronym(acronym, mapping=mapping)
-        index = list()
-        for id in acronym:
-            inds = np.where(self.acronym[self.mappings[mapping]] == id)[0]
-            index.append(self._filter_lr_index(inds, hemisphere))
+        groups = self._get_group_indices('acronym', mapping)
+        index = [self._filter_lr_index(groups[id], hemisphere) for id in acronym.tolist()]
 
         return acronym, index
 
@@ -220,8 +273,8 @@ class _BrainRegions:
         :return: array of remapped acronyms
         """
         mapping = mapping or self.default_mapping
-        inds = self._find_inds(atlas_id, self.id)
-        return self.acronym[self.mappings[mapping]][inds]
+        inds = self._find_inds(atlas_id, 'id')
+        return self.acronym[np.take(self.mappings[mapping], inds)]
 
     def id2id(self, atlas_id, mapping='Allen'):
         """
@@ -231,8 +284,8 @@ class _BrainRegions:
         :return: array of remapped atlas ids
         """
 
-        inds = self._find_inds(atlas_id, self.id)
-        return self.id[self.mappings[mapping]][inds]
+        inds = self._find_inds(atlas_id, 'id')
+        return self.id[np.take(self.mappings[mapping], inds)]
 
     def id2index(self, atlas_id, mapping='Allen'):
         """
@@ -243,10 +296,8 @@ class _BrainRegions:
         """
 
         atlas_id = self.id2id(atlas_id, mapping=mapping)
-        index = list()
-        for id in atlas_id:
-            inds = np.where(self.id[self.mappings[mapping]] == id)[0]
-            index.append(inds)
+        groups = self._get_group_indices('id', mapping)
+        index = [groups[id] for id in atlas_id.tolist()]
 
         return atlas_id, index
 
@@ -305,12 +356,70 @@ class _BrainRegions:
         else:
             return values
 
-    def _find_inds(self, values, all_values):
-        if not isinstance(values, list) and not isinstance(values, np.ndarray):
+    def _get_index_lookup(self, field, mapping=None):
+        """
+        Hash map {value: first index} of self.id or self.acronym (remapped onto mapping if given),
+        built on first use
+        :param field: 'id' or 'acronym'
+        :param mapping: None or mapping name
+        :return: dict
+        """
+        if not hasattr(self, '_index_lookups'):
+            self._index_lookups = {}
+        key = (field, mapping)
+        if key not in self._index_lookups:
+            values = self.__getattribute__(field)
+            if mapping is not None:
+                values = values[self.mappings[mapping]]
+            lookup = {}
+            for i, v in enumerate(values.tolist()):
+                lookup.setdefault(v, i)
+            self._index_lookups[key] = lookup
+        return self._index_lookups[key]
+
+    def _get_group_indices(self, field, mapping):
+        """
+        Hash map {value: indices} of the remapped self.id or self.acronym, i.e. np.where(values == value)[0]
+        for each value, built on first use
+        """
+        if not hasattr(self, '_group_indices'):
+            self._group_indices = {}
+        key = (field, mapping)
+        if key not in self._group_indices:
+            codes, uniques = pd.factorize(self.__getattribute__(field)[self.mappings[mapping]])
+            isort = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[isort], np.arange(uniques.size + 1))
+            self._group_indices[key] = {v: isort[bounds[i]:bounds[i + 1]] for i, v in enumerate(uniques.tolist())}
+        return self._group_indices[key]
+
+    def _find_inds(self, values, field, mapping=None):
+        """
+        Indices of values in self.id or self.acronym (first occurrence), values that are not found are dropped.
+        The values are factorised such that each distinct value is looked up once.
+        :param values: scalar, list or array of ids/acronyms
+        :param field: 'id' or 'acronym'
+        :param mapping: None or mapping name, to look the values up in the remapped field
+        :return: np.array of indices
+        """
+        if not isinstance(values, (list, np.ndarray, pd.Series)):
             values = np.array([values])
-        _, inds = ismember(np.array(values), all_values)
+        codes, uniques = pd.factorize(np.asarray(values).ravel())
+        lookup = self._get_index_lookup(field, mapping=mapping)
+        uinds = np.array([lookup.get(v, -1) for v in uniques.tolist()] + [-1], dtype=np.int64)
+        inds = uinds[codes]  # code -1 (missing values) takes the last element
+        return inds[inds >= 0]
 
-        return inds
+    def remap(self, region_ids, source_map='Allen', target_map='Beryl'):
+        """
+        Remap atlas regions ids from source map to target map. Use the -lr mappings to keep
+        the hemisphere (sign) of the ids.
+        :param region_ids: atlas ids to map
+        :param source_map: map name which original region_ids are in
+        :param target_map: map name onto which to map
+        :return:
+        """
+        inds = self._find_inds(region_ids, 'id', mapping=source_map)
+        return self.id[np.take(self.mappings[target_map], inds)]
 
     def parse_acronyms_argument(self, acronyms, mode='raise'):
         """
@@ -485,16 +594,18 @@ class BrainRegions(_BrainRegions):
             self.hierarchy[lev, sel] = np.where(sel)[0]
             _mask[sel] = True
 
-    def remap(self, region_ids, source_map='Allen', target_map='Beryl'):
-        """
-        Remap atlas regions ids from source map to target map
-        :param region_ids: atlas ids to map
-        :param source_map: map name which original region_ids are in
-        :param target_map: map name onto which to map
-        :return:
-        """
-        _, inds = ismember(region_ids, self.id[self.mappings[source_map]])
-        return self.id[self.mappings[target_map][inds]]
+
+_brain_regions = None
+
+def get_brain_regions():
+    """
+    Returns the BrainRegions of the process, which is read on the first call and shared afterwards
+    :return: BrainRegions object
+    """
+    global _brain_regions
+    if _brain_regions is None:
+        _brain_regions = BrainRegions()
+    return _brain_regions
 
 
 def regions_from_allen_csv():
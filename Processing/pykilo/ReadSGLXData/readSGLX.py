@@ -20,6 +20,9 @@ much easier!
 import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy.signal import butter, sosfiltfilt
 from tkinter import Tk
 from tkinter import filedialog
 
@@ -184,21 +187,23 @@ def ChanGainsIM(meta):
 # [2,6,20]  just these three channels (zero based, as they appear in SGLX).
 #
 def GainCorrectNI(dataArray, chanList, meta):
+    # make array of floats to return. dataArray contains only the channels
+    # in chanList, so output matches that shape
+    convArray = dataArray * GainFactorsNI(chanList, meta)[:, np.newaxis]
+    return(convArray)
+
+
+# Return the factors converting the saved nidq channels in chanList to
+# gain-corrected voltage.
+#
+def GainFactorsNI(chanList, meta):
     MN, MA, XA, DW = ChannelCountsNI(meta)
     fI2V = Int2Volts(meta)
     # print statements used for testing...
     # print("NI fI2V: %.3e" % (fI2V))
     # print("NI ChanGainNI: %.3f" % (ChanGainNI(0, MN, MA, meta)))
-
-    # make array of floats to return. dataArray contains only the channels
-    # in chanList, so output matches that shape
-    convArray = np.zeros(dataArray.shape, dtype=float)
-    for i in range(0, len(chanList)):
-        j = chanList[i]             # index into timepoint
-        conv = fI2V/ChanGainNI(j, MN, MA, meta)
-        # dataArray contains only the channels in chanList
-        convArray[i, :] = dataArray[i, :] * conv
-    return(convArray)
+    conv = np.array([fI2V/ChanGainNI(j, MN, MA, meta) for j in chanList])
+    return(conv)
 
 
 # Having accessed a block of raw imec data using makeMemMapRaw, convert
@@ -212,6 +217,16 @@ def GainCorrectNI(dataArray, chanList, meta):
 # OriginalChans) will be in the range 384-767 for a standard 3A or 3B probe.
 #
 def GainCorrectIM(dataArray, chanList, meta):
+    # make array of floats to return. dataArray contains only the channels
+    # in chanList, so output matches that shape
+    convArray = dataArray * GainFactorsIM(chanList, meta)[:, np.newaxis]
+    return(convArray)
+
+
+# Return the factors converting the saved imec channels in chanList to
+# gain-corrected voltage (1 for the sync channel).
+#
+def GainFactorsIM(chanList, meta):
     # Look up gain with acquired channel ID
     chans = OriginalChans(meta)
     APgain, LFgain = ChanGainsIM(meta)
@@ -221,21 +236,13 @@ def GainCorrectIM(dataArray, chanList, meta):
     # Common conversion factor
     fI2V = Int2Volts(meta)
 
-    # make array of floats to return. dataArray contains only the channels
-    # in chanList, so output matches that shape
-    convArray = np.zeros(dataArray.shape, dtype='float')
-    for i in range(0, len(chanList)):
-        j = chanList[i]     # index into timepoint
-        k = chans[j]        # acquisition index
-        if k < nAP:
-            conv = fI2V / APgain[k]
-        elif k < nNu:
-            conv = fI2V / LFgain[k - nAP]
-        else:
-            conv = 1
-        # The dataArray contains only the channels in chanList
-        convArray[i, :] = dataArray[i, :]*conv
-    return(convArray)
+    k = chans[np.asarray(chanList, dtype=int)]     # acquisition index
+    isAP = k < nAP
+    isLF = (k >= nAP) & (k < nNu)
+    conv = np.ones(k.size)
+    conv[isAP] = fI2V / APgain[k[isAP]]
+    conv[isLF] = fI2V / LFgain[k[isLF] - nAP]
+    return(conv)
 
 
 def makeMemMapRaw(binFullPath, meta):
@@ -247,6 +254,25 @@ def makeMemMapRaw(binFullPath, meta):
     return(rawData)
 
 
+# Return the saved channel index of the digital word dwReq, or None if
+# the word is not in the file.
+#
+def DigitalChannel(dwReq, meta):
+    if meta['typeThis'] == 'imec':
+        AP, LF, SY = ChannelCountsIM(meta)
+        if SY == 0:
+            print("No imec sync channel saved.")
+            return(None)
+        digCh = AP + LF + dwReq
+    else:
+        MN, MA, XA, DW = ChannelCountsNI(meta)
+        if dwReq > DW-1:
+            print("Maximum digital word in file = %d" % (DW-1))
+            return(None)
+        digCh = MN + MA + XA + dwReq
+    return(digCh)
+
+
 # Return an array [lines X timepoints] of uint8 values for a
 # specified set of digital lines.
 #
@@ -257,22 +283,10 @@ def makeMemMapRaw(binFullPath, meta):
 #
 def ExtractDigital(rawData, firstSamp, lastSamp, dwReq, dLineList, meta):
     # Get channel index of requested digital word dwReq
-    if meta['typeThis'] == 'imec':
-        AP, LF, SY = ChannelCountsIM(meta)
-        if SY == 0:
-            print("No imec sync channel saved.")
-            digArray = np.zeros((0), 'uint8')
-            return(digArray)
-        else:
-            digCh = AP + LF + dwReq
-    else:
-        MN, MA, XA, DW = ChannelCountsNI(meta)
-        if dwReq > DW-1:
-            print("Maximum digital word in file = %d" % (DW-1))
-            digArray = np.zeros((0), 'uint8')
-            return(digArray)
-        else:
-            digCh = MN + MA + XA + dwReq
+    digCh = DigitalChannel(dwReq, meta)
+    if digCh is None:
+        digArray = np.zeros((0), 'uint8')
+        return(digArray)
 
     selectData = np.ascontiguousarray(rawData[digCh, firstSamp:lastSamp+1], 'int16')
     nSamp = lastSamp-firstSamp + 1
@@ -292,6 +306,203 @@ def ExtractDigital(rawData, firstSamp, lastSamp, dwReq, dLineList, meta):
     return(digArray)
 
 
+# Open a binary file for reading. Plain .bin files are memory mapped,
+# mtscomp compressed .cbin files (with the .ch file next to them) are
+# decompressed on the fly. Either way, the returned object is sliced as
+# rawData[firstSamp:lastSamp] and returns [timepoints X channels] int16,
+# i.e. the transpose of makeMemMapRaw.
+#
+def makeRawReader(binFullPath, meta):
+    binFullPath = Path(binFullPath)
+    if binFullPath.suffix == '.cbin':
+        from mtscomp import Reader
+        rawData = Reader()
+        rawData.open(binFullPath, binFullPath.with_suffix('.ch'))
+    else:
+        rawData = makeMemMapRaw(binFullPath, meta).T
+    return(rawData)
+
+
+# Read a stretch of saved channels [chanList] from rawData (made by
+# makeRawReader) and return it as gain-corrected [channels X timepoints]
+# voltages. firstSamp:lastSamp is a half-open range here.
+#
+# - car: subtract the median across chanList at each timepoint.
+# - carChans: rows (indices into chanList) the median is taken over and
+#    subtracted from (default: all), e.g. to leave out the sync channel.
+# - hpSos: second order sections of the high-pass filter, applied
+#    forward-backward along time.
+#
+def ReadConvertedChunk(rawData, firstSamp, lastSamp, chanList, conv,
+                       car=False, carChans=None, hpSos=None, dtype='float32'):
+    selectData = rawData[firstSamp:lastSamp]
+    selectData = selectData[:, chanList]
+    convArray = selectData.T.astype(dtype)
+    convArray *= conv.astype(dtype)[:, np.newaxis]
+    if car:
+        if carChans is None:
+            convArray -= np.median(convArray, axis=0)[np.newaxis, :]
+        elif len(carChans) > 0:
+            convArray[carChans] -= np.median(convArray[carChans], axis=0)[np.newaxis, :]
+    if hpSos is not None:
+        convArray = sosfiltfilt(hpSos, convArray, axis=1).astype(dtype)
+    return(convArray)
+
+
+# Stream gain-corrected [channels X timepoints] chunks of a .bin or .cbin
+# file, so long recordings can be scanned without loading them into RAM.
+# Chunks are read, decoded and filtered on a pool of nThreads threads,
+# a few chunks ahead of the one being yielded, and are yielded in order
+# as (chunkFirstSamp, convArray).
+#
+# - chanList: saved channel indices (default: all saved channels).
+# - car: common average reference, over the neural (AP/LF for imec, analog
+#    for nidq) channels of chanList only; the sync/digital channels are
+#    left untouched.
+# - chunkSize: number of timepoints per chunk.
+# - overlap: number of timepoints read on either side of each chunk, such
+#    that CAR and filtering do not suffer from edge effects. The padding is
+#    trimmed again, unless returnPadded, in which case chunkFirstSamp is the
+#    first padded timepoint.
+# - firstSamp, lastSamp: zero-based range of timepoints (lastSamp included
+#    as in ExtractDigital; default: the end of the file).
+# - highPass: cutoff (Hz) of a 3rd order butterworth high-pass, or None.
+#
+def StreamChunks(binFullPath, chanList=None, chunkSize=30000, overlap=0,
+                 firstSamp=0, lastSamp=None, car=False, highPass=None,
+                 nThreads=4, returnPadded=False, dtype='float32'):
+    binFullPath = Path(binFullPath)
+    meta = readMeta(binFullPath)
+    rawData = makeRawReader(binFullPath, meta)
+    nFileSamp = rawData.shape[0]
+
+    if chanList is None:
+        chanList = np.arange(rawData.shape[1])
+    chanList = np.asarray(chanList)
+    if meta['typeThis'] == 'imec':
+        conv = GainFactorsIM(chanList, meta)
+        AP, LF, SY = ChannelCountsIM(meta)
+        nNeural = AP + LF
+    else:
+        conv = GainFactorsNI(chanList, meta)
+        MN, MA, XA, DW = ChannelCountsNI(meta)
+        nNeural = MN + MA + XA
+    carChans = np.flatnonzero(chanList < nNeural)
+
+    hpSos = None
+    minFiltSamp = 0
+    if highPass is not None:
+        hpSos = butter(3, highPass, btype='highpass', fs=SampRate(meta),
+                       output='sos')
+        # sosfiltfilt needs more timepoints than its default padlen
+        nZeros = min((hpSos[:, 2] == 0).sum(), (hpSos[:, 5] == 0).sum())
+        minFiltSamp = 3 * (2 * len(hpSos) + 1 - nZeros) + 1
+
+    if lastSamp is None:
+        lastSamp = nFileSamp - 1
+    lastSamp = min(lastSamp, nFileSamp - 1)
+
+    def processChunk(chunkStart):
+        chunkEnd = min(chunkStart + chunkSize, lastSamp + 1)
+        padStart = max(chunkStart - overlap, 0)
+        padEnd = min(chunkEnd + overlap, nFileSamp)
+        # a short (last) chunk is read further back to be filtered,
+        # and trimmed again below
+        if padEnd - padStart < minFiltSamp:
+            padStart = max(padEnd - minFiltSamp, 0)
+        convArray = ReadConvertedChunk(rawData, padStart, padEnd, chanList,
+                                       conv, car=car, carChans=carChans,
+                                       hpSos=hpSos, dtype=dtype)
+        if returnPadded:
+            return(padStart, convArray)
+        convArray = convArray[:, chunkStart-padStart:chunkEnd-padStart]
+        return(chunkStart, np.ascontiguousarray(convArray))
+
+    try:
+        with ThreadPoolExecutor(max_workers=nThreads) as executor:
+            pending = deque()
+            for chunkStart in range(firstSamp, lastSamp + 1, chunkSize):
+                pending.append(executor.submit(processChunk, chunkStart))
+                if len(pending) > nThreads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        if hasattr(rawData, 'close'):
+            rawData.close()
+
+
+# Return the rising and falling edges of digital lines dLineList of word
+# dwReq, as a list with one (risingEdges, fallingEdges) pair of int64
+# zero-based sample indices per line. An edge is the first sample at which
+# the line has its new value. Unlike ExtractDigital, the file is streamed
+# chunk by chunk (the mtscomp chunks themselves for .cbin files, which hold
+# all channels, so whole chunks are decompressed but only the digital
+# channel is kept) and chunks are processed on nThreads threads.
+#
+def ExtractDigitalEdges(binFullPath, dwReq, dLineList, chunkSize=300000,
+                        nThreads=4):
+    binFullPath = Path(binFullPath)
+    meta = readMeta(binFullPath)
+    digCh = DigitalChannel(dwReq, meta)
+    if digCh is None:
+        return([])
+    rawData = makeRawReader(binFullPath, meta)
+    isCompressed = binFullPath.suffix == '.cbin'
+
+    if isCompressed:
+        bounds = np.asarray(rawData.chunk_bounds)
+    else:
+        bounds = np.append(np.arange(0, rawData.shape[0], chunkSize),
+                           rawData.shape[0])
+
+    lineBits = np.array([1 << line for line in dLineList], dtype='uint16')
+    lineMask = np.bitwise_or.reduce(lineBits)
+
+    def chunkEdges(iChunk):
+        if isCompressed:
+            offsets = rawData.chunk_offsets
+            chunk = rawData.read_chunk(iChunk, offsets[iChunk],
+                                       offsets[iChunk+1] - offsets[iChunk])
+            words = chunk[:, digCh]
+        else:
+            words = rawData[bounds[iChunk]:bounds[iChunk+1], digCh]
+        words = np.ascontiguousarray(words).view('uint16') & lineMask
+        # samples (within chunk) at which any requested line changes
+        changed = np.flatnonzero(words[1:] ^ words[:-1]) + 1
+        return(changed + bounds[iChunk], words[changed], words[0], words[-1])
+
+    try:
+        with ThreadPoolExecutor(max_workers=nThreads) as executor:
+            chunks = list(executor.map(chunkEdges, range(len(bounds) - 1)))
+    finally:
+        if hasattr(rawData, 'close'):
+            rawData.close()
+
+    edgeSamp, edgeWords = [np.zeros(0, 'int64')], [np.zeros(0, 'uint16')]
+    for iChunk, (samp, words, firstWord, _) in enumerate(chunks):
+        # transition across the boundary with the previous chunk
+        if (iChunk > 0) and (firstWord != chunks[iChunk-1][3]):
+            edgeSamp.append(np.array([bounds[iChunk]]))
+            edgeWords.append(np.array([firstWord]))
+        edgeSamp.append(samp)
+        edgeWords.append(words)
+    edgeSamp = np.concatenate(edgeSamp).astype('int64')
+    edgeWords = np.concatenate(edgeWords).astype('uint16')
+
+    # value of the lines before each change
+    initialWord = chunks[0][2] if len(chunks) > 0 else 0
+    prevWords = np.append(np.uint16(initialWord), edgeWords[:-1]).astype('uint16')
+
+    edges = []
+    for bit in lineBits:
+        isTransition = ((edgeWords ^ prevWords) & bit) > 0
+        isHigh = (edgeWords & bit) > 0
+        edges.append((edgeSamp[isTransition & isHigh],
+                      edgeSamp[isTransition & ~isHigh]))
+    return(edges)
+
+
 # Sample calling program to get a file from the user,
 # read metadata fetch sample rate, voltage conversion
 # values for this file and channel, and plot a small range
@@ -9,11 +9,13 @@ pinkRig_path= glob.glob(r'C:\Users\*\Documents\Github\PinkRigs')
 pinkRig_path = Path(pinkRig_path[0])
 sys.path.insert(0, (pinkRig_path.__str__()))
 from Admin.csv_queryExp import get_csv_location, check_date_selection
+from Admin.helpers.file_index import get_file_index
 
-def stage_KS_queue(mouse_selection='',date_selection='last3',resort = False):
+def stage_KS_queue(mouse_selection='',date_selection='last3',resort = False, refresh = True):
     # the function will have a kwarg input structure where you can overwrite MasterMouseList with
     # which mice to sort -- FT or FT032
     # what dates to sort -- last10 from today or a range (2021-12-13:2021-12-20)
+    # the files are looked up in the file index of each server, refresh re-lists the ephys folders that changed
     # check
     print('mice selected: %s' % mouse_selection)
     print('dates selected: %s' % date_selection)
@@ -50,22 +52,26 @@ def stage_KS_queue(mouse_selection='',date_selection='last3',resort = False):
                     #if some dates have been subselected
 
                 if check_date_selection(date_selection,[date])[0]:
+                    file_index = get_file_index(server)
+                    if refresh:
+                        file_index.refresh(r'%s\%s\ephys' % (subject,date))
                     ephys_files = r'%s\%s\%s\ephys\**\*.ap.cbin' % (server,subject,date) 
-                    ephys_files = glob.glob(ephys_files,recursive=True)
+                    ephys_files = file_index.glob(ephys_files)
                     
                     for ephys_file in ephys_files:
 
 
                         # look for pyKS folder with spike times in the same folder as ap.bin
                         KS_rez = r'%s\**\pyKS\**\spike_times.npy' % (os.path.dirname(ephys_file))
-                        KS_rez = glob.glob(KS_rez,recursive=True) # should not be longer than 1?
+                        KS_rez = file_index.find(KS_rez) # should not be longer than 1?
 
                         # check if is there, and not empty
                         if not KS_rez:
                             # couldn't find the kilosort folder/rez file
                             KS_done = False
                         else:
-                            if Path(KS_rez[0]).stat().st_size>0:
+                            _,size,_ = KS_rez[0]
+                            if size>0:
                                 KS_done = True
                             else:
                                 # file was 0kb
@@ -78,7 +84,7 @@ def stage_KS_queue(mouse_selection='',date_selection='last3',resort = False):
                         # override KS_done if the file was modified in the last hour. 
                         # check when the ephys file was created and don't sort if it's less than an hour.
                         # actually check when the corresponding .meta was 'created', for now... 
-                        meta_file_list = list((Path(ephys_file).parent).glob('*.meta'))
+                        meta_file_list = file_index.glob(r'%s\*.meta' % os.path.dirname(ephys_file))
                         is_recently_modified_file = len(meta_file_list)==0
 
                         # last_modification_time = Path(meta_file_path).stat().st_ctime
@@ -89,7 +95,7 @@ def stage_KS_queue(mouse_selection='',date_selection='last3',resort = False):
 
                         if not KS_done:
                             print(ephys_file)
-                            new_recs_to_sort.append(glob.glob(ephys_file,recursive=True))
+                            new_recs_to_sort.append([ephys_file])
 
     new_recs_to_sort = sum(new_recs_to_sort,[]) 
     print(new_recs_to_sort)
@@ -8,7 +8,7 @@ pd.options.mode.chained_assignment = None # disable warning, we will overwrite s
 
 # ibl ephys tools 
 import spikeglx
-from atlaselectrophysiology.extract_files import ks2_to_alf,extract_rmsmap,_sample2v
+from atlaselectrophysiology.extract_files import ks2_to_alf,_sample2v
 from ibllib.atlas import AllenAtlas
 atlas = AllenAtlas(25) # always register to the 25 um atlas 
 
@@ -18,13 +18,16 @@ pinkRig_path= glob.glob(r'C:\Users\*\Documents\Github\PinkRigs')
 pinkRig_path = Path(pinkRig_path[0])
 sys.path.insert(0, (pinkRig_path.__str__()))
 from Admin.csv_queryExp import get_csv_location, check_date_selection
+from Admin.helpers.file_index import get_file_index
 from Processing.pykilo.helpers import save_error_message
 from Processing.pykilo.ReadSGLXData.readSGLX import readMeta
+from Processing.pykilo.ephys_qc import extract_rms_map
 
-def stage_queue(mouse_selection='',ks_folder='pyKS', date_selection='previous3'):
+def stage_queue(mouse_selection='',ks_folder='pyKS', date_selection='previous3', refresh=True):
     # the function will have a kwarg input structure where you can overwrite MasterMouseList with
     # which mice to sort -- FT or FT032
     # what dates to sort -- previous10 from today or a range (2021-12-13:2021-12-20)
+    # the files are looked up in the file index of each server, refresh re-lists the ephys folders that changed
     # check
     
     print(mouse_selection)
@@ -59,20 +62,24 @@ def stage_queue(mouse_selection='',ks_folder='pyKS', date_selection='previous3')
                 #if some dates have been subselected
                 
                 if check_date_selection(date_selection,[date])[0]:
+                    file_index = get_file_index(server)
+                    if refresh:
+                        file_index.refresh(r'%s\%s\ephys' % (subject,date))
                     ephys_files = r'%s\%s\%s\ephys\**\*.ap.cbin' % (server,subject,date) 
-                    ephys_files = glob.glob(ephys_files,recursive=True)
+                    ephys_files = file_index.glob(ephys_files)
 
                     for ephys_file in ephys_files:
                         # look for pyKS folder with spike times in the same folder as ap.bin
                         KS_rez = r'%s\**\%s\**\spike_times.npy' % (os.path.dirname(ephys_file),ks_folder)
-                        KS_rez = glob.glob(KS_rez,recursive=True) # should not be longer than 1?
+                        KS_rez = file_index.find(KS_rez) # should not be longer than 1?
 
                         # check if is there, and not empty
                         if not KS_rez:
                             # couldn't find the kilosort folder/rez file
                             KS_done = False
                         else:
-                            if Path(KS_rez[0]).stat().st_size>0:
+                            _,size,_ = KS_rez[0]
+                            if size>0:
                                 KS_done = True
                             else:
                                 # file was 0kb
@@ -80,14 +87,15 @@ def stage_queue(mouse_selection='',ks_folder='pyKS', date_selection='previous3')
 
                         # also check for whether the ibl_format extraction is done
                         ibl_format = r'%s\**\%s\**\ibl_format\clusters.waveforms.npy' % (os.path.dirname(ephys_file),ks_folder)
-                        ibl_format = glob.glob(ibl_format,recursive=True) # should not be longer than 1?
+                        ibl_format = file_index.find(ibl_format) # should not be longer than 1?
 
                         # check if is there, and not empty
                         if not ibl_format:
                             # couldn't find the kilosort folder/rez file
                             ibl_formatting_done = False
                         else:
-                            if Path(ibl_format[0]).stat().st_size>0:
+                            _,size,_ = ibl_format[0]
+                            if size>0:
                                 ibl_formatting_done = True
                             else:
                                 # file was 0kb
@@ -119,7 +127,7 @@ def stage_queue(mouse_selection='',ks_folder='pyKS', date_selection='previous3')
     print('%d files are waiting to be converted ...'
         % (len(new_queue[new_queue['doneTag']==0])))
 
-def extract_data_PinkRigs(ks_path, ephys_path, out_path,do_raw_files=False):
+def extract_data_PinkRigs(ks_path, ephys_path, out_path,do_raw_files=False,n_threads=4):
     efiles = spikeglx.glob_ephys_files(ephys_path)
 
     for efile in efiles:
@@ -130,9 +138,9 @@ def extract_data_PinkRigs(ks_path, ephys_path, out_path,do_raw_files=False):
             # I might need to rewrite the channels.localCoordinate files. These seem to be wrong
             # on npix 2.0. (as in: incorrect spcing and positional identifier.)
             if do_raw_files:
-                extract_rmsmap(efile.ap, out_folder=out_path, spectra=False)
+                extract_rms_map(efile.ap, out_path, spectra=False, n_threads=n_threads)
         if efile.get('lf') and efile.lf.exists() and do_raw_files:
-            extract_rmsmap(efile.lf, out_folder=out_path)
+            extract_rms_map(efile.lf, out_path, n_threads=n_threads)
 
 def ks_to_ibl_format(ephys_path,ks_folder='pyKS',recompute=False):
     # Path to KS output
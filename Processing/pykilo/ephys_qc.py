@@ -0,0 +1,143 @@
+"""
+streaming computation of the raw data QC maps used for the histology alignment (RMS over time and power spectral density)
+
+This is a native version of atlaselectrophysiology.extract_files.extract_rmsmap: it writes the same
+_iblqc_ephysTimeRms{AP/LF} and _iblqc_ephysSpectralDensity{AP/LF} files, but streams the gain-corrected windows
+of the .bin/.cbin with readSGLX.StreamChunks and processes them in parallel, computing the RMS and the Welch
+spectra in the same pass.
+
+"""
+import sys,glob
+import numpy as np
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy import fft
+from scipy.signal import welch
+
+pinkRig_path= glob.glob(r'C:\Users\*\Documents\Github\PinkRigs')
+if len(pinkRig_path)>0:
+    sys.path.insert(0, pinkRig_path[0])
+
+from Processing.pykilo.ReadSGLXData.readSGLX import readMeta,SampRate,StreamChunks
+
+RMS_WIN_LENGTH_SECS = 3
+WELCH_WIN_LENGTH_SAMPLES = 1024
+
+def highpass_1Hz(data,fs):
+    """
+    removes frequencies below 1 Hz (cosine taper between 0 and 1 Hz) along the last axis, in the frequency domain
+    """
+    n = data.shape[-1]
+    f = fft.rfftfreq(n,d=1/fs)
+    taper = (f>0) & (f<1)
+    filc = (f>=1).astype(data.dtype)
+    filc[taper] = 0.5-np.cos(np.pi*f[taper])/2
+    return fft.irfft(fft.rfft(data,axis=-1)*filc,n=n,axis=-1)
+
+def compute_rms_map(binFullPath,spectra=True,n_threads=4):
+    """
+    RMS in 3 s windows and summed Welch spectral density of each channel of a .ap/.lf .bin or .cbin file
+
+    Parameters:
+    -----------
+    binFullPath: pathlib.Path
+    spectra: bool
+        whether to compute the power spectral density
+    n_threads: int
+        number of windows processed in parallel (each takes ~2x the window size of float32 data in memory)
+
+    Returns:
+    --------
+    : dict
+        TRMS: windows x channels
+        tscale: centre (s) of each window
+        spectral_density: freqs x channels, summed over windows
+        fscale: freqs
+    """
+    binFullPath = Path(binFullPath)
+    fs = SampRate(readMeta(binFullPath))
+    n_win_samples = int(2**np.ceil(np.log2(fs*RMS_WIN_LENGTH_SECS)))
+    fscale = fft.rfftfreq(WELCH_WIN_LENGTH_SAMPLES,d=1/fs)
+
+    def process_window(data):
+        data = highpass_1Hz(data,fs)
+        rms = np.sqrt(np.mean(data**2,axis=-1))
+        # the last window may be smaller than what is needed for welch
+        if (not spectra) or (data.shape[-1]<WELCH_WIN_LENGTH_SAMPLES):
+            return rms,None
+        _,w = welch(data,fs=fs,window='hann',nperseg=WELCH_WIN_LENGTH_SAMPLES,
+                    detrend='constant',return_onesided=True,scaling='density',axis=-1)
+        return rms,w.T
+
+    trms,tscale = [],[]
+    spectral_density = 0
+
+    # the windows are read and gain-corrected by StreamChunks, and filtered/analysed on a second pool
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        def add_window():
+            nonlocal spectral_density
+            first,n,future = pending.popleft()
+            rms,w = future.result()
+            trms.append(rms)
+            tscale.append((first+(n-1)/2)/fs)
+            if w is not None:
+                spectral_density = spectral_density+w
+
+        for first,data in StreamChunks(binFullPath,chunkSize=n_win_samples,nThreads=n_threads):
+            pending.append((first,data.shape[-1],executor.submit(process_window,data)))
+            if len(pending)>n_threads:
+                add_window()
+        while pending:
+            add_window()
+
+    n_channels = trms[0].size if trms else 0
+    win = {
+        'TRMS':np.array(trms,dtype='float64').reshape(-1,n_channels),
+        'tscale':np.array(tscale),
+        'spectral_density':spectral_density+np.zeros((fscale.size,n_channels)),
+        'fscale':fscale
+        }
+
+    return win
+
+def extract_rms_map(binFullPath,out_folder,spectra=True,n_threads=4):
+    """
+    computes the RMS/spectral density maps of binFullPath and saves them in the ibl format, i.e.
+    _iblqc_ephysTimeRms{AP/LF}.rms/timestamps.npy and _iblqc_ephysSpectralDensity{AP/LF}.power/freqs.npy
+
+    Parameters:
+    -----------
+    binFullPath: pathlib.Path
+        .ap or .lf .bin/.cbin file
+    out_folder: pathlib.Path
+    spectra: bool
+    n_threads: int
+
+    Returns:
+    --------
+    : list
+        saved files
+    """
+    binFullPath,out_folder = Path(binFullPath),Path(out_folder)
+    band = 'LF' if '.lf.' in binFullPath.name else 'AP'
+    print('Computing QC for %s' % binFullPath)
+    win = compute_rms_map(binFullPath,spectra=spectra,n_threads=n_threads)
+
+    out_folder.mkdir(parents=True,exist_ok=True)
+    to_save = {
+        ('ephysTimeRms%s' % band,'rms'):win['TRMS'],
+        ('ephysTimeRms%s' % band,'timestamps'):win['tscale']
+        }
+    if spectra:
+        to_save[('ephysSpectralDensity%s' % band,'power')] = win['spectral_density']
+        to_save[('ephysSpectralDensity%s' % band,'freqs')] = win['fscale']
+
+    out_files = []
+    for (object,attribute),dat in to_save.items():
+        out_file = out_folder / ('_iblqc_%s.%s.npy' % (object,attribute))
+        np.save(out_file,dat.astype(np.single))
+        out_files.append(out_file)
+
+    return out_files
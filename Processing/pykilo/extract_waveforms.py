@@ -0,0 +1,225 @@
+"""
+random-access extraction of spike waveform snippets from the raw (.bin or .cbin) ephys data
+
+Rather than going through the whole file, only N spikes per cluster are sampled. The requested
+snippets are sorted in time and nearby ones are read together (one read per <max_read_samples stretch),
+gain-corrected with readSGLX.ReadConvertedChunk, on a thread pool.
+
+"""
+import sys,glob
+import numpy as np
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+pinkRig_path= glob.glob(r'C:\Users\*\Documents\Github\PinkRigs')
+if len(pinkRig_path)>0:
+    sys.path.insert(0, pinkRig_path[0])
+
+from Admin.csv_queryExp import Bunch
+from Processing.pykilo.ReadSGLXData.readSGLX import readMeta,SampRate,makeRawReader,ReadConvertedChunk,ChannelCountsIM,GainFactorsIM
+
+
+def get_read_groups(samples,n_before,n_after,max_read_samples=30000):
+    """
+    coalesce the snippets around sorted spike samples into reads of at most max_read_samples
+
+    Parameters:
+    -----------
+    samples: np.ndarray
+        sorted spike samples
+    n_before,n_after: int
+        snippet extent around each spike
+    max_read_samples: int
+
+    Returns:
+    --------
+    : list
+        (first spike,last spike+1) index into samples of each read
+    """
+    groups = []
+    group_start = 0
+    for i in range(1,samples.size):
+        if (samples[i]+n_after)-(samples[group_start]-n_before)>max_read_samples:
+            groups.append((group_start,i))
+            group_start = i
+    if samples.size>0:
+        groups.append((group_start,samples.size))
+
+    return groups
+
+def iter_snippets(rawData,samples,n_before,n_after,conv,car=True,max_read_samples=30000,n_threads=4):
+    """
+    generator of the gain-corrected data around each (sorted) spike sample.
+
+    Parameters:
+    -----------
+    rawData: readSGLX.makeRawReader output ([timepoints X channels])
+    samples: np.ndarray
+        sorted spike samples
+    n_before,n_after: int
+    conv: np.ndarray
+        gain of each channel (from GainFactorsIM), the first conv.size channels are returned
+    car: bool
+        whether to subtract the median across channels
+    max_read_samples: int
+        max length of a single read
+    n_threads: int
+        number of reads that are done in parallel/ahead
+
+    Yields:
+    --------
+    : (int,int)
+        index into samples of the spikes in the read
+    : np.ndarray
+        float32 (V), spikes x samples x channels
+    """
+    window = np.arange(-n_before,n_after)
+    groups = get_read_groups(samples,n_before,n_after,max_read_samples=max_read_samples)
+
+    def read_group(group):
+        i0,i1 = group
+        first_samp = samples[i0]-n_before
+        data = ReadConvertedChunk(rawData,first_samp,samples[i1-1]+n_after,np.arange(conv.size),conv,car=car).T
+        return group,data[(samples[i0:i1]-first_samp)[:,np.newaxis]+window]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for group in groups:
+            pending.append(executor.submit(read_group,group))
+            if len(pending)>n_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _remove_offset(snippets):
+    # remove the offset of each channel
+    return snippets-snippets.mean(axis=1)[:,np.newaxis,:]
+
+def get_neighbour_channels(peak_channels,n_channels,channel_positions):
+    """
+    the n_channels closest channels to each peak channel (incl. the peak channel itself)
+
+    Parameters:
+    -----------
+    peak_channels: np.ndarray
+    n_channels: int
+    channel_positions: np.ndarray
+        (channels x n_dims) position of each channel
+
+    Returns:
+    --------
+    : np.ndarray
+        peak_channels x n_channels, ordered by distance
+    """
+    channel_positions = np.asarray(channel_positions,dtype='float')
+    n_total = channel_positions.shape[0]
+    dist = np.linalg.norm(channel_positions[peak_channels][:,np.newaxis,:]-channel_positions[np.newaxis,:,:],axis=2)
+    return np.argsort(dist,axis=1,kind='stable')[:,:min(n_channels,n_total)]
+
+def extract_waveforms(binFullPath,spike_times,spike_clusters,
+                      n_spikes=100,n_before=20,n_after=62,n_channels=16,
+                      channel_positions=None,peak_channels=None,car=True,
+                      max_read_samples=30000,n_threads=4,seed=0):
+    """
+    extract the raw waveforms of n_spikes random spikes of each cluster, on the channels around the peak channel
+
+    Parameters:
+    -----------
+    binFullPath: pathlib.Path
+        .ap.bin or .ap.cbin file
+    spike_times: np.ndarray
+        spike times (s) in the time base of the raw data (i.e. spikes.times of ibl_format, not the timeline-aligned ONE_preproc ones)
+    spike_clusters: np.ndarray
+        cluster ID of each spike
+    n_spikes: int
+        number of spikes sampled per cluster
+    n_before,n_after: int
+        number of samples before/after each spike
+    n_channels: int
+        number of channels around the peak channel
+    channel_positions: None/np.ndarray
+        (channels x 2) used to get the neighbouring channels (e.g. channels.localCoordinates). If None, by channel index.
+    peak_channels: None/np.ndarray
+        peak channel of each cluster (in the order of np.unique(spike_clusters)).
+        If None, it is the channel with the largest peak-to-peak mean waveform (from a first, smaller pass).
+    car: bool
+        whether to subtract the median across channels
+    max_read_samples: int
+        snippets within this many samples are read together
+    n_threads: int
+    seed: int
+        for the spike sampling
+
+    Returns:
+    --------
+    Bunch
+        clusters: np.ndarray
+            cluster IDs
+        waveforms: np.ndarray
+            float32 (V), clusters x n_spikes x n_channels x samples, nan if the cluster has fewer spikes
+        channels: np.ndarray
+            clusters x n_channels, channel of each waveform row (first is the peak channel)
+        spike_idx: np.ndarray
+            clusters x n_spikes, index of the sampled spikes into spike_times (-1 if none)
+    """
+    binFullPath = Path(binFullPath)
+    meta = readMeta(binFullPath)
+    fs = SampRate(meta)
+    n_ap,_,_ = ChannelCountsIM(meta)
+    rawData = makeRawReader(binFullPath,meta)
+    n_file_samples = rawData.shape[0]
+
+    spike_samples = np.round(np.asarray(spike_times)*fs).astype('int64')
+    clusters,spike_cluster_idx = np.unique(spike_clusters,return_inverse=True)
+    n_clusters = clusters.size
+
+    # sample the spikes of each cluster, that are far enough from the edges of the file
+    rng = np.random.default_rng(seed)
+    is_valid = (spike_samples>=n_before) & (spike_samples+n_after<=n_file_samples)
+    spike_idx = np.full((n_clusters,n_spikes),-1,dtype='int64')
+    valid_idx = np.flatnonzero(is_valid)
+    valid_idx = valid_idx[np.argsort(spike_cluster_idx[valid_idx],kind='stable')]
+    cluster_bounds = np.searchsorted(spike_cluster_idx[valid_idx],np.arange(n_clusters+1))
+    for c in range(n_clusters):
+        idx = valid_idx[cluster_bounds[c]:cluster_bounds[c+1]]
+        if idx.size>n_spikes:
+            idx = np.sort(rng.choice(idx,n_spikes,replace=False))
+        spike_idx[c,:idx.size] = idx
+
+    def sorted_requests(idx_matrix):
+        cluster_pos,spike_pos = np.nonzero(idx_matrix>=0)
+        idx = idx_matrix[cluster_pos,spike_pos]
+        order = np.argsort(spike_samples[idx],kind='stable')
+        return spike_samples[idx][order],cluster_pos[order],spike_pos[order]
+
+    conv = GainFactorsIM(np.arange(n_ap),meta).astype('float32')
+
+    if peak_channels is None:
+        # mean waveform of the first few sampled spikes on all channels
+        samples,cluster_pos,_ = sorted_requests(spike_idx[:,:min(n_spikes,20)])
+        sums = np.zeros((n_clusters,n_before+n_after,n_ap),dtype='float32')
+        for (i0,i1),snippets in iter_snippets(rawData,samples,n_before,n_after,conv,car=car,
+                                               max_read_samples=max_read_samples,n_threads=n_threads):
+            np.add.at(sums,cluster_pos[i0:i1],_remove_offset(snippets))
+        peak_channels = np.argmax(np.ptp(sums,axis=1),axis=1)
+
+    if channel_positions is None:
+        # closest channels by index
+        channel_positions = np.arange(n_ap)[:,np.newaxis]
+    channels = get_neighbour_channels(np.asarray(peak_channels),n_channels,np.asarray(channel_positions)[:n_ap])
+
+    waveforms = np.full((n_clusters,n_spikes,channels.shape[1],n_before+n_after),np.nan,dtype='float32')
+    samples,cluster_pos,spike_pos = sorted_requests(spike_idx)
+    for (i0,i1),snippets in iter_snippets(rawData,samples,n_before,n_after,conv,car=car,
+                                           max_read_samples=max_read_samples,n_threads=n_threads):
+        snippets = _remove_offset(snippets)
+        chans = channels[cluster_pos[i0:i1]]
+        # spikes x samples x channels -> spikes x channels x samples
+        snippets = np.take_along_axis(snippets,chans[:,np.newaxis,:],axis=2).transpose(0,2,1)
+        waveforms[cluster_pos[i0:i1],spike_pos[i0:i1]] = snippets
+
+    if hasattr(rawData,'close'):
+        rawData.close()
+
+    return Bunch({'clusters':clusters,'waveforms':waveforms,'channels':channels,'spike_idx':spike_idx})
@@ -25,6 +25,7 @@ def preproc_ephys(func=None,funckwargs=None,**kwargs):
         clus_anat -- add cluster anatomy location after alignment has been performed
     fuckwargs(optional): dict
         if you want to pass down arguments for the functions called by func
+        for compress/decompress e.g. {'n_processes':4} (see compress_recordings/decompress_recordings)
     kwargs
         for queryCSV. standard kwargs are subject,expDate,expNum,expDef
     example uses in manual.ipynb
@@ -36,6 +37,9 @@ def preproc_ephys(func=None,funckwargs=None,**kwargs):
     ephys_paths = [Path(p) for p in ephys_paths]
 
 
+    # (de)compression is done for all recordings together, several at a time
+    to_compress,to_decompress = [],[]
+
     for rec in ephys_paths:
         # read the corresponding ephys files
         uncompressed_path = list(rec.glob('**\*.bin'))
@@ -45,27 +49,20 @@ def preproc_ephys(func=None,funckwargs=None,**kwargs):
         print(compressed_path)
 
         if func == 'compress':
-            from Admin.helpers.compress_data import mainCompress
             # find whether there is a uncompressed filed
             if len(uncompressed_path)!=1:
                 print('%s is already compressed.' % rec.__str__())
             else:
-                print('compressing ...')
-                mainCompress(binFile=(uncompressed_path[0]).__str__())
+                to_compress.append(uncompressed_path[0])
 
         if 'decompress' in func:
-            from Admin.helpers.decompress_data import mainDecompress
             # find whether there is a uncompressed filed
             if len(compressed_path)!=1:
                 print('%s is not compressed.' % rec.__str__())
                 if len(ch_path)!=1:
                     print('%s - we cannot find the .ch file.' % rec.__str__())
             else:
-                print('compressing ...')
-                mainDecompress(
-                    cbinFile=(compressed_path[0]).__str__(),
-                    chFile=(ch_path[0]).__str__()
-                    )
+                to_decompress.append((compressed_path[0],ch_path[0]))
                                     
         if 'ibl_anat' in func:
             from Processing.pykilo.convert_to_ibl_format import add_anat_to_ibl_format
@@ -88,6 +85,28 @@ def preproc_ephys(func=None,funckwargs=None,**kwargs):
             else: 
                 run_pyKS_single_file(compressed_path[0],**funckwargs)
 
-        elif 'clus_anat' in func:
-            from Processing.pyhist.assign_clusters_to_atlas import save_out_cluster_location
-            save_out_cluster_location(rec)
\ No newline at end of file
+    if len(to_compress)>0:
+        from Admin.helpers.compress_data import compress_recordings
+        print('compressing %d recordings ...' % len(to_compress))
+        compress_recordings(to_compress,**(funckwargs or {}))
+
+    if 'clus_anat' in func:
+        from Processing.pyhist.assign_clusters_to_atlas import save_out_cluster_locations,get_anatmap_path_same_day
+        # the recordings of a probe on the same day share their anatmap,
+        # which is thus found, read and hashed once per subject/date/probe
+        for probe in ['probe0','probe1']:
+            probe_recs = recordings[recordings['ephysPath%s' % probe.capitalize()].notna()]
+            for (subject,expDate),recs in probe_recs.groupby(['subject','expDate'],sort=False):
+                one_paths = [Path(f) / 'ONE_preproc' / probe for f in recs.expFolder]
+                try:
+                    anatmap_paths = get_anatmap_path_same_day(one_paths[0])
+                except (IndexError,KeyError) as e:
+                    print('no anatmap found for %s %s %s: %s' % (subject,expDate,probe,e))
+                    anatmap_paths = None
+                save_out_cluster_locations(one_paths,anatmap_paths=anatmap_paths)
+
+    if len(to_decompress)>0:
+        from Admin.helpers.decompress_data import decompress_recordings
+        print('decompressing %d recordings ...' % len(to_decompress))
+        cbinFiles,chFiles = zip(*to_decompress)
+        decompress_recordings(cbinFiles,chFiles,**(funckwargs or {}))